@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.PerformanceMiddleware',
+    'core.query_inspector.QueryInspectorMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -132,3 +134,164 @@ MEDIA_ROOT = 'vol/web/media'
 STATIC_ROOT = 'vol/web/static'
 
 AUTH_USER_MODEL = 'core.User'
+
+# Performance instrumentation
+# Adds Server-Timing headers, JSON request logs and the /metrics endpoint
+
+PERFORMANCE_METRICS_ENABLED = (
+    os.environ.get('PERFORMANCE_METRICS_ENABLED', '0') == '1'
+)
+# /metrics is served to staff and to requests with this bearer token
+PERFORMANCE_METRICS_TOKEN = os.environ.get('PERFORMANCE_METRICS_TOKEN', '')
+
+# Query inspection for development and staging
+# Flags repeated query shapes (N+1) and slow queries per request
+
+QUERY_INSPECTOR_ENABLED = (
+    os.environ.get('QUERY_INSPECTOR_ENABLED', '0') == '1'
+)
+QUERY_INSPECTOR_RAISE = os.environ.get('QUERY_INSPECTOR_RAISE', '0') == '1'
+QUERY_INSPECTOR_REPEAT_THRESHOLD = int(
+    os.environ.get('QUERY_INSPECTOR_REPEAT_THRESHOLD', 5)
+)
+QUERY_INSPECTOR_SLOW_MS = int(os.environ.get('QUERY_INSPECTOR_SLOW_MS', 100))
+
+# Background jobs (core.jobs, run by `manage.py run_jobs`)
+# Eager mode runs jobs inline when they are queued instead
+
+JOBS_EAGER = os.environ.get('JOBS_EAGER', '0') == '1'
+JOB_WORKER_PROCESSES = None
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BACKOFF_SECONDS = 10
+JOB_RETRY_BACKOFF_MAX_SECONDS = 60 * 60
+JOB_LEASE_SECONDS = 60 * 60
+
+# Near-duplicate search defaults (Hamming distance of 64 bit dHashes)
+
+SIMILAR_IMAGES_DISTANCE = 8
+SIMILAR_IMAGES_LIMIT = 50
+
+# Deep zoom tile pyramids
+
+IMAGE_TILE_SIZE = 254
+IMAGE_TILE_OVERLAP = 1
+IMAGE_TILE_QUALITY = 85
+IMAGE_TILE_CACHE_SECONDS = 365 * 24 * 60 * 60
+# Tiles and render copies requested without the image's current ?v= are
+# kept this long, then revalidated with their ETag
+IMAGE_UNVERSIONED_CACHE_SECONDS = 60
+IMAGE_TILES_MAX_PIXELS = 4 * 1024 ** 3
+
+# On-demand derivatives (resized / transcoded copies of uploads)
+# Only these parameter values are accepted, bounding the cache key space
+
+IMAGE_DERIVATIVE_SIZES = (64, 128, 256, 512, 1024, 2048)
+IMAGE_DERIVATIVE_FORMATS = ('jpeg', 'png', 'webp')
+IMAGE_DERIVATIVE_QUALITIES = (50, 70, 85, 95)
+IMAGE_DERIVATIVE_CACHE_DIR = os.environ.get(
+    'IMAGE_DERIVATIVE_CACHE_DIR', 'vol/web/cache/derivatives'
+)
+IMAGE_DERIVATIVE_CACHE_BYTES = int(
+    os.environ.get('IMAGE_DERIVATIVE_CACHE_BYTES', 1024 ** 3)
+)
+IMAGE_DERIVATIVE_CACHE_SECONDS = 24 * 60 * 60
+
+# Admin changelists count at most this many rows exactly, then estimate
+
+ADMIN_EXACT_COUNT_LIMIT = 10000
+
+# Incremental sync (/api/image/sync/): change log rows read per batch
+
+SYNC_BATCH_SIZE = 500
+SYNC_MAX_BATCH_SIZE = 5000
+
+# Server-sent events (/api/image/events/) and the pub/sub feeding them
+# The in-memory broker only reaches streams served by the same process,
+# so changes made by the run_jobs worker or other web processes are lost;
+# core.pubsub.PostgresBroker delivers them with LISTEN/NOTIFY instead
+
+PUBSUB_BROKER = os.environ.get('PUBSUB_BROKER', 'core.pubsub.InMemoryBroker')
+PUBSUB_MAX_PENDING = 1000
+EVENTS_HEARTBEAT_SECONDS = 15
+EVENTS_MAX_SECONDS = 5 * 60
+
+# Largest number of images one bulk status transition may move
+
+IMAGE_STATUS_BATCH_MAX = 1000
+
+# Region annotations: shapes per bulk write and points per shape
+
+ANNOTATIONS_BATCH_MAX = 10000
+ANNOTATION_MAX_POINTS = 10000
+
+# Deepest allowed label hierarchy; keeps Label.path within its 255 chars
+
+LABEL_MAX_DEPTH = 8
+
+# Work queue (/api/image/images/next-batch/): images leased per request
+# and how long a lease lasts before the images go back to the queue
+
+IMAGE_LEASE_BATCH_SIZE = 20
+IMAGE_LEASE_BATCH_MAX = 500
+IMAGE_LEASE_SECONDS = 15 * 60
+IMAGE_LEASE_MAX_SECONDS = 24 * 60 * 60
+
+# Label suggestions from the nearest labelled images by embedding
+# Each process holds the embedding index of this many users in memory,
+# about 0.6 kB per image; past max changes an index is reloaded whole
+
+EMBEDDING_NEIGHBOURS = 10
+EMBEDDING_MAX_NEIGHBOURS = 100
+EMBEDDING_INDEX_MAX_USERS = 8
+EMBEDDING_INDEX_MAX_CHANGES = 10000
+
+# Uploads are checked from their header while they stream in, before
+# anything is stored or decoded: the format is sniffed from the magic
+# bytes and the dimensions read without decoding. The default pixel
+# limit stays under Pillow's own decompression bomb threshold.
+
+FILE_UPLOAD_HANDLERS = [
+    'image.uploads.ImageUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+IMAGE_UPLOAD_FORMATS = (
+    'png', 'jpeg', 'gif', 'tiff', 'bmp', 'webp', 'dicom',
+)
+IMAGE_UPLOAD_MAX_BYTES = int(
+    os.environ.get('IMAGE_UPLOAD_MAX_BYTES', 256 * 1024 ** 2)
+)
+IMAGE_UPLOAD_MAX_PIXELS = int(
+    os.environ.get('IMAGE_UPLOAD_MAX_PIXELS', 12000 * 12000)
+)
+
+# Background deletion of files and of deleted users' rows: rows or files
+# per batch, the pause after each batch, and batches per job before the
+# job queues its own continuation. Files younger than the minimum age are
+# never collected as orphans, their row may not be committed yet.
+
+CLEANUP_BATCH_SIZE = 1000
+CLEANUP_BATCH_PAUSE_SECONDS = 0.2
+CLEANUP_BATCHES_PER_JOB = 50
+CLEANUP_ORPHAN_MIN_AGE_SECONDS = 60 * 60
+
+# Media storage: local files under MEDIA_ROOT, or an S3 compatible bucket
+# when S3_BUCKET is set (S3_ENDPOINT_URL points at MinIO or another
+# stand-in; credentials come from the usual AWS_ variables). Transfers
+# over the threshold are split into parts sent in parallel. Files are
+# then downloaded, and can be uploaded, with presigned URLs valid for
+# the given number of seconds, without going through the API.
+
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('S3_REGION') or None
+S3_MULTIPART_THRESHOLD = 16 * 1024 ** 2
+S3_MULTIPART_CHUNK_SIZE = 16 * 1024 ** 2
+S3_MAX_CONCURRENCY = 8
+S3_READ_BUFFER_SIZE = 1024 ** 2
+S3_URL_EXPIRES_SECONDS = 60 * 60
+S3_UPLOAD_EXPIRES_SECONDS = 15 * 60
+DEFAULT_FILE_STORAGE = (
+    'core.storage.S3Storage' if S3_BUCKET
+    else 'core.storage.FileSystemStorage'
+)
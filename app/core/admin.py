@@ -2,12 +2,14 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.utils.translation import gettext as _
 
-from core import models
+from core import cleanup, models
+from core.paginator import EstimatedCountPaginator
 
 
 class UserAdmin(BaseUserAdmin):
     ordering = ['id']
     list_display = ['email', 'name']
+    search_fields = ['email', 'name']
     fieldsets = (
         (None, {'fields': ('email', 'password')}),
         (_('Personal Info'), {'fields': ('name',)}),
@@ -24,8 +26,86 @@ class UserAdmin(BaseUserAdmin):
         }),
     )
 
+    def get_deleted_objects(self, objs, request):
+        """Summarize what goes with the users instead of listing it.
+
+        Collecting every row a user owns, as the confirmation page does
+        by default, takes about as long as deleting them.
+        """
+        objs = list(objs)
+        model_count = {
+            models.User._meta.verbose_name_plural: len(objs),
+            models.Image._meta.verbose_name_plural: sum(
+                obj.image_count for obj in objs
+            ),
+        }
+        return [str(obj) for obj in objs], model_count, set(), []
+
+    def delete_model(self, request, obj):
+        """Deactivate the user and leave the deletion to a job"""
+        cleanup.purge_user_later(obj)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            cleanup.purge_user_later(obj)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables too large to count or list whole"""
+    paginator = EstimatedCountPaginator
+    # Skips the second, unfiltered COUNT(*) behind "x of y selected"
+    show_full_result_count = False
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    ordering = ('-id',)
+
+
+class ImageAttrAdmin(LargeTableAdmin):
+    list_display = ('name', 'user')
+    search_fields = ('name',)
+
+
+class LabelAdmin(ImageAttrAdmin):
+    list_display = ('name', 'parent', 'user')
+    list_select_related = ('user', 'parent')
+    raw_id_fields = ('user', 'parent')
+    readonly_fields = ('path',)
+
+
+class ImageAdmin(LargeTableAdmin):
+    list_display = (
+        'title', 'user', 'status', 'date', 'format', 'width', 'height',
+        'tiles_status'
+    )
+    # Each has a single column index, see Image.Meta
+    list_filter = ('status', 'date', 'format', 'tiles_status')
+    search_fields = ('search_text',)
+    # Searched on demand instead of rendering every label in a select
+    autocomplete_fields = ('labels', 'patient_info')
+    readonly_fields = (
+        'version', 'width', 'height', 'mode', 'format', 'modality',
+        'byte_size', 'checksum', 'phash', 'tiles_status', 'lease_token',
+        'lease_expires', 'intensity_mean', 'intensity_std', 'contrast',
+        'overexposed', 'blankness',
+    )
+    exclude = ('phash_0', 'phash_1', 'phash_2', 'phash_3', 'histogram')
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search like the API does, on the lower cased search text"""
+        for term in search_term.lower().split():
+            queryset = queryset.filter(search_text__contains=term)
+        return queryset, False
+
+
+class JobAdmin(LargeTableAdmin):
+    list_display = ('id', 'kind', 'status', 'progress', 'attempts', 'user',
+                    'created')
+    list_filter = ('status',)
+    readonly_fields = ('locked_by', 'locked_at', 'created', 'updated')
+
 
 admin.site.register(models.User, UserAdmin)
-admin.site.register(models.Label)
-admin.site.register(models.PatientInfo)
-admin.site.register(models.Image)
+admin.site.register(models.Label, LabelAdmin)
+admin.site.register(models.PatientInfo, ImageAttrAdmin)
+admin.site.register(models.Image, ImageAdmin)
+admin.site.register(models.Job, JobAdmin)
@@ -0,0 +1,99 @@
+import math
+import time
+
+
+_registry = {}
+
+
+class BenchmarkContext:
+    """State shared by the benchmark cases of a run"""
+
+    def __init__(self, client, user, password):
+        self.client = client
+        self.user = user
+        self.password = password
+
+
+def register(name, iterations=None):
+    """Register a benchmark case.
+
+    The decorated function receives a BenchmarkContext and returns the
+    zero-argument callable that is timed. Setup done before returning is
+    not measured. `iterations` caps the run count for expensive cases.
+    """
+    def decorator(func):
+        _registry[name] = (func, iterations)
+        return func
+    return decorator
+
+
+def cases():
+    """Return the registered cases by name"""
+    return dict(_registry)
+
+
+def expect_status(response, status_code=200):
+    """Fail the run rather than time an erroring endpoint"""
+    if response.status_code != status_code:
+        raise AssertionError(
+            f'Expected status {status_code}, got {response.status_code}'
+        )
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of sorted samples (nearest rank)"""
+    if not samples:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(samples)))
+    return samples[rank - 1]
+
+
+def summarize(samples):
+    """Summarize per-call durations in seconds as milliseconds"""
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return {
+        'iterations': len(ordered),
+        'throughput_per_s': round(len(ordered) / total, 2) if total else 0.0,
+        'mean_ms': round(total / len(ordered) * 1000, 3),
+        'min_ms': round(ordered[0] * 1000, 3),
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p90_ms': round(percentile(ordered, 90) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def run_case(func, context, iterations, warmup=0):
+    """Run one case and return the summary of its timed calls"""
+    call = func(context)
+    for _ in range(warmup):
+        call()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+def compare(results, baseline, threshold, metric='p50_ms'):
+    """Return the cases whose metric regressed by more than threshold.
+
+    Both arguments are result documents as written by the benchmark
+    command; threshold is a fraction, so 0.2 flags a 20% slowdown.
+    """
+    regressions = []
+    for name, current in results['results'].items():
+        previous = baseline['results'].get(name)
+        if not previous or not previous[metric]:
+            continue
+        change = current[metric] / previous[metric] - 1
+        if change > threshold:
+            regressions.append(
+                (name, previous[metric], current[metric], change)
+            )
+
+    return regressions
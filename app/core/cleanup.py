@@ -0,0 +1,229 @@
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from core import jobs
+from core.models import (
+    TILES_DIR,
+    UPLOADS_DIR,
+    Annotation,
+    ChangeLog,
+    Image,
+    Job,
+    User,
+    tiles_prefix,
+    tiles_version,
+)
+
+
+def _paced(items):
+    """Yield items, pausing after every CLEANUP_BATCH_SIZE of them"""
+    for count, item in enumerate(items, 1):
+        yield item
+        if count % settings.CLEANUP_BATCH_SIZE == 0:
+            jobs.heartbeat()
+            time.sleep(settings.CLEANUP_BATCH_PAUSE_SECONDS)
+
+
+def _batches(items):
+    """Group items in lists of CLEANUP_BATCH_SIZE"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == settings.CLEANUP_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def storage_files(prefix):
+    """Yield the name of every file under a storage directory"""
+    try:
+        directories, files = default_storage.listdir(prefix)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield f'{prefix}{name}'
+    for directory in directories:
+        yield from storage_files(f'{prefix}{directory}/')
+
+
+def delete_files(names=(), prefixes=()):
+    """Delete files, and every file under some directories, from storage.
+
+    Missing files are skipped, so running a deletion twice is harmless.
+    Returns the number of files deleted.
+    """
+    def targets():
+        yield from names
+        for prefix in prefixes:
+            yield from storage_files(prefix)
+
+    deleted = 0
+    for name in _paced(targets()):
+        default_storage.delete(name)
+        deleted += 1
+    return deleted
+
+
+def delete_files_later(names=(), prefixes=()):
+    """Queue a job deleting files from storage.
+
+    The job is written in the caller's transaction: the files only go if
+    the change that orphaned them commits. It has no user, so it outlives
+    the user deleting it.
+    """
+    names = [name for name in names if name]
+    if names or prefixes:
+        jobs.enqueue(
+            'core.delete_files', names=names, prefixes=list(prefixes)
+        )
+
+
+def delete_replaced_later(image, names, version):
+    """Queue the deletion of the files an upload replaced.
+
+    Every upload gets a new name, so the old file and its preview are
+    always orphaned. So are the tiles of the old version, unless the new
+    file has the same content.
+    """
+    stale = version and version != tiles_version(image.checksum)
+    delete_files_later(
+        names, [tiles_prefix(image.id, version)] if stale else []
+    )
+
+
+def image_prefixes(image_id, tiles_status):
+    """Return the storage directories holding files of an image"""
+    return [tiles_prefix(image_id)] if tiles_status else []
+
+
+def _delete_images(user_id):
+    """Delete one batch of a user's images with their links and files"""
+    rows = list(
+        Image.objects.filter(user_id=user_id).order_by('id').values_list(
+            'id', 'image_file', 'preview_file', 'tiles_status'
+        )[:settings.CLEANUP_BATCH_SIZE]
+    )
+    if not rows:
+        return False
+    ids = [row[0] for row in rows]
+    with transaction.atomic():
+        Annotation.objects.filter(image_id__in=ids).delete()
+        Image.labels.through.objects.filter(image_id__in=ids).delete()
+        Image.patient_info.through.objects.filter(image_id__in=ids).delete()
+        # Without the signal receivers, which would keep counts, search
+        # text and the change log of a departing user up to date one row
+        # at a time
+        images = Image.objects.filter(id__in=ids)
+        images._raw_delete(images.db)
+    delete_files(
+        [name for _, file, preview, _ in rows for name in (file, preview)
+         if name],
+        [
+            prefix for image_id, _, _, tiles_status in rows
+            for prefix in image_prefixes(image_id, tiles_status)
+        ],
+    )
+    return True
+
+
+def _row_deleter(model):
+    def delete(user_id):
+        ids = list(
+            model.objects.filter(user_id=user_id).order_by('id').values_list(
+                'id', flat=True
+            )[:settings.CLEANUP_BATCH_SIZE]
+        )
+        if ids:
+            model.objects.filter(id__in=ids).delete()
+        return bool(ids)
+    return delete
+
+
+# The tables that can hold millions of a user's rows, emptied batch by
+# batch before the user row itself is deleted
+PURGE_STEPS = (_delete_images, _row_deleter(ChangeLog), _row_deleter(Job))
+
+
+def purge_user(user_id):
+    """Delete a user with their images, files and history, in batches.
+
+    Each batch is its own short transaction, followed by a pause of
+    CLEANUP_BATCH_PAUSE_SECONDS so the database keeps serving requests.
+    Stops after CLEANUP_BATCHES_PER_JOB batches and returns False if rows
+    remain; returns True once the user, and with it their labels and
+    patient info, is deleted.
+    """
+    batches = 0
+    for step in PURGE_STEPS:
+        while step(user_id):
+            batches += 1
+            if batches == settings.CLEANUP_BATCHES_PER_JOB:
+                return False
+            jobs.heartbeat()
+            time.sleep(settings.CLEANUP_BATCH_PAUSE_SECONDS)
+    User.objects.filter(id=user_id).delete()
+    return True
+
+
+def purge_user_later(user):
+    """Deactivate a user at once and delete them with a background job"""
+    with transaction.atomic():
+        User.objects.filter(id=user.id).update(is_active=False)
+        jobs.enqueue('core.purge_user', user_id=user.id)
+
+
+def orphaned_uploads(cutoff):
+    """Yield the storage names of uploads and previews no image refers to.
+
+    Files modified after the cutoff timestamp are left alone, as the row
+    of an upload in progress may not be committed yet. The storage is
+    scanned as a stream and each batch of files checked with one query.
+    """
+    for batch in _batches(default_storage.scan(UPLOADS_DIR)):
+        names = [name for name, _ in batch]
+        known = set()
+        for field in ('image_file', 'preview_file'):
+            known.update(
+                Image.objects.filter(**{f'{field}__in': names}).values_list(
+                    field, flat=True
+                )
+            )
+        for name, modified in batch:
+            if name not in known and modified < cutoff:
+                yield name
+
+
+def _tile_owner(name):
+    """Return the image id and version of a tile name, or None"""
+    parts = name[len(TILES_DIR):].split('/')
+    if len(parts) < 3 or not parts[0].isdigit():
+        return None
+    return int(parts[0]), parts[1]
+
+
+def orphaned_tiles(cutoff):
+    """Yield the storage names of tiles no image refers to.
+
+    Those are the tiles of deleted images, and of files since replaced by
+    a new upload, whose version no longer matches.
+    """
+    for batch in _batches(default_storage.scan(TILES_DIR)):
+        owners = {name: _tile_owner(name) for name, _ in batch}
+        checksums = dict(
+            Image.objects.filter(
+                id__in={owner[0] for owner in owners.values() if owner}
+            ).values_list('id', 'checksum')
+        )
+        for name, modified in batch:
+            owner = owners[name]
+            if owner is None or modified >= cutoff:
+                continue
+            image_id, version = owner
+            if (image_id not in checksums
+                    or tiles_version(checksums[image_id]) != version):
+                yield name
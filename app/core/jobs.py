@@ -0,0 +1,189 @@
+import contextvars
+import json
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+
+from core.models import Job
+
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+_current_job = contextvars.ContextVar('current_job', default=None)
+_discovered = False
+
+# Error of jobs whose worker stopped renewing their lease
+LOST = 'The worker running the job stopped without reporting an outcome.'
+
+
+class UnknownJobKind(Exception):
+    """Raised when a job names a handler that was never registered"""
+
+
+def register(kind):
+    """Register a function as the handler of a job kind.
+
+    Handlers receive the job payload as keyword arguments, may call
+    report_progress() and return a JSON serializable result. They are
+    looked up in every installed app's `tasks` module.
+    """
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def get_handler(kind):
+    global _discovered
+    if kind not in _handlers and not _discovered:
+        autodiscover_modules('tasks')
+        _discovered = True
+    try:
+        return _handlers[kind]
+    except KeyError:
+        raise UnknownJobKind(kind)
+
+
+def enqueue(kind, user=None, max_attempts=None, delay=None, **payload):
+    """Queue a job and return it.
+
+    The row is written in the caller's transaction, so workers only see
+    it once that commits. With JOBS_EAGER set the job runs inline
+    instead, which is what the test suite uses.
+    """
+    job = Job.objects.create(
+        kind=kind,
+        user=user,
+        payload=json.dumps(payload),
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_after=timezone.now() + (delay or timedelta()),
+    )
+    if settings.JOBS_EAGER:
+        Job.objects.filter(id=job.id).update(
+            status=Job.RUNNING, attempts=1, locked_by='eager'
+        )
+        execute(job.id)
+        job.refresh_from_db()
+    return job
+
+
+def claim(worker, limit):
+    """Lock up to limit runnable jobs for a worker and return their ids.
+
+    SELECT ... FOR UPDATE SKIP LOCKED lets any number of workers on any
+    number of nodes poll the same table: each skips the rows the others
+    are claiming instead of waiting on them. Jobs whose worker vanished
+    are reclaimed once their lease of JOB_LEASE_SECONDS runs out without
+    a heartbeat, or marked failed if that was their last attempt, so a
+    job that crashes its worker is not retried forever.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.JOB_LEASE_SECONDS)
+    with transaction.atomic():
+        rows = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=Job.QUEUED, run_after__lte=now)
+                | Q(status=Job.RUNNING, locked_at__lt=stale)
+            )
+            .order_by('run_after', 'id')
+            .values_list('id', 'status', 'attempts', 'max_attempts')[:limit]
+        )
+        lost = [
+            job_id for job_id, status, attempts, max_attempts in rows
+            if status == Job.RUNNING and attempts >= max_attempts
+        ]
+        ids = [row[0] for row in rows if row[0] not in lost]
+        Job.objects.filter(id__in=lost).update(
+            status=Job.FAILED, error=LOST, locked_at=None
+        )
+        Job.objects.filter(id__in=ids).update(
+            status=Job.RUNNING,
+            locked_by=worker,
+            locked_at=now,
+            attempts=F('attempts') + 1,
+        )
+    return ids
+
+
+def backoff(attempts):
+    """Return the delay before retrying a job that failed attempts times"""
+    delay = min(
+        settings.JOB_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1),
+        settings.JOB_RETRY_BACKOFF_MAX_SECONDS,
+    )
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def fail(job, error):
+    """Record a failed attempt of a claimed job.
+
+    The job is queued again with exponential backoff until it has used
+    max_attempts, then marked failed.
+    """
+    logger.warning('Job %s failed (attempt %s)', job, job.attempts)
+    if job.attempts < job.max_attempts:
+        Job.objects.filter(id=job.id).update(
+            status=Job.QUEUED,
+            error=error,
+            run_after=timezone.now() + backoff(job.attempts),
+            locked_by='',
+            locked_at=None,
+        )
+    else:
+        Job.objects.filter(id=job.id).update(
+            status=Job.FAILED, error=error, locked_at=None
+        )
+
+
+def execute(job_id):
+    """Run a claimed job and record its outcome.
+
+    A failed job is queued again with exponential backoff until it has
+    used max_attempts, then marked failed. Runs in the worker processes,
+    so it never raises.
+    """
+    job = Job.objects.get(id=job_id)
+    token = _current_job.set(job.id)
+    try:
+        handler = get_handler(job.kind)
+        result = handler(**json.loads(job.payload))
+    except Exception:
+        fail(job, traceback.format_exc())
+    else:
+        Job.objects.filter(id=job.id).update(
+            status=Job.SUCCEEDED,
+            progress=1,
+            result=json.dumps(result),
+            error='',
+            locked_at=None,
+        )
+    finally:
+        _current_job.reset(token)
+
+
+def heartbeat(**fields):
+    """Renew the lease of the job being executed, if any.
+
+    Long jobs call this, directly or through report_progress(), more
+    often than every JOB_LEASE_SECONDS so that no other worker takes
+    them for abandoned and runs them a second time.
+    """
+    job_id = _current_job.get()
+    if job_id is not None:
+        Job.objects.filter(id=job_id, status=Job.RUNNING).update(
+            locked_at=timezone.now(), **fields
+        )
+
+
+def report_progress(fraction):
+    """Record the progress (0 to 1) of the job being executed, if any"""
+    heartbeat(progress=max(0.0, min(1.0, fraction)))
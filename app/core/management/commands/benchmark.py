@@ -0,0 +1,153 @@
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from django.utils.module_loading import autodiscover_modules
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import benchmarks, seeding
+
+
+class Command(BaseCommand):
+    """Django command to time the main API endpoints"""
+
+    help = (
+        'Time the registered endpoint benchmarks and report throughput and '
+        'latency percentiles as JSON. Everything runs in a transaction '
+        'that is rolled back, with uploads going to a temporary directory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--case', action='append', dest='cases',
+                            help='Only run the named case (repeatable)')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--user', default=seeding.SEED_EMAIL.format(0),
+                            help='Email of the user to benchmark as')
+        parser.add_argument('--password', default=seeding.SEED_PASSWORD)
+        parser.add_argument('--seed-users', type=int, default=0,
+                            help='Seed this many users before running')
+        parser.add_argument('--seed-images', type=int, default=1000,
+                            help='Images per seeded user')
+        parser.add_argument('--output', help='Write the results to a file')
+        parser.add_argument('--compare',
+                            help='Baseline results file to compare against')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Fractional p50 slowdown that fails')
+
+    def handle(self, *args, **options):
+        autodiscover_modules('benchmarks')
+        available = benchmarks.cases()
+        names = options['cases'] or sorted(available)
+        unknown = set(names) - set(available)
+        if unknown:
+            raise CommandError(f'Unknown cases: {", ".join(sorted(unknown))}')
+
+        media_root = tempfile.mkdtemp(prefix='benchmark-media-')
+        try:
+            # The test client talks to the 'testserver' host
+            allowed_hosts = settings.ALLOWED_HOSTS + ['testserver']
+            with override_settings(MEDIA_ROOT=media_root,
+                                   ALLOWED_HOSTS=allowed_hosts), \
+                    transaction.atomic():
+                results = self._run(names, available, options)
+                transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        document = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(document + '\n')
+        else:
+            self.stdout.write(document)
+
+        if options['compare']:
+            self._compare(results, options['compare'], options['threshold'])
+
+    def _run(self, names, available, options):
+        if options['seed_users']:
+            seeding.seed(
+                users=options['seed_users'],
+                images_per_user=options['seed_images'],
+                password=options['password'],
+            )
+        try:
+            user = get_user_model().objects.get(email=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(
+                f'User {options["user"]} does not exist, run seed_data or '
+                f'pass --seed-users'
+            )
+
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        context = benchmarks.BenchmarkContext(
+            client, user, options['password']
+        )
+
+        results = {}
+        for name in names:
+            func, max_iterations = available[name]
+            iterations = options['iterations']
+            if max_iterations:
+                iterations = min(iterations, max_iterations)
+            results[name] = benchmarks.run_case(
+                func, context, iterations, warmup=options['warmup']
+            )
+            self.stderr.write(
+                f'{name}: p50 {results[name]["p50_ms"]} ms, '
+                f'p95 {results[name]["p95_ms"]} ms'
+            )
+
+        return {
+            'meta': {
+                'commit': _git_commit(),
+                'created': datetime.now(timezone.utc).isoformat(),
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'iterations': options['iterations'],
+                'warmup': options['warmup'],
+                'images': user.image_set.count(),
+            },
+            'results': results,
+        }
+
+    def _compare(self, results, baseline_path, threshold):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = benchmarks.compare(results, baseline, threshold)
+        for name, before, after, change in regressions:
+            self.stderr.write(self.style.ERROR(
+                f'{name}: p50 {before} ms -> {after} ms ({change:+.0%})'
+            ))
+        if regressions:
+            raise CommandError(
+                f'{len(regressions)} benchmark(s) regressed by more than '
+                f'{threshold:.0%}'
+            )
+        self.stderr.write(self.style.SUCCESS('No regressions'))
+
+
+def _git_commit():
+    """Return the commit being benchmarked, when run from a checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,59 @@
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from core import cleanup
+from core.models import TILES_DIR
+
+
+class Command(BaseCommand):
+    """Django command to delete the media files no image refers to"""
+
+    help = (
+        'Scan the media storage for uploads and tiles that no image '
+        'refers to any more, and delete them'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='List the orphans without deleting them')
+        parser.add_argument(
+            '--min-age', type=int,
+            default=settings.CLEANUP_ORPHAN_MIN_AGE_SECONDS,
+            help='Seconds since a file was modified before it is collected'
+        )
+
+    def handle(self, *args, **options):
+        if not hasattr(default_storage, 'scan'):
+            raise CommandError('The storage cannot list its files')
+        cutoff = time.time() - options['min_age']
+        dry_run = options['dry_run']
+        counts = {'uploads': 0, 'tiles': 0}
+
+        def found(kind, orphans):
+            for orphan in orphans:
+                counts[kind] += 1
+                if dry_run or options['verbosity'] > 1:
+                    self.stdout.write(orphan)
+                yield orphan
+
+        orphans = [
+            found('uploads', cleanup.orphaned_uploads(cutoff)),
+            found('tiles', cleanup.orphaned_tiles(cutoff)),
+        ]
+        for names in orphans:
+            if dry_run:
+                for _ in names:
+                    pass
+            else:
+                cleanup.delete_files(names)
+        if not dry_run:
+            default_storage.prune(TILES_DIR)
+
+        action = 'Found' if dry_run else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {counts["uploads"]} orphaned uploads and '
+            f'{counts["tiles"]} orphaned tiles'
+        ))
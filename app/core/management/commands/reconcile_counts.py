@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.models import reconcile_counts
+
+
+class Command(BaseCommand):
+    """Django command to repair the denormalized image counters"""
+
+    help = (
+        'Recompute Label.image_count and User.image_count where they '
+        'drifted from the real counts'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append',
+                            dest='users', help='Only this user id')
+
+    def handle(self, *args, **options):
+        labels, users = reconcile_counts(options['users'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Fixed {labels} label and {users} user counts'
+        ))
@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import jobs
+from core.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Django command to run background jobs"""
+
+    help = (
+        'Claim queued jobs and run them in a pool of processes. Start one '
+        'per node; workers coordinate through the job table only.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=settings.JOB_WORKER_PROCESSES,
+            help='Worker processes, 0 runs jobs in this process'
+        )
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no runnable job is left')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        if processes is None:
+            processes = os.cpu_count() or 1
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.stdout.write(f'Worker {worker} with {processes} processes')
+        if settings.PUBSUB_BROKER == 'core.pubsub.InMemoryBroker':
+            logger.warning(
+                'PUBSUB_BROKER is in memory: changes made by jobs never '
+                'reach event streams served by other processes'
+            )
+
+        if processes == 0:
+            ran = self._run_inline(worker, options)
+        else:
+            ran = self._run_pool(worker, processes, options)
+
+        self.stdout.write(self.style.SUCCESS(f'Ran {ran} jobs'))
+
+    def _run_inline(self, worker, options):
+        ran = 0
+        while True:
+            claimed = jobs.claim(worker, 1)
+            for job_id in claimed:
+                jobs.execute(job_id)
+                ran += 1
+            if not claimed:
+                if options['once']:
+                    return ran
+                time.sleep(options['poll_interval'])
+
+    def _pool(self, processes):
+        # Spawned rather than forked children set Django up from scratch
+        # and never share the parent's database connections
+        return ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+
+    def _run_pool(self, worker, processes, options):
+        ran = 0
+        # The job each pending future runs
+        running = {}
+        pool = self._pool(processes)
+        try:
+            while True:
+                free = processes - len(running)
+                claimed = jobs.claim(worker, free) if free else []
+                for index, job_id in enumerate(claimed):
+                    try:
+                        running[pool.submit(jobs.execute, job_id)] = job_id
+                    except BrokenProcessPool:
+                        for unsubmitted in claimed[index:]:
+                            self._fail(unsubmitted)
+                        pool = self._restart(pool, processes, running)
+                        break
+                if not running:
+                    if options['once']:
+                        return ran
+                    time.sleep(options['poll_interval'])
+                    continue
+                done, _ = wait(
+                    running,
+                    timeout=options['poll_interval'],
+                    return_when=FIRST_COMPLETED,
+                )
+                broken = False
+                for future in done:
+                    job_id = running.pop(future)
+                    ran += 1
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        # A process died, say killed for memory, taking
+                        # its job and failing every other pending one
+                        broken = True
+                        self._fail(job_id)
+                    except Exception:
+                        # execute() records job errors itself; this is a
+                        # failure to run it at all
+                        logger.exception('Job %s could not run', job_id)
+                        self._fail(job_id)
+                if broken:
+                    pool = self._restart(pool, processes, running)
+        finally:
+            pool.shutdown(wait=True)
+
+    def _restart(self, pool, processes, running):
+        """Replace a broken pool, failing the jobs it still held"""
+        self.stderr.write('A worker process died, restarting the pool')
+        for job_id in running.values():
+            self._fail(job_id)
+        running.clear()
+        pool.shutdown(wait=False)
+        return self._pool(processes)
+
+    def _fail(self, job_id):
+        """Record the failed attempt of a job its process never finished"""
+        job = Job.objects.filter(id=job_id, status=Job.RUNNING).first()
+        if job is not None:
+            jobs.fail(job, jobs.LOST)
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core import seeding
+
+
+class Command(BaseCommand):
+    """Django command to bulk insert a synthetic data set"""
+
+    help = 'Bulk insert reproducible users, labels, patients and images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1)
+        parser.add_argument('--images', type=int, default=100,
+                            help='Images per user')
+        parser.add_argument('--labels', type=int, default=20,
+                            help='Labels per user')
+        parser.add_argument('--patients', type=int, default=20,
+                            help='Patient info entries per user')
+        parser.add_argument('--labels-per-image', type=int, default=3)
+        parser.add_argument('--patients-per-image', type=int, default=1)
+        parser.add_argument('--random-seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            users = seeding.seed(
+                users=options['users'],
+                images_per_user=options['images'],
+                labels_per_user=options['labels'],
+                patients_per_user=options['patients'],
+                labels_per_image=options['labels_per_image'],
+                patients_per_image=options['patients_per_image'],
+                random_seed=options['random_seed'],
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(users)} users with {options["images"]} images '
+            f'each (password "{seeding.SEED_PASSWORD}")'
+        ))
@@ -0,0 +1,236 @@
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216
+)
+
+
+class RequestMetrics:
+    """Timings collected while serving a single request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.duration = None
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.timings = defaultdict(float)
+        self._depth = defaultdict(int)
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """Database execute wrapper counting and timing every query"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_time += time.perf_counter() - start
+
+    @contextmanager
+    def span(self, name):
+        """Add the time spent in the block to the named timing.
+
+        Nested spans of the same name are only counted once, so nested
+        serializers do not inflate the total.
+        """
+        self._depth[name] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth[name] -= 1
+            if not self._depth[name]:
+                self.timings[name] += time.perf_counter() - start
+
+    def finish(self):
+        """Stop the wall clock for the request"""
+        self.duration = time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header"""
+        entries = [
+            f'total;dur={self.duration * 1000:.2f}',
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.db_queries} '
+            f'queries"',
+        ]
+        for name, seconds in sorted(self.timings.items()):
+            entries.append(f'{name};dur={seconds * 1000:.2f}')
+
+        return ', '.join(entries)
+
+
+def current():
+    """Return the metrics of the request being served, if any"""
+    return _current.get()
+
+
+@contextmanager
+def activate(metrics):
+    """Make the given metrics the current ones for the block"""
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed(name):
+    """Time the block against the current request, if instrumented"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.span(name):
+        yield
+
+
+class TimedSerializerMixin:
+    """Attribute serializer work to the current request's metrics"""
+
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super().to_representation(instance)
+
+    def is_valid(self, raise_exception=False):
+        with timed('serializer'):
+            return super().is_valid(raise_exception=raise_exception)
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def samples(self):
+        """Yield (le, cumulative count) pairs, ending with +Inf"""
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield format_value(bound), cumulative
+        yield '+Inf', self.count
+
+
+class MetricsRegistry:
+    """Process wide per-route histograms of request metrics"""
+
+    METRICS = (
+        (
+            'http_request_duration_seconds',
+            'Wall time spent serving the request',
+            DURATION_BUCKETS,
+        ),
+        (
+            'http_request_db_queries',
+            'Database queries executed per request',
+            COUNT_BUCKETS,
+        ),
+        (
+            'http_request_db_duration_seconds',
+            'Time spent in the database per request',
+            DURATION_BUCKETS,
+        ),
+        (
+            'http_request_serializer_duration_seconds',
+            'Time spent in serializers per request',
+            DURATION_BUCKETS,
+        ),
+        (
+            'http_response_size_bytes',
+            'Size of the response body',
+            SIZE_BUCKETS,
+        ),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def _histogram(self, name, buckets, labels):
+        key = (name, labels)
+        if key not in self._histograms:
+            self._histograms[key] = Histogram(buckets)
+        return self._histograms[key]
+
+    def observe(self, route, method, metrics, response_size=None):
+        """Record the metrics of a finished request"""
+        labels = (('route', route), ('method', method))
+        values = (
+            metrics.duration,
+            metrics.db_queries,
+            metrics.db_time,
+            metrics.timings.get('serializer', 0.0),
+            response_size,
+        )
+        with self._lock:
+            for (name, _, buckets), value in zip(self.METRICS, values):
+                if value is not None:
+                    self._histogram(name, buckets, labels).observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self):
+        """Return the registry in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, help_text, _ in self.METRICS:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for (key, labels), hist in sorted(self._histograms.items()):
+                    if key != name:
+                        continue
+                    label_str = ','.join(
+                        f'{k}="{escape_label(v)}"' for k, v in labels
+                    )
+                    for le, count in hist.samples():
+                        lines.append(
+                            f'{name}_bucket{{{label_str},le="{le}"}} {count}'
+                        )
+                    lines.append(
+                        f'{name}_sum{{{label_str}}} {format_value(hist.total)}'
+                    )
+                    lines.append(f'{name}_count{{{label_str}}} {hist.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    """Format a number the way Prometheus clients do"""
+    if float(value).is_integer():
+        return f'{float(value):.1f}'
+    return repr(float(value))
+
+
+def escape_label(value):
+    """Escape a label value for the text exposition format"""
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\n', '\\n')
+        .replace('"', '\\"')
+    )
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,74 @@
+import json
+import logging
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from core import metrics
+
+
+logger = logging.getLogger('core.performance')
+
+
+def route_name(request):
+    """Return a low cardinality name for the route that served a request"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+class PerformanceMiddleware:
+    """Record wall, database and serializer time for every request.
+
+    The figures are returned in a Server-Timing header, logged as a JSON
+    line and aggregated into per-route histograms served by the metrics
+    view. When PERFORMANCE_METRICS_ENABLED is off the middleware removes
+    itself from the chain at startup, so it costs nothing.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PERFORMANCE_METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_metrics = metrics.RequestMetrics()
+        with ExitStack() as stack:
+            stack.enter_context(metrics.activate(request_metrics))
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(
+                        request_metrics.execute_wrapper
+                    )
+                )
+            response = self.get_response(request)
+        request_metrics.finish()
+
+        size = None
+        if not response.streaming:
+            size = len(response.content)
+        response['Server-Timing'] = request_metrics.server_timing()
+
+        route = route_name(request)
+        metrics.registry.observe(
+            route, request.method, request_metrics, response_size=size
+        )
+        logger.info(json.dumps({
+            'event': 'request',
+            'route': route,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(request_metrics.duration * 1000, 2),
+            'db_queries': request_metrics.db_queries,
+            'db_ms': round(request_metrics.db_time * 1000, 2),
+            'serializer_ms': round(
+                request_metrics.timings.get('serializer', 0.0) * 1000, 2
+            ),
+            'response_bytes': size,
+        }))
+
+        return response
@@ -0,0 +1,51 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:08
+
+from django.db import migrations, models
+
+
+def backfill_search_text(apps, schema_editor):
+    Image = apps.get_model('core', 'Image')
+    image_ids = list(Image.objects.values_list('id', flat=True))
+    for start in range(0, len(image_ids), 1000):
+        images = Image.objects.filter(
+            id__in=image_ids[start:start + 1000]
+        ).prefetch_related('labels', 'patient_info')
+        for image in images:
+            words = [image.title]
+            words.extend(label.name for label in image.labels.all())
+            words.extend(info.name for info in image.patient_info.all())
+            image.search_text = ' '.join(words).lower()
+        Image.objects.bulk_update(images, ['search_text'])
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX core_image_search_text_trgm ON core_image '
+        'USING gin (search_text gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS core_image_search_text_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_image_phash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(backfill_search_text, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_image_search_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='tiles_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], max_length=16),
+        ),
+    ]
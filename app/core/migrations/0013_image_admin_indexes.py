@@ -0,0 +1,25 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['date'], name='core_image_date_24a8fa_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['format'], name='core_image_format_1c4ab3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['tiles_status'], name='core_image_tiles_s_34d1ce_idx'),
+        ),
+    ]
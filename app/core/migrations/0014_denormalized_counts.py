@@ -0,0 +1,46 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:19
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_of(queryset, field):
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(count=Count('*'))
+        .values('count')
+    ), 0)
+
+
+def backfill_counts(apps, schema_editor):
+    Image = apps.get_model('core', 'Image')
+    Label = apps.get_model('core', 'Label')
+    User = apps.get_model('core', 'User')
+    Label.objects.update(
+        image_count=count_of(Image.labels.through.objects.all(), 'label_id')
+    )
+    User.objects.update(image_count=count_of(Image.objects.all(), 'user_id'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_image_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='label',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
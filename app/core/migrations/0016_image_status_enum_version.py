@@ -0,0 +1,70 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:25
+
+from django.db import migrations, models
+
+
+STATUS_CODES = {'new': 0, 'in_progress': 1, 'labelled': 2, 'reviewed': 3}
+
+
+def status_to_code(apps, schema_editor):
+    """Map the free-form statuses onto the enum, unknown ones to new"""
+    Image = apps.get_model('core', 'Image')
+    statuses = Image.objects.values_list('status', flat=True).distinct()
+    for status in list(statuses):
+        name = '_'.join(status.lower().split())
+        Image.objects.filter(status=status).update(
+            status_code=STATUS_CODES.get(name, 0)
+        )
+
+
+def code_to_status(apps, schema_editor):
+    Image = apps.get_model('core', 'Image')
+    for name, code in STATUS_CODES.items():
+        Image.objects.filter(status_code=code).update(
+            status=name.replace('_', ' ').capitalize()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(status_to_code, code_to_status),
+        # A default lets the column be added back when migrating backwards
+        migrations.AlterField(
+            model_name='image',
+            name='status',
+            field=models.CharField(default='New', max_length=255),
+        ),
+        migrations.RemoveField(
+            model_name='image',
+            name='status',
+        ),
+        migrations.RenameField(
+            model_name='image',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'New'), (1, 'In progress'), (2, 'Labelled'), (3, 'Reviewed')], db_index=True, default=0),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'status'], name='core_image_user_id_19c8e8_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_image_status_enum_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Annotation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(0, 'Box'), (1, 'Polygon')])),
+                ('points', models.BinaryField()),
+                ('x_min', models.FloatField()),
+                ('y_min', models.FloatField()),
+                ('x_max', models.FloatField()),
+                ('y_max', models.FloatField()),
+                ('area', models.FloatField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='annotations', to='core.Image')),
+                ('label', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Label')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['label', 'kind', 'area'], name='core_annota_label_i_7689cf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['image', 'label'], name='core_annota_image_i_e281c6_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:34
+
+from django.db import migrations, models
+from django.db.models import Value
+from django.db.models.functions import Cast, Concat
+import django.db.models.deletion
+
+
+def fill_paths(apps, schema_editor):
+    """Existing labels are all roots: their path is '/<id>/'"""
+    Label = apps.get_model('core', 'Label')
+    Label.objects.update(
+        path=Concat(
+            Value('/'), Cast('id', models.CharField()), Value('/'),
+            output_field=models.CharField(),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_annotation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='label',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='core.Label'),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
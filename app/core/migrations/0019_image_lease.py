@@ -0,0 +1,31 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_label_hierarchy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='lease_token',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'status', 'lease_expires'], name='core_image_user_id_f6ac17_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'lease_token'], name='core_image_user_id_46f53a_idx'),
+        ),
+    ]
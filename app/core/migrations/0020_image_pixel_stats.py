@@ -0,0 +1,59 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_image_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='blankness',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='contrast',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='histogram',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='intensity_mean',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='intensity_std',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='overexposed',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'intensity_mean'], name='core_image_user_id_a76d18_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'contrast'], name='core_image_user_id_67f0df_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'overexposed'], name='core_image_user_id_f46e57_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'blankness'], name='core_image_user_id_8fd6ab_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_image_pixel_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
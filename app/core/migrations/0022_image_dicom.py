@@ -0,0 +1,45 @@
+# Generated by Django 3.0.14 on 2026-10-19 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_image_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='modality',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='preview_file',
+            field=models.ImageField(blank=True, null=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='sop_instance_uid',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='patientinfo',
+            name='patient_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'modality'], name='core_image_user_id_9a8f01_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'sop_instance_uid'], name='core_image_user_id_929579_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientinfo',
+            index=models.Index(fields=['user', 'patient_id'], name='core_patien_user_id_0a77ea_idx'),
+        ),
+    ]
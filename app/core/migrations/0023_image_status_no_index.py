@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-19 19:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_image_dicom'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'New'), (1, 'In progress'), (2, 'Labelled'), (3, 'Reviewed')], default=0),
+        ),
+    ]
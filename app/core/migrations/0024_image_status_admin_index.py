@@ -0,0 +1,17 @@
+# Generated by Django 3.0.14 on 2026-10-19 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_image_status_no_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['status'], name='core_image_status_bca4b1_idx'),
+        ),
+    ]
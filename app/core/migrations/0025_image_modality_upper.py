@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-19 20:15
+
+from django.db import migrations
+from django.db.models.functions import Upper
+
+
+def modality_to_upper(apps, schema_editor):
+    """Upper-case stored modalities, which the API now matches exactly"""
+    Image = apps.get_model('core', 'Image')
+    Image.objects.exclude(modality=Upper('modality')).update(
+        modality=Upper('modality')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_image_status_admin_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(modality_to_upper, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,33 @@
 import uuid
 import os
+from contextlib import contextmanager
 from datetime import date
 
-from django.db import models
+from django.db import models, transaction
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.db.models.functions import (
+    Cast,
+    Coalesce,
+    Concat,
+    Length,
+    Replace,
+    Substr,
+)
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
     PermissionsMixin,
 )
 from django.conf import settings
+from django.utils import timezone
+
+
+# Storage directories of uploaded files and of tile pyramids
+UPLOADS_DIR = 'uploads/image/'
+TILES_DIR = 'tiles/'
+# Image.format of DICOM uploads, which PIL cannot decode
+DICOM_FORMAT = 'DICOM'
 
 
 def image_file_path(instance, filename):
@@ -16,10 +35,54 @@ def image_file_path(instance, filename):
     ext = filename.split('.')[-1]
     filename = f'{uuid.uuid4()}.{ext}'
 
-    return os.path.join('uploads/image/', filename)
+    return os.path.join(UPLOADS_DIR, filename)
+
+
+def tiles_version(checksum):
+    """Return the part of tile paths that changes when a file is replaced"""
+    return checksum[:16]
+
+
+def tiles_prefix(image_id, version=None):
+    """Return the storage directory of an image's tiles, or of one version
+    of them
+    """
+    prefix = f'{TILES_DIR}{image_id}/'
+    return f'{prefix}{version}/' if version else prefix
+
+
+# Users whose deletion is in progress: the cascade must not log changes
+# that would reference the user row being deleted
+_deleting_users = set()
+
+
+def is_being_deleted(user_id):
+    return user_id in _deleting_users
+
+
+@contextmanager
+def _deleting(user_ids):
+    """Mark users as being deleted until the block ends, even when the
+    deletion fails and is rolled back
+    """
+    user_ids = set(user_ids) - _deleting_users
+    _deleting_users.update(user_ids)
+    try:
+        yield
+    finally:
+        _deleting_users.difference_update(user_ids)
+
+
+class UserQuerySet(models.QuerySet):
+    def delete(self):
+        with _deleting(self.values_list('id', flat=True)):
+            return super().delete()
 
 
 class UserManager(BaseUserManager):
+    def get_queryset(self):
+        return UserQuerySet(self.model, using=self._db)
+
     def create_user(self, email, password=None, **extra_fields):
         """Creates and saves a new user"""
         if not email:
@@ -47,48 +110,589 @@ class User(AbstractBaseUser, PermissionsMixin):
     name = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
+    # Denormalized, maintained by core.signals; see reconcile_counts()
+    image_count = models.PositiveIntegerField(default=0, editable=False)
+    # Last ChangeLog.seq handed out for the user's changes
+    change_seq = models.BigIntegerField(default=0, editable=False)
 
     objects = UserManager()
 
     USERNAME_FIELD = "email"
 
+    def delete(self, *args, **kwargs):
+        with _deleting([self.id]):
+            return super().delete(*args, **kwargs)
+
 
 class Label(models.Model):
-    """Label to be used for an image"""
+    """Label to be used for an image, optionally under a parent label.
+
+    The hierarchy is also stored as a materialized path of ids, e.g.
+    '/3/17/42/' for label 42 under 17 under 3, so a whole subtree is one
+    indexed prefix match: path__startswith=label.path. Moving a label
+    rewrites the paths of its subtree with a single UPDATE.
+    """
     name = models.CharField(max_length=255)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
     )
+    parent = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='children',
+    )
+    path = models.CharField(
+        max_length=255, default='', editable=False, db_index=True
+    )
+    # Number of images carrying the label, maintained like User.image_count
+    image_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
+    @property
+    def depth(self):
+        """Number of labels above this one"""
+        return self.path.count('/') - 2
+
+    def _path_parent_id(self):
+        """Return the parent id recorded in the stored path"""
+        ids = self.path.strip('/').split('/')
+        return int(ids[-2]) if len(ids) > 1 else None
+
+    def check_parent(self, parent):
+        """Raise ValidationError if parent cannot hold this label"""
+        if parent is None:
+            return
+        if parent.user_id != self.user_id:
+            raise ValidationError(
+                {'parent': 'The parent label belongs to another user.'}
+            )
+        if self.path and parent.path.startswith(self.path):
+            raise ValidationError({
+                'parent': 'A label cannot be placed under itself or one '
+                          'of its descendants.'
+            })
+        height = 0
+        if self.path:
+            slashes = Length('path') - Length(
+                Replace('path', Value('/'), Value(''))
+            )
+            deepest = Label.objects.filter(
+                path__startswith=self.path
+            ).aggregate(slashes=Max(slashes))['slashes']
+            height = deepest - self.path.count('/')
+        if parent.depth + 1 + height >= settings.LABEL_MAX_DEPTH:
+            raise ValidationError({
+                'parent': f'Labels can be nested at most '
+                          f'{settings.LABEL_MAX_DEPTH} levels deep.'
+            })
+
+    def clean(self):
+        self.check_parent(self.parent)
+
+    def save(self, *args, **kwargs):
+        """Save the label, keeping the paths of it and its subtree in step.
+
+        The label and its parent are locked and their paths read again
+        before the parent is checked, so two concurrent moves cannot build
+        a cycle or nest labels deeper than LABEL_MAX_DEPTH between the
+        check and the write.
+        """
+        with transaction.atomic():
+            if self.parent_id:
+                locked = {
+                    label.id: label for label in Label.objects
+                    .select_for_update()
+                    .filter(id__in={self.parent_id, self.id} - {None})
+                    .only('id', 'user_id', 'path')
+                    .order_by('id')
+                }
+                if self.parent_id in locked:
+                    self.parent = locked[self.parent_id]
+                if self.id in locked and not self._state.adding:
+                    self.path = locked[self.id].path
+            parent_path = self.parent.path if self.parent_id else '/'
+            if self._state.adding:
+                self.check_parent(self.parent)
+                super().save(*args, **kwargs)
+                self.path = f'{parent_path}{self.id}/'
+                Label.objects.filter(id=self.id).update(path=self.path)
+                return
+            update_fields = kwargs.get('update_fields')
+            moved = (
+                self.path and self.parent_id != self._path_parent_id()
+                and (update_fields is None or 'parent' in update_fields)
+            )
+            if moved:
+                self.check_parent(self.parent)
+            super().save(*args, **kwargs)
+            if moved:
+                old_path, self.path = self.path, f'{parent_path}{self.id}/'
+                Label.objects.filter(path__startswith=old_path).update(
+                    path=Concat(
+                        Value(self.path), Substr('path', len(old_path) + 1),
+                        output_field=models.CharField(),
+                    )
+                )
+
 
 class PatientInfo(models.Model):
     """Patient's personal Information"""
     name = models.CharField(max_length=255)
+    # Patient ID of DICOM uploads, which are linked to the patient by it
+    patient_id = models.CharField(max_length=64, blank=True)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
     )
 
+    class Meta:
+        indexes = [models.Index(fields=['user', 'patient_id'])]
+
     def __str__(self):
         return self.name
 
 
+class VersionConflict(Exception):
+    """Raised when saving an image changed since it was read"""
+
+
 class Image(models.Model):
     """Image object"""
+    NEW = 0
+    IN_PROGRESS = 1
+    LABELLED = 2
+    REVIEWED = 3
+    STATUS_CHOICES = (
+        (NEW, 'New'),
+        (IN_PROGRESS, 'In progress'),
+        (LABELLED, 'Labelled'),
+        (REVIEWED, 'Reviewed'),
+    )
+    # How the API spells each status
+    STATUS_NAMES = {
+        NEW: 'new',
+        IN_PROGRESS: 'in_progress',
+        LABELLED: 'labelled',
+        REVIEWED: 'reviewed',
+    }
+    TILES_PENDING = 'pending'
+    TILES_READY = 'ready'
+    TILES_FAILED = 'failed'
+    TILES_STATUS_CHOICES = (
+        (TILES_PENDING, 'Pending'),
+        (TILES_READY, 'Ready'),
+        (TILES_FAILED, 'Failed'),
+    )
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
     )
     title = models.CharField(max_length=255)
-    status = models.CharField(max_length=255)
+    status = models.PositiveSmallIntegerField(
+        choices=STATUS_CHOICES, default=NEW
+    )
+    # Bumped by every save and status transition, for optimistic
+    # concurrency control: a save only writes over the version it read
+    version = models.PositiveIntegerField(default=1, editable=False)
     date = models.DateField(default=date.today)
     labels = models.ManyToManyField('Label')
     patient_info = models.ManyToManyField('PatientInfo')
     image_file = models.ImageField(null=True, upload_to=image_file_path)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    mode = models.CharField(max_length=16, blank=True)
+    format = models.CharField(max_length=16, blank=True)
+    byte_size = models.BigIntegerField(null=True, blank=True)
+    checksum = models.CharField(max_length=64, blank=True)
+    # Read from the header of DICOM uploads, whose pixels are decoded from
+    # an 8 bit preview rendered by the image.render_preview job
+    modality = models.CharField(max_length=16, blank=True)
+    sop_instance_uid = models.CharField(max_length=64, blank=True)
+    preview_file = models.ImageField(null=True, blank=True)
+    # 64 bit perceptual hash, plus its four 16 bit parts for the
+    # multi-index near-duplicate search in image.phash
+    phash = models.BigIntegerField(null=True, blank=True)
+    phash_0 = models.PositiveIntegerField(null=True, blank=True)
+    phash_1 = models.PositiveIntegerField(null=True, blank=True)
+    phash_2 = models.PositiveIntegerField(null=True, blank=True)
+    phash_3 = models.PositiveIntegerField(null=True, blank=True)
+    # Lower cased title, label names and patient names; trigram indexed
+    # on PostgreSQL and kept current by core.signals
+    search_text = models.TextField(blank=True, default='', editable=False)
+    tiles_status = models.CharField(
+        max_length=16, blank=True, choices=TILES_STATUS_CHOICES
+    )
+    # Exposure statistics computed by image.stats, intensities 0-1
+    intensity_mean = models.FloatField(null=True, blank=True)
+    intensity_std = models.FloatField(null=True, blank=True)
+    contrast = models.FloatField(null=True, blank=True)
+    overexposed = models.FloatField(null=True, blank=True)
+    blankness = models.FloatField(null=True, blank=True)
+    histogram = models.BinaryField(null=True, blank=True)
+    # Unit float32 vector from image.embeddings, for label suggestions
+    embedding = models.BinaryField(null=True, blank=True)
+    # Work queue lease: the batch that holds the image and until when; an
+    # expired lease counts as no lease
+    lease_token = models.UUIDField(null=True, blank=True, editable=False)
+    lease_expires = models.DateTimeField(
+        null=True, blank=True, editable=False
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'status']),
+            models.Index(fields=['user', 'status', 'lease_expires']),
+            models.Index(fields=['user', 'lease_token']),
+            models.Index(fields=['user', 'width']),
+            models.Index(fields=['user', 'height']),
+            models.Index(fields=['user', 'format']),
+            models.Index(fields=['user', 'mode']),
+            models.Index(fields=['user', 'byte_size']),
+            models.Index(fields=['user', 'checksum']),
+            models.Index(fields=['user', 'modality']),
+            models.Index(fields=['user', 'sop_instance_uid']),
+            models.Index(fields=['user', 'phash_0']),
+            models.Index(fields=['user', 'phash_1']),
+            models.Index(fields=['user', 'phash_2']),
+            models.Index(fields=['user', 'phash_3']),
+            models.Index(fields=['user', 'intensity_mean']),
+            models.Index(fields=['user', 'contrast']),
+            models.Index(fields=['user', 'overexposed']),
+            models.Index(fields=['user', 'blankness']),
+            # list_filters of the admin, which spans all users
+            models.Index(fields=['status']),
+            models.Index(fields=['date']),
+            models.Index(fields=['format']),
+            models.Index(fields=['tiles_status']),
+        ]
 
     def __str__(self):
         return self.title
+
+    def save(self, *args, **kwargs):
+        """Save the image, raising VersionConflict if the row is no longer
+        at the version this instance holds
+        """
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        self._read_version = self.version
+        self.version += 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        try:
+            # In a savepoint, so a conflict leaves the caller's transaction
+            # usable
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+        except VersionConflict:
+            self.version = self._read_version
+            raise
+        finally:
+            del self._read_version
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        read_version = getattr(self, '_read_version', None)
+        if read_version is None:
+            return super()._do_update(
+                base_qs, using, pk_val, values, update_fields, forced_update
+            )
+        if super()._do_update(
+            base_qs.filter(version=read_version), using, pk_val, values,
+            update_fields, forced_update,
+        ):
+            return True
+        if base_qs.filter(pk=pk_val).exists():
+            raise VersionConflict(
+                f'Image {pk_val} changed since version {read_version}.'
+            )
+        return False
+
+    @property
+    def pixel_file(self):
+        """The file to decode pixels from, or None if there is none yet"""
+        if self.preview_file:
+            return self.preview_file
+        if not self.image_file or self.format == DICOM_FORMAT:
+            return None
+        return self.image_file
+
+    def build_search_text(self):
+        """Return the text the image is found by in a search"""
+        words = [self.title]
+        words.extend(label.name for label in self.labels.all())
+        words.extend(info.name for info in self.patient_info.all())
+        return ' '.join(words).lower()
+
+
+class Annotation(models.Model):
+    """Label attached to a box or polygon region of an image.
+
+    The points are packed as little-endian float32 x, y pairs (see
+    image.annotations); the bounding box and area are stored alongside so
+    regions can be filtered and sorted by size in SQL without decoding
+    them.
+    """
+    BOX = 0
+    POLYGON = 1
+    KIND_CHOICES = (
+        (BOX, 'Box'),
+        (POLYGON, 'Polygon'),
+    )
+    KIND_NAMES = {BOX: 'box', POLYGON: 'polygon'}
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    image = models.ForeignKey(
+        'Image', on_delete=models.CASCADE, related_name='annotations'
+    )
+    label = models.ForeignKey('Label', on_delete=models.CASCADE)
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    points = models.BinaryField()
+    x_min = models.FloatField()
+    y_min = models.FloatField()
+    x_max = models.FloatField()
+    y_max = models.FloatField()
+    area = models.FloatField()
+
+    class Meta:
+        indexes = [
+            # "images with a <label> <kind> larger than <area>"
+            models.Index(fields=['label', 'kind', 'area']),
+            models.Index(fields=['image', 'label']),
+        ]
+
+    def __str__(self):
+        return f'{self.KIND_NAMES[self.kind]} on image {self.image_id}'
+
+
+class Job(models.Model):
+    """Unit of background work executed by the job workers"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+    )
+    kind = models.CharField(max_length=64)
+    # JSON encoded keyword arguments of the handler and its return value
+    payload = models.TextField(default='{}')
+    result = models.TextField(blank=True)
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=QUEUED
+    )
+    progress = models.FloatField(default=0)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+            models.Index(fields=['user', 'created']),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} #{self.id}'
+
+
+class ChangeLog(models.Model):
+    """Insert, update or delete of a user's image, label or patient info.
+
+    seq increases with every change of the user and is what sync clients
+    resume from; see record_changes() for why it is per user.
+    """
+    INSERT = 'insert'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = (
+        (INSERT, 'Insert'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    )
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+    )
+    seq = models.BigIntegerField()
+    model = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'seq'], name='unique_change_seq'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.action} {self.model} #{self.object_id}'
+
+
+def record_changes(user_id, model, object_ids, action):
+    """Append changes of the given objects to their owner's change log.
+
+    Sequence numbers come from a counter on the user row rather than the
+    table's id: the UPDATE locks that row until the transaction commits,
+    so a user's changes commit in seq order and a client that has synced
+    up to some seq can never later see a smaller one appear. Returns the
+    seq of each change, in the order of object_ids.
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return []
+    with transaction.atomic():
+        User.objects.filter(id=user_id).update(
+            change_seq=models.F('change_seq') + len(object_ids)
+        )
+        last = User.objects.filter(id=user_id).values_list(
+            'change_seq', flat=True
+        ).first()
+        if last is None:
+            # The user itself is being deleted
+            return []
+        first = last - len(object_ids) + 1
+        ChangeLog.objects.bulk_create(
+            ChangeLog(
+                user_id=user_id,
+                seq=seq,
+                model=model,
+                object_id=object_id,
+                action=action,
+            )
+            for seq, object_id in zip(range(first, last + 1), object_ids)
+        )
+    return list(range(first, last + 1))
+
+
+def update_image(image, **values):
+    """Write columns of an image with one UPDATE and log the change.
+
+    For the background jobs that fill in what is computed from the file,
+    so that clients syncing the user's images see the new values. Returns
+    whether the image still existed.
+    """
+    with transaction.atomic():
+        updated = Image.objects.filter(id=image.id).update(**values)
+        if updated:
+            record_changes(
+                image.user_id, 'image', [image.id], ChangeLog.UPDATE
+            )
+    return bool(updated)
+
+
+def subtree_images(labels):
+    """Return a subquery of the ids of images carrying a label in the
+    subtree of any of labels.
+
+    Each subtree is one prefix match on the indexed Label.path.
+    """
+    subtrees = models.Q(pk__in=[])
+    for path in labels.values_list('path', flat=True):
+        subtrees |= models.Q(label__path__startswith=path)
+    return Image.labels.through.objects.filter(subtrees).values('image_id')
+
+
+def fill_label_paths(user_id):
+    """Set the paths of a user's labels inserted without one.
+
+    bulk_create() bypasses Label.save(), so labels created that way are
+    given root paths here, in one UPDATE.
+    """
+    Label.objects.filter(user_id=user_id, path='').update(
+        path=Concat(
+            Value('/'), Cast('id', models.CharField()), Value('/'),
+            output_field=models.CharField(),
+        )
+    )
+
+
+def refresh_search_text(image_ids, batch_size=1000):
+    """Recompute the search text of the given images in bulk"""
+    image_ids = list(image_ids)
+    for start in range(0, len(image_ids), batch_size):
+        images = (
+            Image.objects.filter(id__in=image_ids[start:start + batch_size])
+            .only('id', 'title', 'search_text')
+            .prefetch_related('labels', 'patient_info')
+        )
+        changed = []
+        for image in images:
+            text = image.build_search_text()
+            if text != image.search_text:
+                image.search_text = text
+                changed.append(image)
+        Image.objects.bulk_update(changed, ['search_text'])
+
+
+def _count_of(queryset, field):
+    """Return a subquery counting the rows of queryset per value of field"""
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(count=Count('*'))
+        .values('count')
+    ), 0)
+
+
+def reconcile_counts(user_ids=None, batch_size=1000):
+    """Rewrite the denormalized counters that drifted from the real counts.
+
+    The counters are maintained incrementally by core.signals; writes that
+    bypass signals (bulk_create of the through table, raw SQL) leave them
+    stale until this runs. Each drifted row is updated with the count
+    recomputed inside the UPDATE itself, so concurrent increments are not
+    overwritten by a value read earlier. Returns the number of labels and
+    users fixed.
+    """
+    counters = (
+        (Label, 'image_count', Image.labels.through, 'label_id', 'user_id'),
+        (User, 'image_count', Image, 'user_id', 'id'),
+    )
+    fixed = []
+    for model, counter, rows, field, user_field in counters:
+        queryset = model.objects.all()
+        if user_ids is not None:
+            queryset = queryset.filter(**{f'{user_field}__in': user_ids})
+        actual = _count_of(rows.objects.all(), field)
+        drifted = list(
+            queryset.annotate(actual=actual)
+            .exclude(**{counter: models.F('actual')})
+            .values_list('id', flat=True)
+        )
+        for start in range(0, len(drifted), batch_size):
+            model.objects.filter(
+                id__in=drifted[start:start + batch_size]
+            ).update(**{counter: _count_of(rows.objects.all(), field)})
+        fixed.append(len(drifted))
+
+    return tuple(fixed)
@@ -0,0 +1,42 @@
+import json
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that never counts large result sets exactly.
+
+    Up to ADMIN_EXACT_COUNT_LIMIT rows are counted with a LIMIT'ed
+    subquery, which stops scanning as soon as the limit is reached. Past
+    that, PostgreSQL's planner estimate of the row count is used instead:
+    page links near the end may be off, but the changelist no longer does
+    a COUNT(*) over millions of rows on every page view. Other databases
+    fall back to the exact count.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return super().count
+
+        limit = settings.ADMIN_EXACT_COUNT_LIMIT
+        capped = queryset.order_by().values('pk')[:limit + 1].count()
+        if capped <= limit:
+            return capped
+        return max(self.estimate(), limit + 1)
+
+    def estimate(self):
+        """Return the planner's estimate of the number of rows"""
+        queryset = self.object_list.order_by()
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
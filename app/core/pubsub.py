@@ -0,0 +1,247 @@
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Messages published to one channel since subscribing.
+
+    Iterating or calling get() blocks for the next message. A subscriber
+    that falls more than max_pending messages behind is marked overflowed
+    instead of slowing down publishers; it should resynchronize from the
+    database and subscribe again.
+    """
+
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.overflowed = False
+        self._queue = queue.Queue(max_pending)
+
+    def deliver(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """Return the next message, or None once timeout seconds pass"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class InMemoryBroker:
+    """Publish/subscribe within the current process.
+
+    Enough for a single web process serving both the writes and the event
+    streams; a broker shared between processes or nodes (Redis, PostgreSQL
+    LISTEN/NOTIFY) only needs to provide the same three methods.
+    """
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.max_pending)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channel, message):
+        """Deliver message to every current subscriber of channel"""
+        with self._lock:
+            subscribers = list(self._subscriptions.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(message)
+        return len(subscribers)
+
+
+class PostgresBroker(InMemoryBroker):
+    """Publish/subscribe across processes with PostgreSQL LISTEN/NOTIFY.
+
+    Messages are sent with pg_notify on the default database connection,
+    so publishing inside a transaction only delivers them on commit. Each
+    process listens on one connection of its own, for the channels it has
+    subscribers to, and hands what arrives to those subscribers. Messages
+    sent while that connection is lost cannot be recovered: subscribers
+    are marked overflowed so they resynchronize.
+    """
+
+    # Notifications read while LISTEN runs in another thread wait for the
+    # next poll, at most poll_seconds later
+    poll_seconds = 1
+    reconnect_seconds = 1
+
+    def __init__(self, max_pending=1000):
+        super().__init__(max_pending)
+        self._channels = set()
+        self._listen_lock = threading.Lock()
+        self._connection = None
+        self._thread = None
+        self._stopped = False
+
+    def subscribe(self, channel):
+        with self._listen_lock:
+            subscription = super().subscribe(channel)
+            if channel not in self._channels:
+                self._channels.add(channel)
+                self._execute('LISTEN', channel)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        channel = subscription.channel
+        with self._listen_lock:
+            super().unsubscribe(subscription)
+            if channel in self._channels and (
+                channel not in self._subscriptions
+            ):
+                self._channels.discard(channel)
+                self._execute('UNLISTEN', channel)
+
+    def publish(self, channel, message):
+        """Send message to the subscribers of channel in every process"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, %s)', [channel, json.dumps(message)]
+            )
+
+    def stop(self):
+        """Close the listening connection and end its thread"""
+        with self._listen_lock:
+            self._stopped = True
+            self._close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _connect(self):
+        import psycopg2
+
+        conn = psycopg2.connect(**connection.get_connection_params())
+        conn.autocommit = True
+        return conn
+
+    def _execute(self, command, channel):
+        """Run LISTEN or UNLISTEN on the listening connection, starting
+        it on first use; failures are left to the listening thread
+        """
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            with self._connection.cursor() as cursor:
+                cursor.execute(f'{command} "{channel}"')
+        except Exception:
+            logger.exception('Could not %s to %s', command, channel)
+            self._close()
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._listen, daemon=True)
+            self._thread.start()
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def _listen(self):
+        """Dispatch notifications until the process exits, reconnecting
+        whenever the connection is lost
+        """
+        while True:
+            with self._listen_lock:
+                if self._stopped:
+                    return
+                conn = self._connection
+                if conn is None:
+                    conn = self._reconnect()
+            if conn is None:
+                time.sleep(self.reconnect_seconds)
+                continue
+            try:
+                select.select([conn], [], [], self.poll_seconds)
+                with self._listen_lock:
+                    conn.poll()
+                    notifies = list(conn.notifies)
+                    del conn.notifies[:]
+            except Exception:
+                with self._listen_lock:
+                    if self._stopped:
+                        return
+                    logger.exception('Lost the LISTEN connection')
+                    if self._connection is conn:
+                        self._close()
+                continue
+            for notify in notifies:
+                self._dispatch(notify)
+
+    def _reconnect(self):
+        """Open a new listening connection for the current channels and
+        mark their subscribers overflowed, as messages may have been lost
+        """
+        try:
+            conn = self._connect()
+            with conn.cursor() as cursor:
+                for channel in self._channels:
+                    cursor.execute(f'LISTEN "{channel}"')
+        except Exception:
+            logger.exception('Could not reconnect the LISTEN connection')
+            return None
+        self._connection = conn
+        with self._lock:
+            for subscribers in self._subscriptions.values():
+                for subscription in subscribers:
+                    subscription.overflowed = True
+        return conn
+
+    def _dispatch(self, notify):
+        super().publish(notify.channel, json.loads(notify.payload))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Return the process wide broker configured by PUBSUB_BROKER"""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(settings.PUBSUB_BROKER)(
+                max_pending=settings.PUBSUB_MAX_PENDING
+            )
+    return _broker
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
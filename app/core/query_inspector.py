@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import time
+import traceback
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+logger = logging.getLogger('core.queries')
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM_RE = re.compile(r'%s|\?')
+_IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_SPACE_RE = re.compile(r'\s+')
+
+_IGNORED_FRAMES = (
+    os.sep + 'django' + os.sep,
+    os.sep + 'rest_framework' + os.sep,
+    os.path.join('core', 'query_inspector.py'),
+)
+
+
+class RepeatedQueriesError(Exception):
+    """Raised when the same query shape runs more often than allowed"""
+
+
+def normalize_sql(sql):
+    """Reduce a SQL statement to its shape.
+
+    Literals and placeholders become '?' and IN lists collapse to a single
+    item, so queries differing only in their parameters compare equal.
+    """
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _PARAM_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('IN (?)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+
+def caller_stack(limit=8):
+    """Return the innermost application frames of the current stack"""
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if not any(part in frame.filename for part in _IGNORED_FRAMES)
+    ]
+    return ''.join(traceback.format_list(frames[-limit:]))
+
+
+class QueryInspector:
+    """Collect the shape, count and duration of queries in a block"""
+
+    def __init__(self, slow_ms=None):
+        self.slow_ms = slow_ms
+        self.shapes = Counter()
+        self.slow_queries = []
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.count += 1
+            self.shapes[normalize_sql(sql)] += 1
+            if self.slow_ms is not None and elapsed_ms >= self.slow_ms:
+                self.slow_queries.append(
+                    (sql, elapsed_ms, caller_stack())
+                )
+
+    @contextmanager
+    def capture(self):
+        """Inspect every query run on any connection inside the block"""
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+    def repeated(self, threshold):
+        """Return (shape, count) pairs that ran more than threshold times"""
+        return [
+            (shape, count) for shape, count in self.shapes.most_common()
+            if count > threshold
+        ]
+
+
+class QueryInspectorMiddleware:
+    """Flag N+1 patterns and slow queries in development and staging.
+
+    Logs a warning, or raises RepeatedQueriesError when
+    QUERY_INSPECTOR_RAISE is set, whenever a single request runs the same
+    normalized statement more than QUERY_INSPECTOR_REPEAT_THRESHOLD
+    times. Queries slower than QUERY_INSPECTOR_SLOW_MS are logged with the
+    application stack that issued them.
+    """
+
+    def __init__(self, get_response):
+        if not settings.QUERY_INSPECTOR_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        inspector = QueryInspector(slow_ms=settings.QUERY_INSPECTOR_SLOW_MS)
+        with inspector.capture():
+            response = self.get_response(request)
+
+        for sql, elapsed_ms, stack in inspector.slow_queries:
+            logger.warning(
+                'Slow query (%.1f ms) on %s: %s\n%s',
+                elapsed_ms, request.path, sql, stack
+            )
+
+        repeated = inspector.repeated(
+            settings.QUERY_INSPECTOR_REPEAT_THRESHOLD
+        )
+        if repeated:
+            message = '\n'.join(
+                f'{count}x {shape}' for shape, count in repeated
+            )
+            if settings.QUERY_INSPECTOR_RAISE:
+                raise RepeatedQueriesError(
+                    f'Repeated queries on {request.path}:\n{message}'
+                )
+            logger.warning(
+                'Repeated queries on %s:\n%s', request.path, message
+            )
+
+        return response
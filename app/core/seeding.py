@@ -0,0 +1,141 @@
+import random
+from datetime import date, timedelta
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+
+from core.models import (
+    ChangeLog,
+    Image,
+    Label,
+    PatientInfo,
+    fill_label_paths,
+    reconcile_counts,
+    record_changes,
+    refresh_search_text,
+)
+
+
+SEED_EMAIL = 'bench-user-{}@example.com'
+SEED_PASSWORD = 'benchpass'
+BATCH_SIZE = 1000
+
+
+def seed(users=1, images_per_user=100, labels_per_user=20,
+         patients_per_user=20, labels_per_image=3, patients_per_image=1,
+         random_seed=0, password=SEED_PASSWORD):
+    """Bulk insert a reproducible synthetic data set.
+
+    Every user gets their own labels, patient info and images, and each
+    image is linked to a random sample of that user's labels and patient
+    info. The same arguments always produce the same rows.
+    """
+    rng = random.Random(random_seed)
+    user_model = get_user_model()
+    first = user_model.objects.filter(
+        email__startswith='bench-user-'
+    ).count()
+    password_hash = make_password(password)
+
+    _bulk_create(user_model, (
+        user_model(
+            email=SEED_EMAIL.format(first + i),
+            name=f'Benchmark user {first + i}',
+            password=password_hash,
+        )
+        for i in range(users)
+    ))
+    seeded = list(
+        user_model.objects.filter(
+            email__in=[SEED_EMAIL.format(first + i) for i in range(users)]
+        ).order_by('id')
+    )
+
+    for user in seeded:
+        _seed_user(
+            rng, user, images_per_user, labels_per_user, patients_per_user,
+            labels_per_image, patients_per_image
+        )
+
+    return seeded
+
+
+def _seed_user(rng, user, images, labels, patients, labels_per_image,
+               patients_per_image):
+    """Bulk insert the labels, patient info and images of one user"""
+    _bulk_create(Label, (
+        Label(user=user, name=f'Label {i}') for i in range(labels)
+    ))
+    fill_label_paths(user.id)
+    _bulk_create(PatientInfo, (
+        PatientInfo(user=user, name=f'Patient {i}') for i in range(patients)
+    ))
+    start = date(2020, 1, 1)
+    _bulk_create(Image, (
+        Image(
+            user=user,
+            title=f'Scan {i}',
+            status=rng.choice(list(Image.STATUS_NAMES)),
+            date=start + timedelta(days=rng.randrange(365)),
+        )
+        for i in range(images)
+    ))
+
+    label_ids = list(
+        Label.objects.filter(user=user).values_list('id', flat=True)
+    )
+    patient_ids = list(
+        PatientInfo.objects.filter(user=user).values_list('id', flat=True)
+    )
+    image_ids = Image.objects.filter(user=user).order_by('id').values_list(
+        'id', flat=True
+    )
+
+    links = [
+        (
+            image_id,
+            _sample(rng, label_ids, labels_per_image),
+            _sample(rng, patient_ids, patients_per_image),
+        )
+        for image_id in image_ids
+    ]
+    _bulk_create(Image.labels.through, (
+        Image.labels.through(image_id=image_id, label_id=label_id)
+        for image_id, image_labels, _ in links
+        for label_id in image_labels
+    ))
+    _bulk_create(Image.patient_info.through, (
+        Image.patient_info.through(
+            image_id=image_id, patientinfo_id=patient_id
+        )
+        for image_id, _, image_patients in links
+        for patient_id in image_patients
+    ))
+    refresh_search_text(image_ids)
+    # The bulk inserts above bypass the signals maintaining the counters
+    # and the change log
+    reconcile_counts([user.id])
+    for model, ids in (
+        ('label', label_ids), ('patientinfo', patient_ids),
+        ('image', image_ids),
+    ):
+        record_changes(user.id, model, ids, ChangeLog.INSERT)
+
+
+def _sample(rng, population, count):
+    return rng.sample(population, min(count, len(population)))
+
+
+def _bulk_create(model, objs):
+    """Insert objects from an iterable BATCH_SIZE at a time.
+
+    Each chunk is left to bulk_create to split further where the backend
+    limits the number of query parameters.
+    """
+    objs = iter(objs)
+    while True:
+        batch = list(islice(objs, BATCH_SIZE))
+        if not batch:
+            return
+        model.objects.bulk_create(batch)
@@ -0,0 +1,264 @@
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_init,
+    post_save,
+    pre_delete,
+)
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+
+from core import cleanup, pubsub
+from core.models import (
+    ChangeLog,
+    Image,
+    Label,
+    PatientInfo,
+    User,
+    is_being_deleted,
+    record_changes,
+    refresh_search_text,
+)
+
+
+@receiver(post_save, sender=Image)
+def image_saved(sender, instance, raw=False, **kwargs):
+    """Keep the search text in step with the image title"""
+    if not raw:
+        refresh_search_text([instance.id])
+
+
+@receiver(m2m_changed, sender=Image.labels.through)
+@receiver(m2m_changed, sender=Image.patient_info.through)
+def image_relations_changed(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    """Keep the search text in step with the labels and patient info"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        refresh_search_text([instance.id])
+    elif action == 'post_clear':
+        refresh_search_text(instance._cleared_image_ids)
+    else:
+        refresh_search_text(pk_set)
+
+
+@receiver(m2m_changed, sender=Image.labels.through)
+@receiver(m2m_changed, sender=Image.patient_info.through)
+def image_relations_clearing(sender, instance, action, reverse, **kwargs):
+    """Remember which images a reverse clear() is about to detach"""
+    if action == 'pre_clear' and reverse:
+        instance._cleared_image_ids = list(
+            instance.image_set.values_list('id', flat=True)
+        )
+
+
+@receiver(post_save, sender=Label)
+@receiver(post_save, sender=PatientInfo)
+def image_attribute_saved(sender, instance, created, raw=False, **kwargs):
+    """Refresh the images carrying a renamed label or patient"""
+    if not created and not raw:
+        refresh_search_text(
+            instance.image_set.values_list('id', flat=True)
+        )
+
+
+@receiver(pre_delete, sender=Label)
+@receiver(pre_delete, sender=PatientInfo)
+def image_attribute_deleting(sender, instance, **kwargs):
+    """Remember the images of a label or patient before it goes away"""
+    instance._deleted_image_ids = list(
+        instance.image_set.values_list('id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Label)
+@receiver(post_delete, sender=PatientInfo)
+def image_attribute_deleted(sender, instance, **kwargs):
+    """Drop a deleted label or patient from the search text"""
+    refresh_search_text(getattr(instance, '_deleted_image_ids', []))
+
+
+def _add_to_count(queryset, delta):
+    """Atomically add delta to the image_count of every row of queryset"""
+    if delta:
+        queryset.update(image_count=Greatest(F('image_count') + delta, 0))
+
+
+@receiver(m2m_changed, sender=Image.labels.through)
+def image_labels_counted(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    """Keep Label.image_count in step with the labels of images.
+
+    Forward changes (image.labels) touch many labels by one, reverse ones
+    (label.image_set) one label by many; either way it is one UPDATE.
+    """
+    if action == 'pre_remove':
+        # remove() reports every pk it was given, linked or not
+        if reverse:
+            links = sender.objects.filter(
+                label_id=instance.id, image_id__in=pk_set
+            ).values_list('image_id', flat=True)
+        else:
+            links = sender.objects.filter(
+                image_id=instance.id, label_id__in=pk_set
+            ).values_list('label_id', flat=True)
+        instance._removed_ids = list(links)
+    elif action == 'pre_clear' and not reverse:
+        instance._cleared_label_ids = list(
+            sender.objects.filter(image_id=instance.id)
+            .values_list('label_id', flat=True)
+        )
+    elif action in ('post_add', 'post_remove') and pk_set:
+        sign = 1 if action == 'post_add' else -1
+        changed = pk_set if action == 'post_add' else instance._removed_ids
+        if reverse:
+            _add_to_count(
+                Label.objects.filter(id=instance.id), sign * len(changed)
+            )
+        else:
+            _add_to_count(Label.objects.filter(id__in=changed), sign)
+    elif action == 'post_clear':
+        if reverse:
+            Label.objects.filter(id=instance.id).update(image_count=0)
+        else:
+            _add_to_count(
+                Label.objects.filter(id__in=instance._cleared_label_ids), -1
+            )
+
+
+@receiver(post_save, sender=Image)
+def image_counted(sender, instance, created, raw=False, **kwargs):
+    """Count a new image in its owner's total"""
+    if created and not raw:
+        _add_to_count(User.objects.filter(id=instance.user_id), 1)
+
+
+@receiver(pre_delete, sender=Image)
+def image_uncounting(sender, instance, **kwargs):
+    """Remember the labels of an image before its links are deleted"""
+    instance._deleted_label_ids = list(
+        Image.labels.through.objects.filter(image_id=instance.id)
+        .values_list('label_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Image)
+def image_uncounted(sender, instance, **kwargs):
+    """Drop a deleted image from its labels' and owner's counts"""
+    _add_to_count(
+        Label.objects.filter(
+            id__in=getattr(instance, '_deleted_label_ids', [])
+        ),
+        -1,
+    )
+    _add_to_count(User.objects.filter(id=instance.user_id), -1)
+
+
+@receiver(post_delete, sender=Image)
+def image_files_deleted(sender, instance, **kwargs):
+    """Queue the removal of a deleted image's files and tiles"""
+    cleanup.delete_files_later(
+        [instance.image_file.name, instance.preview_file.name],
+        cleanup.image_prefixes(instance.id, instance.tiles_status),
+    )
+
+
+def _record(user_id, model, object_ids, action):
+    if is_being_deleted(user_id):
+        return []
+    return record_changes(user_id, model, object_ids, action)
+
+
+def publish_image_changes(user_id, image_ids, seqs, changed):
+    """Push image changes to the user's event streams once committed"""
+    events = [
+        {'seq': seq, 'model': 'image', 'id': image_id, 'changed': changed}
+        for image_id, seq in zip(image_ids, seqs)
+    ]
+    if not events:
+        return
+
+    def publish():
+        broker = pubsub.get_broker()
+        for event in events:
+            broker.publish(pubsub.user_channel(user_id), event)
+
+    transaction.on_commit(publish)
+
+
+@receiver(post_init, sender=Image)
+def image_loaded(sender, instance, **kwargs):
+    """Remember the loaded status to tell when a save changes it"""
+    # Read from __dict__ so deferred loading of status is never triggered
+    instance._loaded_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_save, sender=Label)
+@receiver(post_save, sender=PatientInfo)
+def change_saved(sender, instance, created, raw=False, **kwargs):
+    """Log inserts and updates for the sync endpoint"""
+    if raw:
+        return
+    action = ChangeLog.INSERT if created else ChangeLog.UPDATE
+    seqs = _record(instance.user_id, sender._meta.model_name, [instance.id],
+                   action)
+    if sender is Image and not created:
+        loaded = instance._loaded_status
+        if loaded is not None and loaded != instance.status:
+            publish_image_changes(
+                instance.user_id, [instance.id], seqs, ['status']
+            )
+        instance._loaded_status = instance.status
+
+
+@receiver(post_delete, sender=Image)
+@receiver(post_delete, sender=Label)
+@receiver(post_delete, sender=PatientInfo)
+def change_deleted(sender, instance, **kwargs):
+    """Log deletes, and the images that lost a deleted label or patient"""
+    _record(instance.user_id, sender._meta.model_name, [instance.id],
+            ChangeLog.DELETE)
+    if sender is not Image:
+        _record_image_updates(
+            getattr(instance, '_deleted_image_ids', []), sender is Label
+        )
+
+
+@receiver(m2m_changed, sender=Image.labels.through)
+@receiver(m2m_changed, sender=Image.patient_info.through)
+def change_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    """Log images whose labels or patient info changed as updated"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    # Only label changes are pushed to the event streams
+    publish = sender is Image.labels.through
+    if not reverse:
+        seqs = _record(
+            instance.user_id, 'image', [instance.id], ChangeLog.UPDATE
+        )
+        if publish:
+            publish_image_changes(
+                instance.user_id, [instance.id], seqs, ['labels']
+            )
+    elif action == 'post_clear':
+        _record_image_updates(instance._cleared_image_ids, publish)
+    else:
+        _record_image_updates(pk_set, publish)
+
+
+def _record_image_updates(image_ids, publish=False):
+    """Log updates of images that may belong to several users"""
+    by_user = {}
+    rows = Image.objects.filter(id__in=list(image_ids)).values_list(
+        'user_id', 'id'
+    )
+    for user_id, image_id in rows.order_by('id'):
+        by_user.setdefault(user_id, []).append(image_id)
+    for user_id, ids in by_user.items():
+        seqs = _record(user_id, 'image', ids, ChangeLog.UPDATE)
+        if publish:
+            publish_image_changes(user_id, ids, seqs, ['labels'])
@@ -0,0 +1,271 @@
+import io
+import mimetypes
+import os
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import (
+    FileSystemStorage as BaseFileSystemStorage,
+    Storage,
+)
+from django.utils import timezone
+
+
+class FileSystemStorage(BaseFileSystemStorage):
+    """Media files on the local disk, under MEDIA_ROOT"""
+
+    def scan(self, prefix):
+        """Yield (name, modified timestamp) of every file under a directory.
+
+        Directories are read with os.scandir as the entries are consumed,
+        so memory does not grow with the number of files, and each
+        directory's subtree comes out in one run.
+        """
+        pending = [self.path(prefix)]
+        while pending:
+            try:
+                entries = os.scandir(pending.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        name = os.path.relpath(entry.path, self.location)
+                        yield (
+                            name.replace(os.sep, '/'),
+                            entry.stat().st_mtime,
+                        )
+
+    def prune(self, prefix):
+        """Remove the directories left empty under a directory"""
+        top = self.path(prefix)
+        for path, _, _ in os.walk(top, topdown=False):
+            if path != top:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    # Not empty
+                    pass
+
+
+def _missing(exc):
+    return exc.response.get('Error', {}).get('Code') in (
+        '404', 'NoSuchKey', 'NotFound'
+    )
+
+
+class ObjectReader(io.RawIOBase):
+    """Seekable reads of an S3 object over a streaming GET.
+
+    The first read opens a GET of the object from the current position
+    to its end and later reads carry on from the same response, so a
+    file read front to back costs one request however large it is. A
+    seek elsewhere only drops the response; the next read opens a new
+    one from there, which is what makes reading an image header cheap.
+    """
+
+    def __init__(self, client, bucket, key, size):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.position = 0
+        self._body = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position')
+        if offset != self.position:
+            self._drop()
+            self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        if self._body is None:
+            self._body = self.client.get_object(
+                Bucket=self.bucket, Key=self.key,
+                Range=f'bytes={self.position}-',
+            )['Body']
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        self._drop()
+        super().close()
+
+    def _drop(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+
+class S3File(File):
+    """Read only file of an S3 object"""
+
+    def __init__(self, reader, name):
+        super().__init__(
+            io.BufferedReader(reader, settings.S3_READ_BUFFER_SIZE), name
+        )
+        self.size = reader.size
+        self.mode = 'rb'
+
+    def open(self, mode=None):
+        if self.closed:
+            raise ValueError('A closed S3 file cannot be reopened')
+        self.seek(0)
+        return self
+
+
+class S3Storage(Storage):
+    """Media files in an S3 compatible bucket.
+
+    Saves go through boto3's managed transfer: files over
+    S3_MULTIPART_THRESHOLD are split into parts uploaded in parallel by
+    S3_MAX_CONCURRENCY threads. Reads stream (see ObjectReader), and
+    url() returns presigned URLs, so downloads go to the bucket directly
+    instead of through the API. Works against MinIO and other stand-ins
+    with S3_ENDPOINT_URL.
+    """
+
+    def __init__(self, bucket=None, endpoint_url=None, region=None):
+        self.bucket = bucket or settings.S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.S3_ENDPOINT_URL
+        self.region = region or settings.S3_REGION
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use; clients are thread safe and slow to make
+        if self._client is None:
+            self._client = boto3.session.Session().client(
+                's3', endpoint_url=self.endpoint_url,
+                region_name=self.region,
+            )
+        return self._client
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError as exc:
+            if _missing(exc):
+                raise FileNotFoundError(name)
+            raise
+
+    def _open(self, name, mode='rb'):
+        if set(mode) - set('rb'):
+            raise ValueError('S3 files are opened for reading only')
+        size = self._head(name)['ContentLength']
+        return S3File(ObjectReader(self.client, self.bucket, name, size),
+                      name)
+
+    def _save(self, name, content):
+        content_type = (
+            getattr(content, 'content_type', None)
+            or mimetypes.guess_type(name)[0]
+            or 'application/octet-stream'
+        )
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        self.client.upload_fileobj(
+            content, self.bucket, name,
+            ExtraArgs={'ContentType': content_type},
+            Config=TransferConfig(
+                multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+                multipart_chunksize=settings.S3_MULTIPART_CHUNK_SIZE,
+                max_concurrency=settings.S3_MAX_CONCURRENCY,
+            ),
+        )
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # Upload names are unique already and a PUT replaces an object
+        # atomically, so the HEAD request looking for a free name is
+        # skipped
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def exists(self, name):
+        try:
+            self._head(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, name):
+        return self._head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        modified = self._head(name)['LastModified']
+        return modified if settings.USE_TZ else timezone.make_naive(
+            modified
+        )
+
+    def _pages(self, prefix, **params):
+        paginator = self.client.get_paginator('list_objects_v2')
+        return paginator.paginate(Bucket=self.bucket, Prefix=prefix,
+                                  **params)
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/' if path else ''
+        directories, files = [], []
+        for page in self._pages(prefix, Delimiter='/'):
+            for common in page.get('CommonPrefixes', ()):
+                directories.append(common['Prefix'][len(prefix):-1])
+            for obj in page.get('Contents', ()):
+                files.append(obj['Key'][len(prefix):])
+        return directories, files
+
+    def scan(self, prefix):
+        """Yield (name, modified timestamp) of every object under a
+        prefix, one listing page at a time
+        """
+        for page in self._pages(prefix):
+            for obj in page.get('Contents', ()):
+                yield obj['Key'], obj['LastModified'].timestamp()
+
+    def prune(self, prefix):
+        """Object stores have no directories to remove"""
+
+    def url(self, name):
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': name},
+            ExpiresIn=settings.S3_URL_EXPIRES_SECONDS,
+        )
+
+    def presigned_upload(self, name, max_bytes, expires):
+        """Return the URL and form fields of a browser POST that uploads
+        at most max_bytes to name, straight into the bucket
+        """
+        return self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=name,
+            Conditions=[['content-length-range', 1, max_bytes]],
+            ExpiresIn=expires,
+        )
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+
+from core import cleanup, jobs
+
+
+@jobs.register('core.delete_files')
+def delete_files(names=(), prefixes=()):
+    """Delete orphaned files from storage"""
+    return {'deleted': cleanup.delete_files(names, prefixes)}
+
+
+@jobs.register('core.purge_user')
+def purge_user(user_id):
+    """Delete a user batch by batch, over as many jobs as it takes.
+
+    Each job stops after CLEANUP_BATCHES_PER_JOB batches and queues the
+    next one, which leaves the workers to other jobs in between.
+    """
+    done = cleanup.purge_user(user_id)
+    if not done:
+        jobs.enqueue(
+            'core.purge_user',
+            delay=timedelta(seconds=settings.CLEANUP_BATCH_PAUSE_SECONDS),
+            user_id=user_id,
+        )
+    return {'done': done}
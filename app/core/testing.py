@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+
+from core.query_inspector import QueryInspector
+
+
+class QueryBudgetMixin:
+    """TestCase mixin for pinning the query cost of an endpoint"""
+
+    @contextmanager
+    def assertQueryBudget(self, max_queries, max_repeats=None):
+        """Fail if the block runs more than max_queries queries, or runs
+        any single query shape more than max_repeats times.
+        """
+        inspector = QueryInspector()
+        with inspector.capture():
+            yield inspector
+
+        executed = '\n'.join(
+            f'{count}x {shape}' for shape, count in inspector.shapes.items()
+        )
+        self.assertLessEqual(
+            inspector.count,
+            max_queries,
+            f'{inspector.count} queries executed, budget is {max_queries}:'
+            f'\n{executed}'
+        )
+        if max_repeats is not None:
+            repeated = inspector.repeated(max_repeats)
+            self.assertFalse(
+                repeated,
+                f'Query shapes repeated more than {max_repeats} times:\n'
+                + '\n'.join(f'{count}x {shape}' for shape, count in repeated)
+            )
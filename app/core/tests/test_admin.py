@@ -1,7 +1,14 @@
-from django.test import TestCase, Client
+from unittest.mock import patch
+
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.urls import reverse
 
+from core.models import Image, Label
+from core.paginator import EstimatedCountPaginator
+
 
 class AdminSiteTests(TestCase):
     def setUp(self):
@@ -37,3 +44,90 @@ class AdminSiteTests(TestCase):
         res = self.client.get(url)
 
         self.assertEqual(res.status_code, 200)
+
+
+class LargeTableAdminTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@test.com", password="password123"
+        )
+        self.client.force_login(self.admin_user)
+        self.label = Label.objects.create(user=self.admin_user, name="Chest")
+        self.image = Image.objects.create(
+            user=self.admin_user, title="Scan", status=Image.NEW
+        )
+        self.image.labels.add(self.label)
+
+    def test_changelists(self):
+        """Test the changelists load with a query count independent of rows"""
+        for model in ('image', 'label', 'patientinfo', 'job'):
+            url = reverse(f"admin:core_{model}_changelist")
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+
+        url = reverse("admin:core_image_changelist")
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        Image.objects.bulk_create(
+            Image(user=self.admin_user, title=f"Scan {i}", status=Image.NEW)
+            for i in range(20)
+        )
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(url)
+        self.assertEqual(len(few), len(many))
+
+    def test_image_change_page(self):
+        """Test the image edit page does not list every label"""
+        Label.objects.create(user=self.admin_user, name="Unrelated")
+        url = reverse("admin:core_image_change", args=[self.image.id])
+        res = self.client.get(url)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, "Chest")
+        self.assertNotContains(res, "Unrelated")
+
+    def test_image_search(self):
+        """Test searching images uses the search text"""
+        Image.objects.create(user=self.admin_user, title="Knee")
+        url = reverse("admin:core_image_changelist")
+        res = self.client.get(url, {'q': 'CHEST'})
+
+        self.assertContains(res, "Scan")
+        self.assertNotContains(res, "Knee")
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(
+            email="test@test.com", password="test123"
+        )
+        Label.objects.bulk_create(
+            Label(user=user, name=f"label {i}") for i in range(5)
+        )
+        self.queryset = Label.objects.order_by('id')
+
+    def test_exact_count_by_default(self):
+        """Test databases without planner estimates count exactly"""
+        paginator = EstimatedCountPaginator(self.queryset, 2)
+        self.assertEqual(paginator.count, 5)
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=3)
+    def test_estimate_past_limit(self):
+        """Test large results use the estimate instead of a full count"""
+        with patch.object(connection, 'vendor', 'postgresql'), \
+                patch.object(EstimatedCountPaginator, 'estimate',
+                             return_value=1000) as estimate:
+            paginator = EstimatedCountPaginator(self.queryset, 2)
+            self.assertEqual(paginator.count, 1000)
+            self.assertEqual(paginator.num_pages, 500)
+        estimate.assert_called_once()
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=10)
+    def test_small_results_counted_exactly(self):
+        """Test results within the limit are counted exactly"""
+        with patch.object(connection, 'vendor', 'postgresql'), \
+                patch.object(EstimatedCountPaginator, 'estimate') as estimate:
+            paginator = EstimatedCountPaginator(self.queryset, 2)
+            self.assertEqual(paginator.count, 5)
+        estimate.assert_not_called()
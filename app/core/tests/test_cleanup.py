@@ -0,0 +1,268 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO, StringIO
+
+from PIL import Image as PILImage
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core import cleanup
+from core.models import (
+    Annotation,
+    ChangeLog,
+    Image,
+    Job,
+    Label,
+    PatientInfo,
+    tiles_prefix,
+    tiles_version,
+)
+
+
+def png_bytes(color=(10, 20, 30)):
+    buffer = BytesIO()
+    PILImage.new('RGB', (8, 8), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class MediaTestCase(TestCase):
+    """Run against an empty media directory of its own"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = get_user_model().objects.create_user(
+            'test@test.com', 'testpass'
+        )
+
+    def image_with_file(self, user=None, tiles=False):
+        image = Image.objects.create(user=user or self.user, title='Scan')
+        image.image_file.save('scan.png', ContentFile(png_bytes()))
+        if tiles:
+            image.checksum = 'a' * 64
+            image.tiles_status = Image.TILES_READY
+            image.save()
+            self.save_tile(image.id, tiles_version(image.checksum))
+        return image
+
+    def save_tile(self, image_id, version):
+        return default_storage.save(
+            f'{tiles_prefix(image_id, version)}0/0_0.jpeg',
+            ContentFile(b'tile'),
+        )
+
+
+class DeleteFilesTests(MediaTestCase):
+    """Test files are deleted in the background once orphaned"""
+
+    def test_delete_files(self):
+        """Test files and directories are deleted, missing ones skipped"""
+        name = default_storage.save('uploads/image/a.png', ContentFile(b'a'))
+        tile = self.save_tile(7, 'v1')
+
+        deleted = cleanup.delete_files(
+            [name, 'uploads/image/missing.png'], [tiles_prefix(7)]
+        )
+
+        self.assertEqual(deleted, 3)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(default_storage.exists(tile))
+
+    def test_image_delete_queues_file_deletion(self):
+        """Test deleting an image queues the removal of its files"""
+        image = self.image_with_file(tiles=True)
+        name, image_id = image.image_file.name, image.id
+
+        image.delete()
+
+        job = Job.objects.get(kind='core.delete_files')
+        self.assertIsNone(job.user)
+        self.assertEqual(json.loads(job.payload), {
+            'names': [name], 'prefixes': [tiles_prefix(image_id)]
+        })
+        self.assertTrue(default_storage.exists(name))
+
+    @override_settings(JOBS_EAGER=True)
+    def test_image_delete_removes_files(self):
+        """Test the file and tiles of a deleted image are removed"""
+        image = self.image_with_file(tiles=True)
+        name, image_id = image.image_file.name, image.id
+
+        image.delete()
+
+        self.assertFalse(default_storage.exists(name))
+        self.assertEqual(
+            list(cleanup.storage_files(tiles_prefix(image_id))), []
+        )
+
+    def test_image_without_file_queues_nothing(self):
+        """Test no job is queued for images that never had a file"""
+        Image.objects.create(user=self.user, title='Empty').delete()
+
+        self.assertFalse(Job.objects.filter(kind='core.delete_files'))
+
+    def test_reupload_queues_old_file_deletion(self):
+        """Test uploading a new file queues the removal of the old one"""
+        image = self.image_with_file(tiles=True)
+        old_name = image.image_file.name
+        client = APIClient()
+        client.force_authenticate(self.user)
+        upload = BytesIO(png_bytes((200, 0, 0)))
+        upload.name = 'new.png'
+
+        client.post(
+            reverse('image:image-upload-file', args=[image.id]),
+            {'image_file': upload}, format='multipart'
+        )
+
+        image.refresh_from_db()
+        job = Job.objects.get(kind='core.delete_files')
+        self.assertNotEqual(image.image_file.name, old_name)
+        self.assertEqual(json.loads(job.payload), {
+            'names': [old_name],
+            'prefixes': [tiles_prefix(image.id, 'a' * 16)],
+        })
+
+
+@override_settings(CLEANUP_BATCH_SIZE=2, CLEANUP_BATCH_PAUSE_SECONDS=0)
+class PurgeUserTests(MediaTestCase):
+    """Test users are deleted batch by batch in the background"""
+
+    def setUp(self):
+        super().setUp()
+        label = Label.objects.create(user=self.user, name='Chest')
+        patient = PatientInfo.objects.create(user=self.user, name='P1')
+        self.images = [self.image_with_file(tiles=i == 0) for i in range(5)]
+        for image in self.images:
+            image.labels.add(label)
+            image.patient_info.add(patient)
+            Annotation.objects.create(
+                user=self.user, image=image, label=label, kind=Annotation.BOX,
+                points=b'', x_min=0, y_min=0, x_max=1, y_max=1, area=1
+            )
+        self.other = get_user_model().objects.create_user(
+            'other@test.com', 'testpass'
+        )
+        self.kept = self.image_with_file(user=self.other)
+
+    def assertPurged(self):
+        self.assertFalse(
+            get_user_model().objects.filter(id=self.user.id).exists()
+        )
+        for model in (Image, Label, PatientInfo, Annotation, ChangeLog):
+            self.assertFalse(model.objects.filter(user=self.user).exists())
+        for image in self.images:
+            self.assertFalse(default_storage.exists(image.image_file.name))
+        self.assertEqual(
+            list(cleanup.storage_files(tiles_prefix(self.images[0].id))),
+            []
+        )
+        self.assertTrue(default_storage.exists(self.kept.image_file.name))
+        self.assertEqual(Image.objects.get().id, self.kept.id)
+
+    @override_settings(CLEANUP_BATCHES_PER_JOB=2)
+    def test_purge_in_steps(self):
+        """Test each call stops after its share of batches"""
+        self.assertFalse(cleanup.purge_user(self.user.id))
+        self.assertEqual(Image.objects.filter(user=self.user).count(), 1)
+
+        while not cleanup.purge_user(self.user.id):
+            pass
+
+        self.assertPurged()
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.image_count, 1)
+
+    @override_settings(CLEANUP_BATCHES_PER_JOB=2, JOBS_EAGER=True)
+    def test_purge_user_later(self):
+        """Test the user is deactivated and the purge jobs chained"""
+        cleanup.purge_user_later(self.user)
+
+        self.assertPurged()
+        self.assertGreater(
+            Job.objects.filter(kind='core.purge_user').count(), 1
+        )
+
+    def test_admin_delete(self):
+        """Test deleting a user in the admin leaves it to a job"""
+        admin = get_user_model().objects.create_superuser(
+            'admin@test.com', 'password123'
+        )
+        client = Client()
+        client.force_login(admin)
+        url = reverse('admin:core_user_delete', args=[self.user.id])
+
+        confirm = client.get(url)
+        res = client.post(url, {'post': 'yes'})
+
+        self.user.refresh_from_db()
+        self.assertContains(confirm, 'Images: 5')
+        self.assertEqual(res.status_code, 302)
+        self.assertFalse(self.user.is_active)
+        self.assertEqual(Image.objects.filter(user=self.user).count(), 5)
+        job = Job.objects.get(kind='core.purge_user')
+        self.assertEqual(json.loads(job.payload), {'user_id': self.user.id})
+
+
+class CollectOrphanedMediaTests(MediaTestCase):
+    """Test the command reclaiming files no image refers to"""
+
+    def setUp(self):
+        super().setUp()
+        self.image = self.image_with_file(tiles=True)
+        self.orphan = default_storage.save(
+            'uploads/image/orphan.png', ContentFile(b'x')
+        )
+        self.stale_tile = self.save_tile(self.image.id, 'b' * 16)
+        self.deleted_tile = self.save_tile(self.image.id + 1, 'c' * 16)
+        past = time.time() - 2 * 60 * 60
+        for name in (self.orphan, self.stale_tile, self.deleted_tile):
+            os.utime(default_storage.path(name), (past, past))
+        self.young = default_storage.save(
+            'uploads/image/young.png', ContentFile(b'y')
+        )
+
+    def collect(self, **options):
+        out = StringIO()
+        call_command('collect_orphaned_media', stdout=out, **options)
+        return out.getvalue()
+
+    def test_dry_run(self):
+        """Test orphans are listed and kept"""
+        out = self.collect(dry_run=True)
+
+        self.assertIn(self.orphan, out)
+        self.assertIn(self.stale_tile, out)
+        self.assertIn(self.deleted_tile, out)
+        self.assertIn('Found 1 orphaned uploads and 2', out)
+        self.assertTrue(default_storage.exists(self.orphan))
+
+    @override_settings(CLEANUP_BATCH_SIZE=1)
+    def test_collect(self):
+        """Test orphans are deleted and files in use or recent kept"""
+        out = self.collect()
+
+        self.assertIn('Deleted 1 orphaned uploads and 2', out)
+        for name in (self.orphan, self.stale_tile, self.deleted_tile):
+            self.assertFalse(default_storage.exists(name))
+        self.assertFalse(os.path.exists(
+            default_storage.path(tiles_prefix(self.image.id + 1))
+        ))
+        self.assertTrue(default_storage.exists(self.young))
+        self.assertTrue(default_storage.exists(self.image.image_file.name))
+        self.assertTrue(default_storage.exists(
+            f'{tiles_prefix(self.image.id, "a" * 16)}0/0_0.jpeg'
+        ))
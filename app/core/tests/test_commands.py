@@ -1,9 +1,17 @@
+import json
+import os
+import tempfile
+from io import StringIO
 from unittest.mock import patch
 
+from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.utils import OperationalError
 from django.test import TestCase
 
+from core.models import Image, Label
+
 
 class CommandTests(TestCase):
 
@@ -21,3 +29,77 @@ class CommandTests(TestCase):
             gi.side_effect = [OperationalError] * 5 + [True]
             call_command('wait_for_db')
             self.assertEqual(gi.call_count, 6)
+
+
+class SeedAndBenchmarkCommandTests(TestCase):
+
+    def test_seed_data(self):
+        """Test seeding creates the requested volumes"""
+        call_command(
+            'seed_data', users=2, images=5, labels=4, patients=3,
+            labels_per_image=2, patients_per_image=1, stdout=StringIO()
+        )
+
+        user = get_user_model().objects.get(email='bench-user-0@example.com')
+        self.assertEqual(get_user_model().objects.count(), 2)
+        self.assertEqual(Image.objects.filter(user=user).count(), 5)
+        self.assertEqual(Label.objects.filter(user=user).count(), 4)
+        self.assertEqual(
+            Image.labels.through.objects.filter(image__user=user).count(), 10
+        )
+        self.assertEqual(user.image_count, 5)
+        self.assertEqual(
+            sum(Label.objects.filter(user=user)
+                .values_list('image_count', flat=True)), 10
+        )
+        label = Label.objects.filter(user=user).first()
+        self.assertEqual(label.path, f'/{label.id}/')
+
+    def test_benchmark_writes_results(self):
+        """Test the benchmark reports percentiles for every case"""
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            call_command(
+                'benchmark', seed_users=1, seed_images=3, iterations=2,
+                warmup=0, output=output, stderr=StringIO()
+            )
+            with open(output) as results_file:
+                results = json.load(results_file)
+
+        self.assertIn('image-list', results['results'])
+        self.assertIn('token-login', results['results'])
+        self.assertEqual(results['results']['image-list']['iterations'], 2)
+        self.assertIn('p95_ms', results['results']['image-detail'])
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_benchmark_compare_flags_regressions(self):
+        """Test comparing against a faster baseline fails the run"""
+        baseline = {'results': {'label-list': {'p50_ms': 0.000001}}}
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as base_file:
+            json.dump(baseline, base_file)
+            base_file.flush()
+            with self.assertRaises(CommandError):
+                call_command(
+                    'benchmark', case=['label-list'], seed_users=1,
+                    seed_images=1, iterations=1, warmup=0,
+                    compare=base_file.name, stdout=StringIO(),
+                    stderr=StringIO()
+                )
+
+
+class ReconcileCountsCommandTests(TestCase):
+
+    def test_reconcile_counts(self):
+        """Test the command reports and fixes drifted counters"""
+        user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'testpass'
+        )
+        label = Label.objects.create(user=user, name='Chest')
+        Label.objects.filter(id=label.id).update(image_count=3)
+
+        out = StringIO()
+        call_command('reconcile_counts', stdout=out)
+
+        label.refresh_from_db()
+        self.assertEqual(label.image_count, 0)
+        self.assertIn('Fixed 1 label and 0 user counts', out.getvalue())
@@ -0,0 +1,201 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core import jobs
+from core.management.commands.run_jobs import Command as RunJobsCommand
+from core.models import Job
+
+
+calls = []
+
+
+@jobs.register('test.add')
+def add(a, b):
+    jobs.report_progress(0.5)
+    calls.append((a, b))
+    return {'sum': a + b}
+
+
+@jobs.register('test.fail')
+def fail():
+    raise ValueError('boom')
+
+
+class JobTests(TestCase):
+
+    def setUp(self):
+        calls.clear()
+        self.user = get_user_model().objects.create_user(
+            'test@londonappdev.com', 'testpass'
+        )
+
+    def test_enqueue_waits_for_a_worker(self):
+        """Test queued jobs are not run until claimed"""
+        job = jobs.enqueue('test.add', user=self.user, a=1, b=2)
+
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertEqual(job.user, self.user)
+        self.assertEqual(calls, [])
+
+    @override_settings(JOBS_EAGER=True)
+    def test_enqueue_eager(self):
+        """Test eager mode runs the job inline"""
+        job = jobs.enqueue('test.add', a=1, b=2)
+
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.result, '{"sum": 3}')
+        self.assertEqual(job.progress, 1)
+        self.assertEqual(calls, [(1, 2)])
+
+    def test_claim_and_execute(self):
+        """Test claiming locks runnable jobs and execute records results"""
+        job = jobs.enqueue('test.add', a=2, b=3)
+        jobs.enqueue('test.add', delay=timedelta(hours=1), a=0, b=0)
+
+        self.assertEqual(jobs.claim('worker-1', 10), [job.id])
+        self.assertEqual(jobs.claim('worker-2', 10), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.RUNNING)
+        self.assertEqual(job.locked_by, 'worker-1')
+        self.assertEqual(job.attempts, 1)
+
+        jobs.execute(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.result, '{"sum": 5}')
+
+    def test_claim_reclaims_expired_leases(self):
+        """Test jobs of a vanished worker are claimed again"""
+        job = jobs.enqueue('test.add', a=1, b=1)
+        jobs.claim('worker-1', 1)
+        Job.objects.filter(id=job.id).update(
+            locked_at=timezone.now() - timedelta(days=1)
+        )
+
+        self.assertEqual(jobs.claim('worker-2', 1), [job.id])
+        job.refresh_from_db()
+        self.assertEqual(job.locked_by, 'worker-2')
+        self.assertEqual(job.attempts, 2)
+
+    def test_claim_fails_lost_job_after_max_attempts(self):
+        """Test a job whose worker vanished on its last attempt fails"""
+        job = jobs.enqueue('test.add', max_attempts=1, a=1, b=1)
+        jobs.claim('worker-1', 1)
+        Job.objects.filter(id=job.id).update(
+            locked_at=timezone.now() - timedelta(days=1)
+        )
+
+        self.assertEqual(jobs.claim('worker-2', 1), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.error, jobs.LOST)
+
+    def test_report_progress_renews_lease(self):
+        """Test progress reports keep a long job from being reclaimed"""
+        job = jobs.enqueue('test.add', a=1, b=1)
+        jobs.claim('worker-1', 1)
+        Job.objects.filter(id=job.id).update(
+            locked_at=timezone.now() - timedelta(days=1)
+        )
+        token = jobs._current_job.set(job.id)
+        try:
+            jobs.report_progress(0.5)
+        finally:
+            jobs._current_job.reset(token)
+
+        self.assertEqual(jobs.claim('worker-2', 1), [])
+        job.refresh_from_db()
+        self.assertEqual(job.progress, 0.5)
+        self.assertAlmostEqual(
+            job.locked_at, timezone.now(), delta=timedelta(minutes=1)
+        )
+
+    def test_failed_job_is_retried_with_backoff(self):
+        """Test a failing job is queued again later"""
+        job = jobs.enqueue('test.fail', max_attempts=2)
+        jobs.claim('worker', 1)
+        jobs.execute(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertIn('ValueError: boom', job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(jobs.claim('worker', 1), [])
+
+    def test_failed_job_gives_up_after_max_attempts(self):
+        """Test a job is marked failed once it used all its attempts"""
+        job = jobs.enqueue('test.fail', max_attempts=1)
+        jobs.claim('worker', 1)
+        jobs.execute(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+
+    def test_unknown_kind_fails(self):
+        """Test a job without a registered handler fails"""
+        job = jobs.enqueue('test.missing', max_attempts=1)
+        jobs.claim('worker', 1)
+        jobs.execute(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('UnknownJobKind', job.error)
+
+    def test_backoff_grows_and_is_capped(self):
+        """Test the retry delay doubles up to the configured maximum"""
+        with override_settings(JOB_RETRY_BACKOFF_SECONDS=10,
+                               JOB_RETRY_BACKOFF_MAX_SECONDS=60):
+            self.assertLessEqual(jobs.backoff(1), timedelta(seconds=10))
+            self.assertGreaterEqual(jobs.backoff(3), timedelta(seconds=20))
+            self.assertLessEqual(jobs.backoff(10), timedelta(seconds=60))
+
+    def test_run_jobs_once(self):
+        """Test the worker command drains the queue"""
+        for i in range(3):
+            jobs.enqueue('test.add', a=i, b=i)
+
+        out = StringIO()
+        call_command('run_jobs', processes=0, once=True, stdout=out)
+
+        self.assertIn('Ran 3 jobs', out.getvalue())
+        self.assertEqual(
+            Job.objects.filter(status=Job.SUCCEEDED).count(), 3
+        )
+
+    def test_run_jobs_survives_broken_pool(self):
+        """Test jobs of a dead worker process fail and the pool restarts"""
+        job = jobs.enqueue('test.add', max_attempts=1, a=1, b=1)
+        pools = []
+
+        class BrokenPool:
+            def __init__(self):
+                pools.append(self)
+
+            def submit(self, func, job_id):
+                future = Future()
+                future.set_exception(BrokenProcessPool())
+                return future
+
+            def shutdown(self, wait=True):
+                pass
+
+        command = RunJobsCommand(stdout=StringIO(), stderr=StringIO())
+        with mock.patch.object(command, '_pool', lambda _: BrokenPool()):
+            ran = command._run_pool(
+                'worker', 2, {'once': True, 'poll_interval': 0}
+            )
+
+        job.refresh_from_db()
+        self.assertEqual(ran, 1)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.error, jobs.LOST)
+        self.assertEqual(len(pools), 2)
@@ -0,0 +1,86 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core import metrics
+from core.models import Image
+
+
+IMAGES_URL = reverse('image:image-list')
+METRICS_URL = reverse('metrics')
+
+
+class PerformanceMiddlewareTests(TestCase):
+    """Test the per-request performance instrumentation"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'testpass'
+        )
+        Image.objects.create(user=self.user, title='Scan', status=Image.NEW)
+        metrics.registry.reset()
+
+    def _client(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client
+
+    @override_settings(PERFORMANCE_METRICS_ENABLED=True)
+    def test_server_timing_header(self):
+        """Test timings are returned in a Server-Timing header"""
+        with self.assertLogs('core.performance', level='INFO') as logs:
+            res = self._client().get(IMAGES_URL)
+
+        timing = res['Server-Timing']
+        self.assertIn('total;dur=', timing)
+        self.assertIn('db;dur=', timing)
+        self.assertIn('serializer;dur=', timing)
+        self.assertIn('"route": "image:image-list"', logs.output[0])
+
+    @override_settings(PERFORMANCE_METRICS_ENABLED=True,
+                       PERFORMANCE_METRICS_TOKEN='scrape')
+    def test_metrics_endpoint_aggregates_routes(self):
+        """Test the metrics endpoint exposes per-route histograms"""
+        client = self._client()
+        with self.assertLogs('core.performance', level='INFO'):
+            client.get(IMAGES_URL)
+            client.get(IMAGES_URL)
+            res = client.get(METRICS_URL, HTTP_AUTHORIZATION='Bearer scrape')
+
+        body = res.content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn(
+            'http_request_duration_seconds_count'
+            '{route="image:image-list",method="GET"} 2',
+            body
+        )
+        self.assertIn('http_request_db_queries_bucket{', body)
+
+    @override_settings(PERFORMANCE_METRICS_ENABLED=True,
+                       PERFORMANCE_METRICS_TOKEN='scrape')
+    def test_metrics_endpoint_refuses_anonymous(self):
+        """Test only staff and the scraper token may read the metrics"""
+        client = APIClient()
+        with self.assertLogs('core.performance', level='INFO'):
+            self.assertEqual(client.get(METRICS_URL).status_code, 403)
+            res = client.get(METRICS_URL, HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(res.status_code, 403)
+
+            client.force_login(self.user)
+            self.assertEqual(client.get(METRICS_URL).status_code, 403)
+
+            self.user.is_staff = True
+            self.user.save()
+            self.assertEqual(client.get(METRICS_URL).status_code, 200)
+
+    @override_settings(PERFORMANCE_METRICS_ENABLED=False)
+    def test_disabled_middleware_is_skipped(self):
+        """Test nothing is recorded while instrumentation is disabled"""
+        client = self._client()
+        res = client.get(IMAGES_URL)
+
+        self.assertNotIn('Server-Timing', res)
+        self.assertEqual(client.get(METRICS_URL).status_code, 404)
@@ -1,5 +1,6 @@
 from unittest.mock import patch
 
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 
@@ -55,6 +56,27 @@ class ModelTests(TestCase):
 
         self.assertEqual(str(label), label.name)
 
+    def test_label_move_checked_against_stored_paths(self):
+        """Test a move is checked against the paths in the database, not
+        those of instances read before a concurrent move
+        """
+        user = sample_user()
+        first = models.Label.objects.create(user=user, name='Chest')
+        second = models.Label.objects.create(user=user, name='Lung')
+        stale_first = models.Label.objects.get(id=first.id)
+        stale_second = models.Label.objects.get(id=second.id)
+        first.parent = second
+        first.save()
+
+        stale_second.check_parent(stale_first)
+        stale_second.parent = stale_first
+        with self.assertRaisesMessage(ValidationError, 'descendants'):
+            stale_second.save()
+
+        second.refresh_from_db()
+        self.assertIsNone(second.parent_id)
+        self.assertEqual(second.path, f'/{second.id}/')
+
     def test_patient_info_str(self):
         """ Test the patient info string representation"""
         patient_info = models.PatientInfo.objects.create(
@@ -70,10 +92,28 @@ class ModelTests(TestCase):
             user=sample_user(),
             title="Dear patient1 MRI Image",
             date="2020-05-12",
-            status="New status",
+            status=models.Image.NEW,
         )
         self.assertEqual(str(image), image.title)
 
+    def test_image_search_text(self):
+        """Test the search text follows the title and relations"""
+        user = sample_user()
+        image = models.Image.objects.create(
+            user=user, title='Brain CT', status=models.Image.NEW
+        )
+        label = models.Label.objects.create(user=user, name='Stroke')
+        patient = models.PatientInfo.objects.create(user=user, name='Ann Lee')
+
+        image.labels.add(label)
+        patient.image_set.add(image)
+        image.refresh_from_db()
+        self.assertEqual(image.search_text, 'brain ct stroke ann lee')
+
+        label.image_set.clear()
+        image.refresh_from_db()
+        self.assertEqual(image.search_text, 'brain ct ann lee')
+
     @patch('uuid.uuid4')
     def test_image_file_name_uuid(self, mock_uuid):
         """ Test that image is saved in the correct location"""
@@ -83,3 +123,70 @@ class ModelTests(TestCase):
 
         exp_path = f'uploads/image/{uuid}.jpg'
         self.assertEqual(file_path, exp_path)
+
+
+class CounterTests(TestCase):
+    def setUp(self):
+        self.user = sample_user()
+        self.chest = models.Label.objects.create(user=self.user, name='Chest')
+        self.knee = models.Label.objects.create(user=self.user, name='Knee')
+        self.image = models.Image.objects.create(
+            user=self.user, title='Scan', status=models.Image.NEW
+        )
+
+    def counts(self):
+        return [
+            models.Label.objects.get(id=self.chest.id).image_count,
+            models.Label.objects.get(id=self.knee.id).image_count,
+            get_user_model().objects.get(id=self.user.id).image_count,
+        ]
+
+    def test_forward_changes(self):
+        """Test adding, removing and clearing an image's labels"""
+        self.image.labels.add(self.chest, self.knee)
+        self.image.labels.add(self.chest)
+        self.assertEqual(self.counts(), [1, 1, 1])
+
+        self.image.labels.remove(self.knee)
+        self.image.labels.remove(self.knee)
+        self.assertEqual(self.counts(), [1, 0, 1])
+
+        self.image.labels.set([self.knee])
+        self.assertEqual(self.counts(), [0, 1, 1])
+
+        self.image.labels.clear()
+        self.assertEqual(self.counts(), [0, 0, 1])
+
+    def test_reverse_changes(self):
+        """Test adding, removing and clearing a label's images"""
+        other = models.Image.objects.create(
+            user=self.user, title='Other', status=models.Image.NEW
+        )
+        self.chest.image_set.add(self.image, other)
+        self.assertEqual(self.counts(), [2, 0, 2])
+
+        self.chest.image_set.remove(other)
+        self.assertEqual(self.counts(), [1, 0, 2])
+
+        self.chest.image_set.clear()
+        self.assertEqual(self.counts(), [0, 0, 2])
+
+    def test_image_deleted(self):
+        """Test deleting an image drops it from every count"""
+        self.image.labels.add(self.chest)
+        self.image.delete()
+
+        self.assertEqual(self.counts(), [0, 0, 0])
+
+    def test_reconcile_counts(self):
+        """Test counters missed by bulk inserts are repaired"""
+        models.Image.labels.through.objects.bulk_create([
+            models.Image.labels.through(
+                image_id=self.image.id, label_id=self.knee.id
+            )
+        ])
+        models.Label.objects.filter(id=self.chest.id).update(image_count=7)
+
+        self.assertEqual(models.reconcile_counts(), (2, 0))
+        self.assertEqual(self.counts(), [0, 1, 1])
+        self.assertEqual(models.reconcile_counts(), (0, 0))
@@ -0,0 +1,96 @@
+from unittest import mock, skipUnless
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from core.pubsub import InMemoryBroker, PostgresBroker
+
+
+class InMemoryBrokerTests(TestCase):
+
+    def test_publish_to_subscribers(self):
+        """Test messages reach every subscriber of their channel only"""
+        broker = InMemoryBroker()
+        first = broker.subscribe('user:1')
+        second = broker.subscribe('user:1')
+        other = broker.subscribe('user:2')
+
+        self.assertEqual(broker.publish('user:1', {'id': 1}), 2)
+
+        self.assertEqual(first.get(timeout=0), {'id': 1})
+        self.assertEqual(second.get(timeout=0), {'id': 1})
+        self.assertIsNone(other.get(timeout=0))
+
+    def test_unsubscribe(self):
+        """Test closed subscriptions receive nothing more"""
+        broker = InMemoryBroker()
+        with broker.subscribe('user:1') as subscription:
+            pass
+
+        self.assertEqual(broker.publish('user:1', {'id': 1}), 0)
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_slow_subscriber_overflows(self):
+        """Test a full subscriber is flagged instead of blocking"""
+        broker = InMemoryBroker(max_pending=2)
+        subscription = broker.subscribe('user:1')
+        for i in range(3):
+            broker.publish('user:1', {'id': i})
+
+        self.assertTrue(subscription.overflowed)
+        self.assertEqual(subscription.get(timeout=0), {'id': 0})
+
+
+class PostgresBrokerTests(TestCase):
+
+    def test_reconnect_resyncs_subscribers(self):
+        """Test a new listening connection listens to every subscribed
+        channel again and flags their subscribers as having missed events
+        """
+        broker = PostgresBroker()
+        conn = mock.MagicMock()
+        with mock.patch.object(broker, '_execute'):
+            subscription = broker.subscribe('user:1')
+
+        with mock.patch.object(broker, '_connect', return_value=conn):
+            self.assertIs(broker._reconnect(), conn)
+
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with('LISTEN "user:1"')
+        self.assertTrue(subscription.overflowed)
+
+    def test_notification_delivered(self):
+        """Test notifications reach the local subscribers of their channel"""
+        broker = PostgresBroker()
+        with mock.patch.object(broker, '_execute'):
+            subscription = broker.subscribe('user:1')
+
+        broker._dispatch(mock.Mock(channel='user:1', payload='{"id": 1}'))
+
+        self.assertEqual(subscription.get(timeout=0), {'id': 1})
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Needs PostgreSQL')
+class PostgresBrokerNotifyTests(TransactionTestCase):
+
+    def setUp(self):
+        self.broker = PostgresBroker()
+        self.addCleanup(self.broker.stop)
+
+    def test_publish_between_brokers(self):
+        """Test messages reach subscribers of another process' broker"""
+        subscription = self.broker.subscribe('user:1')
+
+        PostgresBroker().publish('user:1', {'id': 1})
+
+        self.assertEqual(subscription.get(timeout=5), {'id': 1})
+        self.assertFalse(subscription.overflowed)
+
+    def test_unsubscribe(self):
+        """Test the last subscriber of a channel stops listening to it"""
+        with self.broker.subscribe('user:1'):
+            pass
+
+        self.broker.publish('user:1', {'id': 1})
+
+        self.assertFalse(self.broker._channels)
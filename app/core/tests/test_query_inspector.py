@@ -0,0 +1,76 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core.models import Label
+from core.query_inspector import (
+    QueryInspector,
+    RepeatedQueriesError,
+    normalize_sql,
+)
+
+
+LABELS_URL = reverse('image:label-list')
+
+
+class NormalizeSqlTests(TestCase):
+
+    def test_literals_and_in_lists_normalized(self):
+        """Test queries differing only in parameters share a shape"""
+        first = normalize_sql(
+            "SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'a'"
+        )
+        second = normalize_sql(
+            "SELECT  * FROM t WHERE id IN (%s) AND name = %s"
+        )
+
+        self.assertEqual(first, 'SELECT * FROM t WHERE id IN (?) AND name = ?')
+        self.assertEqual(first, second)
+
+
+class QueryInspectorTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'testpass'
+        )
+
+    def test_repeated_shapes_detected(self):
+        """Test a per-row query pattern is reported"""
+        labels = [
+            Label.objects.create(user=self.user, name=f'Label {i}')
+            for i in range(4)
+        ]
+        with QueryInspector().capture() as inspector:
+            for label in labels:
+                Label.objects.get(id=label.id)
+
+        repeated = inspector.repeated(3)
+        self.assertEqual(len(repeated), 1)
+        self.assertEqual(repeated[0][1], 4)
+
+    def test_slow_queries_recorded_with_stack(self):
+        """Test queries over the threshold keep the calling stack"""
+        with QueryInspector(slow_ms=0).capture() as inspector:
+            Label.objects.count()
+
+        sql, _, stack = inspector.slow_queries[0]
+        self.assertIn('COUNT', sql)
+        self.assertIn('test_query_inspector.py', stack)
+
+    @override_settings(
+        QUERY_INSPECTOR_ENABLED=True,
+        QUERY_INSPECTOR_RAISE=True,
+        QUERY_INSPECTOR_REPEAT_THRESHOLD=0,
+        QUERY_INSPECTOR_SLOW_MS=10000,
+    )
+    def test_middleware_raises_on_repeated_queries(self):
+        """Test the middleware raises when the repeat threshold is hit"""
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        with self.assertRaises(RepeatedQueriesError):
+            client.get(LABELS_URL)
@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+import time
+from io import StringIO
+
+import boto3
+
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core.models import Image
+from core.storage import FileSystemStorage, S3Storage
+
+BUCKET = 'media'
+
+
+class S3TestMixin:
+    """Run against a mocked bucket, made the default storage"""
+
+    def setUp(self):
+        super().setUp()
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        boto3.client('s3', region_name='us-east-1').create_bucket(
+            Bucket=BUCKET
+        )
+        storage = override_settings(
+            DEFAULT_FILE_STORAGE='core.storage.S3Storage',
+            S3_BUCKET=BUCKET, S3_REGION='us-east-1', S3_ENDPOINT_URL=None,
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.storage = default_storage
+
+
+class S3StorageTests(S3TestMixin, SimpleTestCase):
+    """Test media files kept in an S3 bucket"""
+
+    def test_save_and_read(self):
+        """Test files round trip, with seeks served by ranged reads"""
+        content = bytes(range(256)) * 64
+        name = self.storage.save('uploads/image/a.bin', ContentFile(content))
+
+        with self.storage.open(name) as stored:
+            head = stored.read(10)
+            stored.seek(1000)
+            middle = stored.read(24)
+            stored.seek(0)
+            whole = stored.read()
+
+        self.assertEqual(name, 'uploads/image/a.bin')
+        self.assertEqual(head, content[:10])
+        self.assertEqual(middle, content[1000:1024])
+        self.assertEqual(whole, content)
+        self.assertEqual(self.storage.size(name), len(content))
+        self.assertEqual(stored.size, len(content))
+
+    def test_exists_and_delete(self):
+        """Test missing objects are reported, and deletes are idempotent"""
+        name = self.storage.save('a.png', ContentFile(b'a'))
+
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete(name)
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(name)
+
+    def test_content_type(self):
+        """Test objects are stored with the type of their extension"""
+        name = self.storage.save('scan.png', ContentFile(b'a'))
+
+        head = boto3.client('s3', region_name='us-east-1').head_object(
+            Bucket=BUCKET, Key=name
+        )
+        self.assertEqual(head['ContentType'], 'image/png')
+
+    @override_settings(S3_MULTIPART_THRESHOLD=5 * 1024 ** 2,
+                       S3_MULTIPART_CHUNK_SIZE=5 * 1024 ** 2)
+    def test_multipart(self):
+        """Test large files are uploaded in parts"""
+        content = os.urandom(11 * 1024 ** 2)
+        name = self.storage.save('big.bin', ContentFile(content))
+
+        head = boto3.client('s3', region_name='us-east-1').head_object(
+            Bucket=BUCKET, Key=name
+        )
+        self.assertTrue(head['ETag'].strip('"').endswith('-3'))
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), content)
+
+    def test_listdir_and_scan(self):
+        """Test listings by level and of a whole prefix"""
+        for name in ('tiles/1/v/0/0_0.jpeg', 'tiles/1/v/1/0_0.jpeg',
+                     'tiles/2/w/0/0_0.jpeg', 'tiles/top.txt'):
+            self.storage.save(name, ContentFile(b't'))
+
+        self.assertEqual(
+            self.storage.listdir('tiles/'), (['1', '2'], ['top.txt'])
+        )
+        self.assertEqual(
+            sorted(name for name, _ in self.storage.scan('tiles/1/')),
+            ['tiles/1/v/0/0_0.jpeg', 'tiles/1/v/1/0_0.jpeg'],
+        )
+        _, modified = next(self.storage.scan('tiles/2/'))
+        self.assertAlmostEqual(modified, time.time(), delta=60)
+
+    def test_urls_are_presigned(self):
+        """Test URLs point at the bucket and carry a signature"""
+        url = self.storage.url('uploads/image/a.png')
+
+        self.assertIn('uploads/image/a.png', url)
+        self.assertIn('Signature', url)
+
+    def test_presigned_upload_limits_size(self):
+        """Test upload forms are limited to the given size"""
+        upload = S3Storage().presigned_upload('a.png', 1000, 60)
+
+        self.assertEqual(upload['fields']['key'], 'a.png')
+        self.assertIn('policy', upload['fields'])
+
+
+class FileSystemStorageTests(SimpleTestCase):
+    """Test the listing extensions of local storage"""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location)
+        self.storage = FileSystemStorage(location=self.location)
+
+    def test_scan_and_prune(self):
+        """Test every file is found and empty directories removed"""
+        for name in ('tiles/1/v/0/0_0.jpeg', 'tiles/2/w/0/0_0.jpeg'):
+            self.storage.save(name, ContentFile(b't'))
+
+        self.assertEqual(
+            sorted(name for name, _ in self.storage.scan('tiles/')),
+            ['tiles/1/v/0/0_0.jpeg', 'tiles/2/w/0/0_0.jpeg'],
+        )
+        self.assertEqual(list(self.storage.scan('missing/')), [])
+
+        self.storage.delete('tiles/1/v/0/0_0.jpeg')
+        self.storage.prune('tiles/')
+
+        self.assertEqual(self.storage.listdir('tiles/'), (['2'], []))
+
+
+@override_settings(CLEANUP_ORPHAN_MIN_AGE_SECONDS=-60)
+class S3OrphanedMediaTests(S3TestMixin, TestCase):
+    """Test orphaned media is collected from a bucket"""
+
+    def test_collect(self):
+        """Test objects no image refers to are deleted"""
+        user = get_user_model().objects.create_user(
+            'test@test.com', 'testpass'
+        )
+        image = Image.objects.create(user=user, title='Scan')
+        image.image_file.save('scan.png', ContentFile(b'png'))
+        orphan = self.storage.save(
+            'uploads/image/orphan.png', ContentFile(b'x')
+        )
+        out = StringIO()
+
+        call_command('collect_orphaned_media', stdout=out)
+
+        self.assertIn('Deleted 1 orphaned uploads and 0', out.getvalue())
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertTrue(self.storage.exists(image.image_file.name))
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+
+from core import metrics as core_metrics
+
+
+def _may_read_metrics(request):
+    """Staff sessions, and scrapers sending PERFORMANCE_METRICS_TOKEN as a
+    bearer token
+    """
+    token = settings.PERFORMANCE_METRICS_TOKEN
+    if token and constant_time_compare(
+        request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'
+    ):
+        return True
+    return request.user.is_active and request.user.is_staff
+
+
+def metrics(request):
+    """Expose the per-route request histograms to Prometheus"""
+    if not settings.PERFORMANCE_METRICS_ENABLED:
+        raise Http404
+    if not _may_read_metrics(request):
+        raise PermissionDenied
+    return HttpResponse(
+        core_metrics.registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
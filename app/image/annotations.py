@@ -0,0 +1,64 @@
+import sys
+from array import array
+
+from core.models import Annotation
+
+# Largest magnitude a float32 holds; pack() cannot store larger values
+MAX_COORDINATE = 3.4028234663852886e38
+
+
+def pack(points):
+    """Pack [[x, y], ...] as little-endian float32 pairs"""
+    packed = array('f', (value for point in points for value in point))
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(data):
+    """Return the [[x, y], ...] points packed by pack()"""
+    values = array('f')
+    values.frombytes(bytes(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    values = values.tolist()
+    return [values[i:i + 2] for i in range(0, len(values), 2)]
+
+
+def polygon_area(points):
+    """Return the area enclosed by a simple polygon (shoelace formula)"""
+    twice_area = 0.0
+    x_prev, y_prev = points[-1]
+    for x, y in points:
+        twice_area += x_prev * y - x * y_prev
+        x_prev, y_prev = x, y
+    return abs(twice_area) / 2
+
+
+def build(user, image, label_id, kind, points):
+    """Return an unsaved Annotation with its bounding box and area.
+
+    A box is given by two opposite corners, which are stored as its
+    minimum and maximum corner.
+    """
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    x_min, y_min, x_max, y_max = min(xs), min(ys), max(xs), max(ys)
+    if kind == Annotation.BOX:
+        points = [[x_min, y_min], [x_max, y_max]]
+        area = (x_max - x_min) * (y_max - y_min)
+    else:
+        area = polygon_area(points)
+
+    return Annotation(
+        user=user,
+        image=image,
+        label_id=label_id,
+        kind=kind,
+        points=pack(points),
+        x_min=x_min,
+        y_min=y_min,
+        x_max=x_max,
+        y_max=y_max,
+        area=area,
+    )
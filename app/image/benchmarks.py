@@ -0,0 +1,189 @@
+import random
+import struct
+import zlib
+from io import BytesIO
+
+import numpy as np
+
+from django.urls import reverse
+
+from PIL import Image as PILImage
+
+from core.benchmarks import expect_status, register
+from core.models import Image, Label
+
+from image import embeddings, phash
+
+
+IMAGES_URL = reverse('image:image-list')
+LABELS_URL = reverse('image:label-list')
+
+
+def _get(client, url, params=None):
+    """Return a callable issuing a GET that must succeed"""
+    def call():
+        res = client.get(url, params)
+        expect_status(res)
+    return call
+
+
+def _post_upload(client, url, payload, name, status_code=200):
+    """Return a callable uploading payload as a file"""
+    def call():
+        upload = BytesIO(payload)
+        upload.name = name
+        res = client.post(url, {'image_file': upload}, format='multipart')
+        expect_status(res, status_code)
+    return call
+
+
+@register('image-list')
+def image_list(context):
+    return _get(context.client, IMAGES_URL)
+
+
+@register('image-list-filtered')
+def image_list_filtered(context):
+    label_ids = Label.objects.filter(user=context.user).values_list(
+        'id', flat=True
+    )[:2]
+    return _get(
+        context.client,
+        IMAGES_URL,
+        {'labels': ','.join(str(label_id) for label_id in label_ids)},
+    )
+
+
+@register('image-search')
+def image_search(context):
+    return _get(context.client, IMAGES_URL, {'search': 'patient 1'})
+
+
+@register('image-detail')
+def image_detail(context):
+    image = Image.objects.filter(user=context.user).order_by('id').first()
+    return _get(
+        context.client, reverse('image:image-detail', args=[image.id])
+    )
+
+
+@register('image-upload', iterations=20)
+def image_upload(context):
+    image = Image.objects.filter(user=context.user).order_by('id').first()
+    url = reverse('image:image-upload-file', args=[image.id])
+    buffer = BytesIO()
+    PILImage.new('RGB', (512, 512), (120, 60, 30)).save(buffer, 'PNG')
+    payload = buffer.getvalue()
+
+    return _post_upload(context.client, url, payload, 'benchmark.png')
+
+
+@register('image-upload-large', iterations=10)
+def image_upload_large(context):
+    """A 4096x4096 photo-like JPEG of several megabytes"""
+    image = Image.objects.filter(user=context.user).order_by('id').first()
+    url = reverse('image:image-upload-file', args=[image.id])
+    noise = np.random.default_rng(0).integers(
+        0, 256, (4096, 4096, 3), dtype=np.uint8
+    )
+    buffer = BytesIO()
+    PILImage.fromarray(noise).save(buffer, 'JPEG', quality=90)
+    return _post_upload(context.client, url, buffer.getvalue(), 'large.jpg')
+
+
+def _png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data)))
+
+
+@register('image-upload-bomb', iterations=20)
+def image_upload_bomb(context):
+    """A 400 kB PNG that would decode to 20000x20000 pixels.
+
+    Refused from its header, so the time must not grow with the pixels
+    it claims.
+    """
+    image = Image.objects.filter(user=context.user).order_by('id').first()
+    url = reverse('image:image-upload-file', args=[image.id])
+    side = 20000
+    compressor = zlib.compressobj(9)
+    row = bytes(side + 1)
+    pixels = b''.join(compressor.compress(row) for _ in range(side))
+    payload = (
+        b'\x89PNG\r\n\x1a\n'
+        + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 0, 0,
+                                          0, 0))
+        + _png_chunk(b'IDAT', pixels + compressor.flush())
+        + _png_chunk(b'IEND', b'')
+    )
+    return _post_upload(context.client, url, payload, 'bomb.png', 400)
+
+
+@register('image-status-bulk')
+def image_status_bulk(context):
+    """Move 100 images between two statuses at their current versions"""
+    images = Image.objects.filter(user=context.user).order_by('id')[:100]
+    url = reverse('image:image-status')
+    statuses = ['in_progress', 'labelled']
+
+    def call():
+        statuses.reverse()
+        payload = [
+            {'id': image_id, 'version': version, 'status': statuses[0]}
+            for image_id, version in images.values_list('id', 'version')
+        ]
+        res = context.client.post(url, payload, format='json')
+        expect_status(res)
+    return call
+
+
+@register('label-list')
+def label_list(context):
+    return _get(context.client, LABELS_URL)
+
+
+@register('image-similar')
+def image_similar(context):
+    """Near-duplicate lookup over the user's whole library.
+
+    Images without a hash get random ones, so the multi-index probes hit
+    realistically sparse chunk values; one image gets a near copy of the
+    query hash so the lookup has something to return.
+    """
+    rng = random.Random(0)
+    pending = Image.objects.filter(user=context.user, phash__isnull=True)
+    batch = []
+    for image in pending.only('id').iterator():
+        for name, value in phash.hash_fields(rng.getrandbits(64)).items():
+            setattr(image, name, value)
+        batch.append(image)
+    Image.objects.bulk_update(
+        batch, ['phash', 'phash_0', 'phash_1', 'phash_2', 'phash_3']
+    )
+
+    query, near = Image.objects.filter(user=context.user).order_by('id')[:2]
+    near_hash = phash.to_unsigned(query.phash) ^ 0b101
+    Image.objects.filter(id=near.id).update(**phash.hash_fields(near_hash))
+    url = reverse('image:image-similar', args=[query.id])
+    return _get(context.client, url, {'distance': 8})
+
+
+@register('image-suggest-labels')
+def image_suggest_labels(context):
+    """Label suggestions from the nearest of the whole library.
+
+    Images without an embedding get random unit vectors; the first call
+    loads the user's index, later ones only check the change log.
+    """
+    rng = np.random.default_rng(0)
+    pending = Image.objects.filter(user=context.user, embedding__isnull=True)
+    batch = []
+    for image in pending.only('id').iterator():
+        vector = rng.standard_normal(embeddings.DIMENSIONS)
+        image.embedding = embeddings.pack(vector / np.linalg.norm(vector))
+        batch.append(image)
+    Image.objects.bulk_update(batch, ['embedding'], batch_size=1000)
+
+    query = Image.objects.filter(user=context.user).order_by('id').first()
+    url = reverse('image:image-suggest-labels', args=[query.id])
+    return _get(context.client, url, {'k': 10})
@@ -0,0 +1,214 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.conf import settings
+
+from PIL import Image as PILImage
+
+
+CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+
+def render(image_file, width=None, height=None, format='jpeg', quality=85):
+    """Return the bytes of a downscaled, re-encoded copy of an image.
+
+    The image is fitted inside width x height keeping its aspect ratio and
+    is never upscaled. draft() lets the JPEG decoder scale by up to 1/8
+    while decoding, and reduce() does a cheap integer box downscale before
+    the final resample, so large originals are never resampled at full
+    resolution.
+    """
+    with PILImage.open(image_file) as img:
+        target = _fit(img.size, width, height)
+        mode = 'RGB' if format == 'jpeg' else img.mode
+        img.draft(mode, target)
+        # Before reduce(), which refuses palette, bilevel and 16 bit modes
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            img = img.convert('RGBA' if format != 'jpeg' else 'RGB')
+        if format == 'jpeg' and img.mode == 'RGBA':
+            img = img.convert('RGB')
+        factor = min(img.width // target[0], img.height // target[1]) // 2
+        if factor >= 2:
+            img = img.reduce(factor)
+        if img.size != target:
+            img = img.resize(target, PILImage.LANCZOS)
+
+        buffer = BytesIO()
+        img.save(buffer, format=format, quality=quality)
+
+    return buffer.getvalue()
+
+
+def _fit(size, width, height):
+    """Return the largest size within width x height keeping the aspect"""
+    src_width, src_height = size
+    scale = min(
+        (width or src_width) / src_width,
+        (height or src_height) / src_height,
+        1,
+    )
+    return (
+        max(1, round(src_width * scale)),
+        max(1, round(src_height * scale)),
+    )
+
+
+class DerivativeCache:
+    """Size bounded, least recently used cache of derivatives on disk.
+
+    Entries are files named by key; a hit touches the file's mtime so the
+    eviction scan can drop the least recently used files first once the
+    directory grows past max_bytes. Concurrent requests for a missing key
+    are coalesced: threads wait on a per-key lock and processes on a per-key
+    flock, so only one of them decodes the original.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key[:2], f'{key}.{extension}')
+
+    @contextmanager
+    def _key_lock(self, key):
+        with self._locks_guard:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            lock_path = os.path.join(self.directory, '.locks', key)
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            with open(lock_path, 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with self._locks_guard:
+            if not lock.locked():
+                self._locks.pop(key, None)
+
+    def open(self, key, extension, produce):
+        """Open a cached entry, first storing produce()'s bytes on a miss"""
+        path = self.path(key, extension)
+        cached = self._open(path)
+        if cached:
+            return cached
+
+        with self._key_lock(key):
+            cached = self._open(path)
+            if cached:
+                return cached
+            content = produce()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(content)
+            os.replace(tmp_path, path)
+            # Open before eviction can see the entry, so it cannot vanish
+            entry = open(path, 'rb')
+
+        self._added(len(content))
+        return entry
+
+    def _open(self, path):
+        """Open an entry and mark it as recently used, if it exists"""
+        try:
+            entry = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def _entries(self):
+        """Yield (mtime, size, path) for every cached file"""
+        if not os.path.isdir(self.directory):
+            return
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir() or shard.name == '.locks':
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def _added(self, size):
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._size = self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries down to 90% of the budget.
+
+        The scan also resynchronizes the size estimate with what other
+        processes have written.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            key = os.path.basename(path).split('.')[0]
+            for stale in (path, os.path.join(self.directory, '.locks', key)):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+        return total
+
+
+_cache = None
+
+
+def get_cache():
+    """Return the process wide derivative cache"""
+    global _cache
+    directory = settings.IMAGE_DERIVATIVE_CACHE_DIR
+    max_bytes = settings.IMAGE_DERIVATIVE_CACHE_BYTES
+    if _cache is None or (_cache.directory, _cache.max_bytes) != (
+        directory, max_bytes
+    ):
+        _cache = DerivativeCache(directory, max_bytes)
+    return _cache
+
+
+def derivative_key(image, width, height, format, quality):
+    """Return the cache key of a derivative; it changes on re-upload"""
+    raw = f'{image.id}:{image.checksum}:{width}:{height}:{format}:{quality}'
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def get_derivative(image, width=None, height=None, format='jpeg',
+                   quality=85):
+    """Open a cached derivative, rendering it on a miss"""
+    key = derivative_key(image, width, height, format, quality)
+
+    def produce():
+        with image.pixel_file.open('rb') as image_file:
+            return render(image_file, width, height, format, quality)
+
+    return get_cache().open(key, format, produce)
@@ -0,0 +1,188 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pydicom
+from pydicom.multival import MultiValue
+
+try:
+    from pydicom.pixels import apply_color_lut
+except ImportError:
+    # pydicom < 3
+    from pydicom.pixel_data_handlers.util import apply_color_lut
+
+from PIL import Image as PILImage
+
+from core.models import DICOM_FORMAT, PatientInfo
+
+
+# DICOM files start with a 128 byte preamble followed by this marker
+PREAMBLE = 128
+MAGIC = b'DICM'
+# The only elements read from the header; reading stops before the pixel
+# data, and values over DEFER_SIZE bytes are skipped rather than loaded
+HEADER_TAGS = (
+    'PatientID', 'PatientName', 'StudyDate', 'SeriesDate',
+    'AcquisitionDate', 'ContentDate', 'Modality', 'SOPInstanceUID', 'Rows',
+    'Columns', 'SamplesPerPixel', 'PhotometricInterpretation',
+    'BitsAllocated',
+)
+DEFER_SIZE = 1024
+# The first of these dates present is the image's date
+DATE_TAGS = ('StudyDate', 'SeriesDate', 'AcquisitionDate', 'ContentDate')
+
+
+def is_dicom(fp):
+    """Return whether a file carries the DICOM marker"""
+    fp.seek(PREAMBLE)
+    marker = fp.read(len(MAGIC))
+    fp.seek(0)
+    return marker == MAGIC
+
+
+def read_header(fp):
+    """Return the HEADER_TAGS elements of a DICOM file.
+
+    Pixel data is never read, and neither are large values of elements
+    other than those asked for. Raises ValueError for files pydicom cannot
+    read.
+    """
+    fp.seek(0)
+    try:
+        header = pydicom.dcmread(
+            fp, stop_before_pixels=True, defer_size=DEFER_SIZE,
+            specific_tags=list(HEADER_TAGS),
+        )
+    except Exception as exc:
+        # pydicom fails in many ways on malformed files
+        raise ValueError(f'Unreadable DICOM header: {exc}') from exc
+    finally:
+        fp.seek(0)
+    if 'Rows' not in header or 'Columns' not in header:
+        raise ValueError('The DICOM file holds no image.')
+    return header
+
+
+def _date(header):
+    for tag in DATE_TAGS:
+        value = str(header.get(tag) or '')
+        digits = ''.join(char for char in value if char.isdigit())
+        try:
+            return datetime.strptime(digits[:8], '%Y%m%d').date()
+        except ValueError:
+            continue
+    return None
+
+
+def _mode(header):
+    """Return the PIL mode matching the stored pixels"""
+    if header.get('SamplesPerPixel', 1) == 3:
+        return 'RGB'
+    if header.get('PhotometricInterpretation') == 'PALETTE COLOR':
+        return 'P'
+    return 'L' if header.get('BitsAllocated', 8) <= 8 else 'I;16'
+
+
+def image_fields(header):
+    """Return the Image columns read from a DICOM header"""
+    fields = {
+        'width': int(header.Columns),
+        'height': int(header.Rows),
+        'mode': _mode(header),
+        'format': DICOM_FORMAT,
+        # Upper case, as the standard spells modalities, so the API can
+        # match them exactly
+        'modality': str(header.get('Modality') or '').upper()[:16],
+        'sop_instance_uid': str(header.get('SOPInstanceUID') or '')[:64],
+    }
+    date = _date(header)
+    if date is not None:
+        fields['date'] = date
+    return fields
+
+
+def patient_fields(header):
+    """Return the PatientInfo fields of a DICOM header's patient, or None"""
+    patient_id = str(header.get('PatientID') or '').strip()[:64]
+    name = header.get('PatientName')
+    if name:
+        # Family^Given^Middle^Prefix^Suffix, written in reading order
+        name = ' '.join(
+            part for part in (
+                name.name_prefix, name.given_name, name.middle_name,
+                name.family_name, name.name_suffix,
+            ) if part
+        ) or str(name)
+    name = (name or patient_id)[:255]
+    if not name:
+        return None
+    return {'patient_id': patient_id, 'name': name}
+
+
+def link_patient(image, patient):
+    """Link an image to the user's patient of some patient_fields.
+
+    Patients are matched by patient ID, or by name when the file has no
+    ID, and created if the user has none yet.
+    """
+    if patient is None:
+        return None
+    lookup = (
+        {'patient_id': patient['patient_id']} if patient['patient_id']
+        else {'name': patient['name'], 'patient_id': ''}
+    )
+    info = PatientInfo.objects.filter(user_id=image.user_id, **lookup).first()
+    if info is None:
+        info = PatientInfo.objects.create(user_id=image.user_id, **patient)
+    image.patient_info.add(info)
+    return info
+
+
+def _window(values, header):
+    """Map stored values to 0-1 through the modality and VOI transforms"""
+    values = values.astype(np.float32)
+    slope = float(header.get('RescaleSlope', 1) or 1)
+    intercept = float(header.get('RescaleIntercept', 0) or 0)
+    values = values * slope + intercept
+    center, width = header.get('WindowCenter'), header.get('WindowWidth')
+    if center is not None and width is not None:
+        # Several windows may be given; the first is the default
+        if isinstance(center, MultiValue):
+            center, width = center[0], width[0]
+        low = float(center) - float(width) / 2
+        high = float(center) + float(width) / 2
+    else:
+        low, high = float(values.min()), float(values.max())
+    scaled = np.clip((values - low) / max(high - low, 1e-6), 0, 1)
+    if header.get('PhotometricInterpretation') == 'MONOCHROME1':
+        # Low values are bright
+        scaled = 1 - scaled
+    return scaled
+
+
+def render_preview(fp):
+    """Return an 8 bit PIL image of the first frame of a DICOM file.
+
+    Grayscale frames go through the file's rescale and default window,
+    or are stretched between their extremes when there is no window.
+    This is the one place the pixel data is decoded.
+    """
+    fp.seek(0)
+    dataset = pydicom.dcmread(fp)
+    pixels = dataset.pixel_array
+    if int(dataset.get('NumberOfFrames', 1) or 1) > 1:
+        pixels = pixels[0]
+    if dataset.get('PhotometricInterpretation') == 'PALETTE COLOR':
+        pixels = apply_color_lut(pixels, dataset)
+    if pixels.ndim == 3:
+        # Color; pydicom's decoders already convert YBR to RGB
+        if pixels.dtype.itemsize > 1:
+            pixels = pixels >> 8 * (pixels.dtype.itemsize - 1)
+        return PILImage.fromarray(pixels.astype(np.uint8))
+    scaled = _window(pixels, dataset)
+    return PILImage.fromarray(np.round(scaled * 255).astype(np.uint8))
+
+
+def preview_name(name):
+    """Return the storage name of the preview of an uploaded file"""
+    return f'{os.path.splitext(name)[0]}.preview.png'
@@ -0,0 +1,237 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from PIL import Image as PILImage
+
+from core.models import ChangeLog, Image, User
+
+
+# 8x8 gray layout, 4x4x4 color histogram, 16 bin gradient histogram
+LAYOUT_SIZE = 8
+COLOR_LEVELS = 4
+TEXTURE_BINS = 16
+DIMENSIONS = LAYOUT_SIZE ** 2 + COLOR_LEVELS ** 3 + TEXTURE_BINS
+DTYPE = np.dtype('<f4')
+# Side of the thumbnail every feature is computed from
+THUMBNAIL_SIZE = 32
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _unit(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def embed(fp):
+    """Return the embedding of an image file as a unit float32 vector.
+
+    Three cheap descriptors of a 32x32 thumbnail, each normalized so they
+    weigh the same: the 8x8 layout of gray levels around their mean, a
+    4x4x4 RGB histogram and a histogram of gradient magnitudes for the
+    texture. Histograms are square rooted, so the dot product of two
+    embeddings compares them with the Hellinger kernel.
+    """
+    with PILImage.open(fp) as img:
+        img.draft('RGB', (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+        small = img.convert('RGB').resize(
+            (THUMBNAIL_SIZE, THUMBNAIL_SIZE), PILImage.BILINEAR
+        )
+    rgb = np.asarray(small, dtype=np.float32) / 255
+    gray = rgb @ GRAY_WEIGHTS
+
+    cell = THUMBNAIL_SIZE // LAYOUT_SIZE
+    layout = gray.reshape(LAYOUT_SIZE, cell, LAYOUT_SIZE, cell).mean(
+        axis=(1, 3)
+    ).ravel()
+    layout -= layout.mean()
+
+    levels = np.minimum((rgb * COLOR_LEVELS).astype(np.int64),
+                        COLOR_LEVELS - 1)
+    bins = (levels[..., 0] * COLOR_LEVELS + levels[..., 1]) * COLOR_LEVELS
+    bins += levels[..., 2]
+    color = np.bincount(bins.ravel(), minlength=COLOR_LEVELS ** 3)
+
+    grad_y, grad_x = np.gradient(gray)
+    texture, _ = np.histogram(
+        np.hypot(grad_x, grad_y), bins=TEXTURE_BINS, range=(0, 0.5)
+    )
+
+    vector = np.concatenate([
+        _unit(layout),
+        _unit(np.sqrt(color.astype(np.float32))),
+        _unit(np.sqrt(texture.astype(np.float32))),
+    ])
+    return _unit(vector).astype(DTYPE)
+
+
+def pack(vector):
+    return np.asarray(vector, dtype=DTYPE).tobytes()
+
+
+def unpack(data):
+    return np.frombuffer(bytes(data), dtype=DTYPE)
+
+
+class EmbeddingIndex:
+    """The embeddings of one user's images, held in memory for search.
+
+    Rows live in one preallocated float32 matrix that grows by doubling;
+    search is a single matrix product against it. The index follows the
+    user's change log: refresh() reloads only the images logged as
+    inserted, updated or deleted since the last refresh, which covers
+    new embeddings as well as label changes. Rows of deleted images are
+    only masked out; past EMBEDDING_INDEX_MAX_CHANGES pending changes the
+    whole index is reloaded instead, which also compacts it.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.seq = None
+        self.lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.size = 0
+        self.vectors = np.zeros((0, DIMENSIONS), dtype=DTYPE)
+        self.ids = np.zeros(0, dtype=np.int64)
+        # Labelled rows are the candidate neighbours; removed rows are
+        # never labelled
+        self.labelled = np.zeros(0, dtype=bool)
+        self.rows = {}
+
+    def _images(self, ids=None):
+        images = Image.objects.filter(
+            user_id=self.user_id, embedding__isnull=False
+        )
+        if ids is not None:
+            images = images.filter(id__in=ids)
+        return images.annotate(
+            has_labels=Exists(Image.labels.through.objects.filter(
+                image_id=OuterRef('pk')
+            ))
+        ).values_list('id', 'embedding', 'has_labels')
+
+    def load(self):
+        """Read every embedded image of the user"""
+        # Read before the images: changes made meanwhile are replayed by
+        # the next refresh, which is harmless
+        self.seq = User.objects.filter(id=self.user_id).values_list(
+            'change_seq', flat=True
+        ).first() or 0
+        self._clear()
+        self._store(list(self._images().iterator()))
+
+    def refresh(self):
+        """Catch up with the changes logged since the last refresh"""
+        if self.seq is None:
+            self.load()
+            return
+        changes = list(
+            ChangeLog.objects.filter(
+                user_id=self.user_id, seq__gt=self.seq
+            ).order_by('seq').values_list('seq', 'model', 'object_id')[
+                :settings.EMBEDDING_INDEX_MAX_CHANGES + 1
+            ]
+        )
+        if len(changes) > settings.EMBEDDING_INDEX_MAX_CHANGES:
+            self.load()
+            return
+        if not changes:
+            return
+        self.seq = changes[-1][0]
+        changed = {
+            object_id for _, model, object_id in changes if model == 'image'
+        }
+        if not changed:
+            return
+        found = list(self._images(changed))
+        # Deleted, or no longer embedded
+        for image_id in changed - {row[0] for row in found}:
+            row = self.rows.pop(image_id, None)
+            if row is not None:
+                self.labelled[row] = False
+                self.ids[row] = -1
+        self._store(found)
+
+    def _store(self, found):
+        """Insert or overwrite the rows of (id, embedding, labelled)"""
+        if not found:
+            return
+        ids, vectors, labelled = zip(*found)
+        new = [image_id for image_id in ids if image_id not in self.rows]
+        self._reserve(self.size + len(new))
+        for row, image_id in enumerate(new, self.size):
+            self.rows[image_id] = row
+        self.size += len(new)
+        rows = [self.rows[image_id] for image_id in ids]
+        self.vectors[rows] = unpack(b''.join(map(bytes, vectors))).reshape(
+            -1, DIMENSIONS
+        )
+        self.ids[rows] = ids
+        self.labelled[rows] = labelled
+
+    def _reserve(self, size):
+        capacity = len(self.ids)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, 1024)
+        vectors = np.zeros((capacity, DIMENSIONS), dtype=DTYPE)
+        vectors[:self.size] = self.vectors[:self.size]
+        ids = np.full(capacity, -1, dtype=np.int64)
+        ids[:self.size] = self.ids[:self.size]
+        labelled = np.zeros(capacity, dtype=bool)
+        labelled[:self.size] = self.labelled[:self.size]
+        self.vectors, self.ids, self.labelled = vectors, ids, labelled
+
+    def nearest(self, queries, k, exclude=()):
+        """Return the k labelled images most similar to each query.
+
+        queries is a (m, DIMENSIONS) array; all of them are scored in one
+        matrix product and the top k of each row picked with
+        argpartition, without sorting the whole index. Returns a list of
+        m lists of (image id, cosine similarity), most similar first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=DTYPE))
+        scores = queries @ self.vectors[:self.size].T
+        candidates = self.labelled[:self.size].copy()
+        for image_id in exclude:
+            if image_id in self.rows:
+                candidates[self.rows[image_id]] = False
+        scores[:, ~candidates] = -np.inf
+        k = min(k, int(candidates.sum()))
+        if k == 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [
+            list(zip(self.ids[rows].tolist(), row_scores.tolist()))
+            for rows, row_scores in zip(top, top_scores)
+        ]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(user_id):
+    """Return the user's index, refreshed, creating it on first use.
+
+    Each process keeps the indexes of the EMBEDDING_INDEX_MAX_USERS users
+    searched most recently. Callers must hold index.lock while using it.
+    """
+    with _indexes_lock:
+        index = _indexes.pop(user_id, None) or EmbeddingIndex(user_id)
+        _indexes[user_id] = index
+        while len(_indexes) > settings.EMBEDDING_INDEX_MAX_USERS:
+            _indexes.popitem(last=False)
+    with index.lock:
+        index.refresh()
+    return index
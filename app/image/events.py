@@ -0,0 +1,73 @@
+import json
+import time
+
+from django.db import connection
+
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.renderers import BaseRenderer
+
+
+class QueryTokenAuthentication(TokenAuthentication):
+    """Token authentication that also accepts ?token=<key>.
+
+    Browsers' EventSource cannot send an Authorization header.
+    """
+
+    def authenticate(self, request):
+        key = request.query_params.get('token')
+        if key is None:
+            return super().authenticate(request)
+        return self.authenticate_credentials(key)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Renders errors for text/event-stream clients as an error event"""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_event(data, event='error')
+
+
+def format_event(data, event=None, event_id=None):
+    """Return one server-sent event carrying data as JSON"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def event_stream(subscription, heartbeat, max_seconds):
+    """Yield server-sent events from a pub/sub subscription.
+
+    A comment goes out every heartbeat seconds without events, so proxies
+    keep the connection open and dead clients are noticed. The stream ends
+    after max_seconds; EventSource reconnects by itself, which bounds how
+    long a server thread stays tied to one client. A subscriber that fell
+    behind gets a resync event and should catch up through the sync
+    endpoint.
+    """
+    with subscription:
+        # Nothing below needs the database; don't hold a connection open
+        if not connection.in_atomic_block:
+            connection.close()
+        yield ': connected\n\n'
+        deadline = time.monotonic() + max_seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            message = subscription.get(timeout=min(heartbeat, remaining))
+            if subscription.overflowed:
+                yield format_event({}, event='resync')
+                return
+            if message is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield format_event(
+                    message, event=message['model'], event_id=message['seq']
+                )
@@ -0,0 +1,278 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import django
+from django.core.files.storage import default_storage
+
+from PIL import Image as PILImage, ImageOps
+
+from core.models import Image, Label
+
+from image import tasks
+
+
+MANIFEST = 'manifest.json'
+PLAN = 'plan-ids.npy'
+CHANNELS = {'L': 1, 'RGB': 3}
+
+
+def shard_path(directory, kind, index):
+    """Return the path of one array of a shard: images, labels or ids"""
+    return os.path.join(directory, f'{kind}-{index:05d}.npy')
+
+
+def decode(image_file, size, mode):
+    """Return an image as a height x width x channels uint8 array.
+
+    The image is fitted inside size keeping its aspect ratio and padded
+    with black. draft() lets the JPEG decoder scale down while decoding,
+    so large originals are never decoded at full resolution.
+    """
+    height, width = size
+    with PILImage.open(image_file) as img:
+        img.draft(mode, (width, height))
+        img = ImageOps.pad(
+            img.convert(mode), (width, height), method=PILImage.BILINEAR
+        )
+        return np.asarray(img, dtype=np.uint8).reshape(
+            height, width, CHANNELS[mode]
+        )
+
+
+def write_shard(directory, index, files, size, mode):
+    """Decode files into the images array of one shard.
+
+    Rows are written straight into a memory mapped .npy file, so a worker
+    holds one decoded image at a time whatever the shard size. The file
+    only gets its final name once complete; a crash leaves a .partial
+    file that the next run overwrites. Returns the ids that are missing
+    or failed to decode, whose rows are left black.
+    """
+    final = shard_path(directory, 'images', index)
+    partial = f'{final}.partial'
+    rows = np.lib.format.open_memmap(
+        partial, mode='w+', dtype=np.uint8,
+        shape=(len(files), *size, CHANNELS[mode]),
+    )
+    failed = []
+    for row, (image_id, name) in enumerate(files):
+        if not name:
+            failed.append(image_id)
+            continue
+        try:
+            with default_storage.open(name) as image_file:
+                rows[row] = decode(image_file, size, mode)
+        except (OSError, ValueError, PILImage.DecompressionBombError):
+            failed.append(image_id)
+    rows.flush()
+    del rows
+    os.replace(partial, final)
+    return failed
+
+
+class Exporter:
+    """Export images as fixed shape, sharded .npy arrays for training.
+
+    The directory gets, for each shard of up to shard_size images:
+
+        images-NNNNN.npy  uint8, (n, height, width, channels)
+        labels-NNNNN.npy  uint8, (n, len(labels)) multi-hot label index
+        ids-NNNNN.npy     int64, (n,) image ids
+
+    plus manifest.json describing the shape, the label columns and which
+    shards are complete. The image ids to export are fixed in
+    plan-ids.npy on the first run, so running again with the same
+    parameters resumes after the last complete shard even if images were
+    labelled in between. filters describes how the queryset was chosen;
+    it is kept in the manifest so a run with other filters is refused
+    rather than resumed over images it did not select.
+    """
+
+    def __init__(self, directory, size=(224, 224), mode='RGB',
+                 shard_size=1024, filters=None):
+        self.directory = directory
+        self.size = tuple(size)
+        self.mode = mode
+        self.shard_size = shard_size
+        self.filters = filters or {}
+        self.manifest_path = os.path.join(directory, MANIFEST)
+
+    def plan(self, queryset):
+        """Fix the images and label columns of the export, or reload them.
+
+        Returns the manifest. Raises ValueError if the directory holds an
+        export made with other parameters.
+        """
+        params = {
+            'size': list(self.size),
+            'mode': self.mode,
+            'channels': CHANNELS[self.mode],
+            'dtype': 'uint8',
+            'shard_size': self.shard_size,
+            'filters': self.filters,
+        }
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as fp:
+                manifest = json.load(fp)
+            if {key: manifest.get(key) for key in params} != params:
+                raise ValueError(
+                    f'{self.directory} holds an export with other '
+                    f'parameters: {manifest}'
+                )
+            return manifest
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Images over the upload limit would be decoded whole, only to be
+        # shrunk to a few hundred pixels
+        queryset = tasks.decodable(queryset)
+        ids = np.fromiter(
+            queryset.order_by('id').values_list('id', flat=True).iterator(),
+            dtype=np.int64,
+        )
+        np.save(os.path.join(self.directory, PLAN), ids)
+        labels = Label.objects.filter(
+            id__in=Image.labels.through.objects.filter(
+                image_id__in=queryset.values('id')
+            ).values('label_id')
+        ).order_by('id').values('id', 'name')
+        manifest = {
+            **params,
+            'count': len(ids),
+            'labels': list(labels),
+            'shards': [
+                {'index': index,
+                 'count': int(min(self.shard_size, len(ids) - start)),
+                 'complete': False, 'failed': []}
+                for index, start in enumerate(
+                    range(0, len(ids), self.shard_size)
+                )
+            ],
+        }
+        self._save(manifest)
+        return manifest
+
+    def run(self, queryset, processes=0, progress=None):
+        """Export the images of queryset, skipping the complete shards.
+
+        processes=0 decodes in this process. Otherwise shards are decoded
+        by a pool of spawned processes, with at most two shards per
+        process in flight so memory stays bounded. Returns the manifest.
+        """
+        manifest = self.plan(queryset)
+        ids = np.load(os.path.join(self.directory, PLAN), mmap_mode='r')
+        label_ids = np.array(
+            [label['id'] for label in manifest['labels']], dtype=np.int64
+        )
+        pending = [
+            shard for shard in manifest['shards']
+            if not (shard['complete'] and os.path.exists(
+                shard_path(self.directory, 'images', shard['index'])
+            ))
+        ]
+
+        def submit(submit_fn, shard):
+            start = shard['index'] * self.shard_size
+            shard_ids = np.array(ids[start:start + shard['count']])
+            self._write_index(shard['index'], shard_ids, label_ids)
+            names = {
+                image.id: image.pixel_file and image.pixel_file.name
+                for image in Image.objects.filter(
+                    id__in=shard_ids.tolist()
+                ).only('image_file', 'preview_file', 'format')
+            }
+            # Images deleted since the plan keep their (black) row
+            files = [
+                (image_id, names.get(image_id))
+                for image_id in shard_ids.tolist()
+            ]
+            return submit_fn(
+                write_shard, self.directory, shard['index'], files,
+                self.size, self.mode,
+            )
+
+        def finish(shard, failed):
+            shard['complete'] = True
+            shard['failed'] = failed
+            self._save(manifest)
+            if progress:
+                progress(shard)
+
+        if processes == 0:
+            for shard in pending:
+                finish(shard, submit(lambda fn, *args: fn(*args), shard))
+            return manifest
+
+        # Spawned rather than forked children set Django up from scratch
+        # and never share the parent's database connections
+        pool = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+        running = {}
+        with pool:
+            for shard in pending:
+                if len(running) >= 2 * processes:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(running.pop(future), future.result())
+                running[submit(pool.submit, shard)] = shard
+            for future in wait(running).done:
+                finish(running[future], future.result())
+        return manifest
+
+    def _write_index(self, index, shard_ids, label_ids):
+        """Write the ids and multi-hot label rows of one shard"""
+        pairs = np.array(
+            Image.labels.through.objects.filter(
+                image_id__in=shard_ids.tolist()
+            ).values_list('image_id', 'label_id'),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        # Labels created after the plan have no column
+        pairs = pairs[np.isin(pairs[:, 1], label_ids)]
+        labels = np.zeros((len(shard_ids), len(label_ids)), dtype=np.uint8)
+        labels[
+            np.searchsorted(shard_ids, pairs[:, 0]),
+            np.searchsorted(label_ids, pairs[:, 1]),
+        ] = 1
+        np.save(shard_path(self.directory, 'labels', index), labels)
+        np.save(shard_path(self.directory, 'ids', index), shard_ids)
+
+    def _save(self, manifest):
+        """Write the manifest atomically"""
+        partial = f'{self.manifest_path}.partial'
+        with open(partial, 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        os.replace(partial, self.manifest_path)
+
+
+def load_shard(directory, index):
+    """Return the (images, labels, ids) arrays of a shard, memory mapped"""
+    return tuple(
+        np.load(shard_path(directory, kind, index), mmap_mode='r')
+        for kind in ('images', 'labels', 'ids')
+    )
+
+
+def iter_batches(directory, batch_size):
+    """Yield (images, labels, ids) batches of an export.
+
+    Batches are slices of the memory mapped shards: nothing is copied
+    until the trainer reads the pixels, and the OS pages them in and out
+    as needed. A batch never spans two shards, so the last batch of each
+    shard may be smaller.
+    """
+    with open(os.path.join(directory, MANIFEST)) as fp:
+        manifest = json.load(fp)
+    for shard in manifest['shards']:
+        if not shard['complete']:
+            continue
+        images, labels, ids = load_shard(directory, shard['index'])
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            yield images[start:end], labels[start:end], ids[start:end]
@@ -0,0 +1,14 @@
+from image import tasks
+from image.management.commands import compute_image_stats
+
+
+class Command(compute_image_stats.Command):
+    """Django command to backfill image embeddings"""
+
+    help = (
+        'Compute the embedding of images that do not have one, in a pool '
+        'of processes'
+    )
+    task = staticmethod(tasks.compute_embedding)
+    field = 'embedding'
+    computed = 'embeddings'
@@ -0,0 +1,79 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import Image
+
+from image import tasks
+
+logger = logging.getLogger(__name__)
+
+
+def run(task, image_id):
+    """Run task on one image and return whether it succeeded; errors are
+    logged so that one unreadable file does not stop the backfill
+    """
+    try:
+        task(image_id)
+    except Exception:
+        logger.exception('Could not compute image %s', image_id)
+        return False
+    return True
+
+
+class Command(BaseCommand):
+    """Django command to backfill image exposure statistics"""
+
+    help = (
+        'Compute the exposure statistics of images that do not have them, '
+        'in a pool of processes'
+    )
+    # The task run for each image, and the column it fills in
+    task = staticmethod(tasks.compute_stats)
+    field = 'blankness'
+    computed = 'statistics'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=settings.JOB_WORKER_PROCESSES,
+            help='Worker processes, 0 computes in this process'
+        )
+        parser.add_argument('--all', action='store_true',
+                            help=f'Recompute images with {self.computed}')
+
+    def handle(self, *args, **options):
+        # Images over the limit are only viewed through their tiles
+        pending = tasks.decodable(Image.objects.all())
+        if not options['all']:
+            pending = pending.filter(**{f'{self.field}__isnull': True})
+        pending = list(pending.order_by('id').values_list('id', flat=True))
+
+        processes = options['processes']
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes == 0:
+            results = [run(self.task, image_id) for image_id in pending]
+        else:
+            # Spawned rather than forked children set Django up from
+            # scratch and never share the parent's database connections
+            pool = ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+            with pool:
+                results = list(pool.map(
+                    partial(run, self.task), pending, chunksize=64
+                ))
+
+        failed = results.count(False)
+        self.stdout.write(self.style.SUCCESS(
+            f'Computed {self.computed} of {len(pending) - failed} images'
+            + (f', {failed} failed' if failed else '')
+        ))
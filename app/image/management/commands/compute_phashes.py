@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Image
+
+from image import tasks
+from image.management.commands.compute_image_stats import run
+
+
+class Command(BaseCommand):
+    """Django command to backfill perceptual hashes"""
+
+    help = 'Compute the perceptual hash of images that do not have one'
+
+    def handle(self, *args, **options):
+        # Images over the limit are only viewed through their tiles
+        pending = list(
+            tasks.decodable(Image.objects.filter(phash__isnull=True))
+            .values_list('id', flat=True)
+        )
+        failed = [
+            image_id for image_id in pending
+            if not run(tasks.compute_phash, image_id)
+        ]
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Hashed {len(pending) - len(failed)} images'
+            + (f', {len(failed)} failed' if failed else '')
+        ))
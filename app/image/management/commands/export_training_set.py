@@ -0,0 +1,110 @@
+import os
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Image, Label, subtree_images
+
+from image.export import CHANNELS, Exporter
+
+
+def parse_size(value):
+    """Parse 224 or 224x320 (height x width)"""
+    try:
+        parts = [int(part) for part in value.lower().split('x')]
+    except ValueError:
+        parts = []
+    if len(parts) == 1:
+        parts *= 2
+    if len(parts) != 2 or min(parts) < 1:
+        raise CommandError(f'Invalid size "{value}", expected 224 or 224x320')
+    return tuple(parts)
+
+
+class Command(BaseCommand):
+    """Django command to export images as sharded NumPy arrays"""
+
+    help = (
+        'Decode and resize images into fixed shape, memory mappable .npy '
+        'shards with a multi-hot label index. Run again with the same '
+        'arguments to resume an interrupted export.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--user', help='Email of the images\' owner')
+        parser.add_argument(
+            '--status', default='labelled,reviewed',
+            help='Comma separated statuses to export'
+        )
+        parser.add_argument(
+            '--labels',
+            help='Comma separated label ids; their subtrees are included'
+        )
+        parser.add_argument('--size', default='224',
+                            help='224 or height x width, e.g. 224x320')
+        parser.add_argument('--mode', default='RGB', choices=list(CHANNELS))
+        parser.add_argument('--shard-size', type=int, default=1024)
+        parser.add_argument(
+            '--processes', type=int, default=settings.JOB_WORKER_PROCESSES,
+            help='Decoding processes, 0 decodes in this process'
+        )
+
+    def handle(self, *args, **options):
+        images = Image.objects.all()
+        if options['user']:
+            try:
+                user = get_user_model().objects.get(email=options['user'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f'No user {options["user"]}')
+            images = images.filter(user=user)
+        codes = {name: code for code, name in Image.STATUS_NAMES.items()}
+        statuses = options['status'].split(',')
+        unknown = set(statuses) - set(codes)
+        if unknown:
+            raise CommandError(f'Unknown status {", ".join(sorted(unknown))}')
+        images = images.filter(status__in=[codes[name] for name in statuses])
+        label_ids = []
+        if options['labels']:
+            try:
+                label_ids = sorted({
+                    int(i) for i in options['labels'].split(',')
+                })
+            except ValueError:
+                raise CommandError(f'Invalid labels "{options["labels"]}"')
+            images = images.filter(
+                id__in=subtree_images(Label.objects.filter(id__in=label_ids))
+            )
+
+        processes = options['processes']
+        if processes is None:
+            processes = os.cpu_count() or 1
+        exporter = Exporter(
+            options['directory'],
+            size=parse_size(options['size']),
+            mode=options['mode'],
+            shard_size=options['shard_size'],
+            filters={
+                'user': options['user'],
+                'status': sorted(set(statuses)),
+                'labels': label_ids,
+            },
+        )
+        try:
+            manifest = exporter.run(
+                images,
+                processes=processes,
+                progress=lambda shard: self.stdout.write(
+                    f'Shard {shard["index"]}: {shard["count"]} images'
+                ),
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        failed = sum(len(shard['failed']) for shard in manifest['shards'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {manifest["count"]} images in '
+            f'{len(manifest["shards"])} shards to {options["directory"]}'
+            + (f', {failed} could not be decoded' if failed else '')
+        ))
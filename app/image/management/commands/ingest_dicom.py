@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.models import Image
+
+from image import dicom, tasks, uploads
+from image.metadata import extract_metadata
+
+
+def read_file(path):
+    """Return (path, metadata, patient, error) of a file, metadata being
+    None for files that are not DICOM
+    """
+    try:
+        with open(path, 'rb') as fp:
+            if not dicom.is_dicom(fp):
+                return path, None, None, None
+            values, patient = extract_metadata(fp)
+        uploads.check_size(values['byte_size'])
+        uploads.check_dimensions(values['width'], values['height'])
+    except (OSError, ValueError, uploads.UploadRejected) as exc:
+        return path, None, None, str(exc)
+    return path, values, patient, None
+
+
+class Command(BaseCommand):
+    """Django command to import a directory of DICOM files"""
+
+    help = (
+        'Import the DICOM files under a directory, such as a study, as '
+        'images of a user linked to their patients. Headers are parsed in '
+        'a pool of processes; files imported before, by SOP Instance UID, '
+        'are skipped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--user', required=True,
+                            help='Email of the images\' owner')
+        parser.add_argument('--generate-tiles', action='store_true',
+                            help='Build the tile pyramid of every image')
+        parser.add_argument(
+            '--processes', type=int, default=settings.JOB_WORKER_PROCESSES,
+            help='Parsing processes, 0 parses in this process'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            self.user = get_user_model().objects.get(email=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'No user {options["user"]}')
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f'No directory {directory}')
+        self.directory = directory
+        self.generate_tiles = options['generate_tiles']
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(directory) for name in names
+        )
+
+        processes = options['processes']
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes == 0:
+            counts = self.ingest(map(read_file, paths))
+        else:
+            # Spawned rather than forked children set Django up from
+            # scratch and never share the parent's database connections
+            pool = ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+            with pool:
+                counts = self.ingest(pool.map(read_file, paths, chunksize=16))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Imported {imported} DICOM files, skipped {duplicate} imported '
+            'before, {other} other files and {failed} failures'.format(
+                **counts
+            )
+        ))
+
+    def ingest(self, results):
+        """Store the files read by the pool, in the order they come"""
+        counts = dict.fromkeys(('imported', 'duplicate', 'other', 'failed'), 0)
+        for path, values, patient, error in results:
+            if error:
+                self.stderr.write(f'{path}: {error}')
+                counts['failed'] += 1
+            elif values is None:
+                counts['other'] += 1
+            elif values['sop_instance_uid'] and Image.objects.filter(
+                user=self.user, sop_instance_uid=values['sop_instance_uid']
+            ).exists():
+                counts['duplicate'] += 1
+            else:
+                self.store(path, values, patient)
+                counts['imported'] += 1
+        return counts
+
+    def store(self, path, values, patient):
+        """Create the image of a file and queue its preview"""
+        title = os.path.relpath(path, self.directory)[:255]
+        image = Image(
+            user=self.user, title=title,
+            tiles_status=Image.TILES_PENDING if self.generate_tiles else '',
+            **values
+        )
+        with open(path, 'rb') as fp:
+            image.image_file.save('image.dcm', File(fp), save=False)
+        with transaction.atomic():
+            image.save()
+            dicom.link_patient(image, patient)
+            tasks.process_upload(image)
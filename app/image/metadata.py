@@ -0,0 +1,46 @@
+import hashlib
+
+from image import dicom, uploads
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def extract_metadata(image_file):
+    """Return the indexed metadata columns for an uploaded image file, and
+    the patient_fields of DICOM files (None for other formats).
+
+    Pillow only parses the header, so dimensions, mode and format are
+    read without decoding any pixels; it is opened without its pixel
+    limit, which tiled uploads may exceed. image.dicom reads DICOM
+    headers the same way, which also give the date and modality. The
+    checksum is computed over the raw bytes in chunks.
+    """
+    patient = None
+    if dicom.is_dicom(image_file):
+        header = dicom.read_header(image_file)
+        metadata = dicom.image_fields(header)
+        patient = dicom.patient_fields(header)
+    else:
+        with uploads.open_image(image_file) as img:
+            width, height = img.size
+            metadata = {
+                'width': width,
+                'height': height,
+                'mode': img.mode,
+                'format': img.format or '',
+                'modality': '',
+                'sop_instance_uid': '',
+            }
+
+    image_file.seek(0)
+    digest = hashlib.sha256()
+    byte_size = 0
+    for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        byte_size += len(chunk)
+    image_file.seek(0)
+
+    metadata['byte_size'] = byte_size
+    metadata['checksum'] = digest.hexdigest()
+    return metadata, patient
@@ -0,0 +1,98 @@
+from itertools import combinations
+
+from django.db.models import Q
+
+from PIL import Image as PILImage
+
+
+HASH_SIZE = 8
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# Largest distance answerable from the chunk index with radius 2 probes
+MAX_DISTANCE = CHUNKS * 3 - 1
+
+
+def dhash(fp):
+    """Return the 64 bit difference hash of an image file.
+
+    The image is reduced to a 9x8 grayscale thumbnail and each bit records
+    whether a pixel is brighter than its right neighbour. draft() lets the
+    JPEG decoder skip straight to a downscaled image.
+    """
+    with PILImage.open(fp) as img:
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        small = img.convert('L').resize(
+            (HASH_SIZE + 1, HASH_SIZE), PILImage.BILINEAR
+        )
+        pixels = list(small.getdata())
+
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            brighter = pixels[offset + col] > pixels[offset + col + 1]
+            value = (value << 1) | brighter
+
+    return value
+
+
+def to_signed(value):
+    """Map an unsigned 64 bit hash onto a signed BigIntegerField value"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value):
+    """Inverse of to_signed"""
+    return value + (1 << 64) if value < 0 else value
+
+
+def split(value):
+    """Split a 64 bit hash into its CHUNKS indexed 16 bit parts"""
+    return [
+        (value >> (CHUNK_BITS * (CHUNKS - 1 - i))) & CHUNK_MASK
+        for i in range(CHUNKS)
+    ]
+
+
+def hash_fields(value):
+    """Return the Image column values for an unsigned hash"""
+    fields = {'phash': to_signed(value)}
+    for i, chunk in enumerate(split(value)):
+        fields[f'phash_{i}'] = chunk
+    return fields
+
+
+def distance(a, b):
+    """Hamming distance between two hashes"""
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count('1')
+
+
+def neighbours(chunk, radius):
+    """Return every chunk value within radius bits of chunk"""
+    values = [chunk]
+    for flips in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            mask = 0
+            for bit in bits:
+                mask |= 1 << bit
+            values.append(chunk ^ mask)
+    return values
+
+
+def candidates_filter(value, max_distance):
+    """Return a Q matching every hash within max_distance of value.
+
+    Multi-index hashing: if two hashes differ in at most max_distance bits,
+    at least one of the CHUNKS parts differs in at most
+    max_distance // CHUNKS bits. Probing each part's index with those
+    neighbours is exact for recall and only touches a small fraction of
+    the rows; candidates still need their full distance checked.
+    """
+    if not 0 <= max_distance <= MAX_DISTANCE:
+        raise ValueError(f'max_distance must be between 0 and {MAX_DISTANCE}')
+    radius = max_distance // CHUNKS
+    query = Q()
+    for i, chunk in enumerate(split(to_unsigned(value))):
+        query |= Q(**{f'phash_{i}__in': neighbours(chunk, radius)})
+    return query
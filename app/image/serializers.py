@@ -1,55 +1,446 @@
+import json
+import math
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError as DjangoValidationError
+
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
+
+from core import cleanup
+from core.metrics import TimedSerializerMixin
+from core.models import (
+    Annotation,
+    Image,
+    Job,
+    Label,
+    PatientInfo,
+    tiles_version,
+)
+
+from image import annotations, dicom, stats, uploads
+from image.metadata import extract_metadata
+
+
+IMAGE_METADATA_FIELDS = (
+    'width', 'height', 'mode', 'format', 'byte_size', 'checksum',
+    'modality', 'tiles_status',
+)
+IMAGE_STATS_FIELDS = (
+    'intensity_mean', 'intensity_std', 'contrast', 'overexposed',
+    'blankness',
+)
+
+
+class NamedChoiceField(serializers.ChoiceField):
+    """Small integer code read and written by name"""
+
+    def __init__(self, names, **kwargs):
+        self.names = names
+        self.codes = {name: code for code, name in names.items()}
+        super().__init__(choices=list(self.codes), **kwargs)
+
+    def to_internal_value(self, data):
+        return self.codes[super().to_internal_value(data)]
+
+    def to_representation(self, value):
+        return self.names[value]
+
+
+class ImageStatusField(NamedChoiceField):
+    """Image status by name, stored as its small integer code"""
+
+    def __init__(self, **kwargs):
+        super().__init__(Image.STATUS_NAMES, **kwargs)
+
+
+class PointsField(serializers.Field):
+    """[[x, y], ...] coordinates, stored packed by image.annotations"""
+    default_error_messages = {
+        'invalid': 'Expected a list of [x, y] pairs of finite numbers.',
+        'out_of_range': 'Coordinates must be within +/-{max_coordinate}.',
+        'too_many': 'At most {max_points} points are allowed.',
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            self.fail('invalid')
+        if len(data) > settings.ANNOTATION_MAX_POINTS:
+            self.fail('too_many', max_points=settings.ANNOTATION_MAX_POINTS)
+        points = []
+        for point in data:
+            if not isinstance(point, list) or len(point) != 2:
+                self.fail('invalid')
+            x, y = point
+            if not all(
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and math.isfinite(value)
+                for value in point
+            ):
+                self.fail('invalid')
+            if any(abs(value) > annotations.MAX_COORDINATE for value in point):
+                self.fail(
+                    'out_of_range',
+                    max_coordinate=annotations.MAX_COORDINATE,
+                )
+            points.append([float(x), float(y)])
+        return points
+
+    def to_representation(self, value):
+        return annotations.unpack(value)
+
+
+class HistogramField(serializers.Field):
+    """Intensity histogram shares, stored packed by image.stats"""
+
+    def to_representation(self, value):
+        return [round(share, 6) for share in stats.unpack_histogram(value)]
+
+
+class ImageUploadField(serializers.FileField):
+    """Image file checked from its header instead of decoded.
 
-from core.models import Label, PatientInfo, Image
+    DRF's ImageField has Pillow open and verify the whole upload. This
+    reads only the header for the format and dimensions, and reports the
+    reason ImageUploadHandler gave for refusing an upload mid-stream.
+    """
 
+    def run_validation(self, data=serializers.empty):
+        request = self.context.get('request')
+        rejections = getattr(request, 'upload_rejections', {})
+        if self.field_name in rejections:
+            raise serializers.ValidationError(rejections[self.field_name])
+        return super().run_validation(data)
 
-class LabelSerializer(serializers.ModelSerializer):
+    def to_internal_value(self, data):
+        image_file = super().to_internal_value(data)
+        try:
+            uploads.inspect_file(image_file, tiled=True)
+        except uploads.UploadRejected as exc:
+            raise serializers.ValidationError(str(exc))
+        return image_file
+
+
+class BatchedManyRelatedField(serializers.ManyRelatedField):
+    """List of primary keys resolved with one id__in query.
+
+    DRF's ManyRelatedField fetches every submitted pk with its own query.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+
+        child = self.child_relation
+        pks = []
+        for item in data:
+            try:
+                if isinstance(item, bool):
+                    raise TypeError
+                pks.append(int(item))
+            except (TypeError, ValueError):
+                child.fail('incorrect_type', data_type=type(item).__name__)
+
+        found = child.get_queryset().in_bulk(pks)
+        for pk in pks:
+            if pk not in found:
+                child.fail('does_not_exist', pk_value=pk)
+        return [found[pk] for pk in dict.fromkeys(pks)]
+
+
+class UserPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Primary key of an object owned by the requesting user.
+
+    With many=True the keys are validated in one batch.
+    """
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BatchedManyRelatedField(**list_kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        request = self.context.get('request')
+        if request is None or not request.user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(user=request.user)
+
+
+class LabelSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
     """Serializer for label objects"""
+    parent = UserPrimaryKeyRelatedField(
+        queryset=Label.objects.all(), required=False, allow_null=True
+    )
 
     class Meta:
         model = Label
-        fields = ('id', 'name')
-        read_only_fields = ('id',)
+        fields = ('id', 'name', 'parent', 'image_count')
+        read_only_fields = ('id', 'image_count')
+
+    def validate(self, attrs):
+        if 'parent' in attrs:
+            label = self.instance or Label(
+                user=self.context['request'].user
+            )
+            try:
+                label.check_parent(attrs['parent'])
+            except DjangoValidationError as exc:
+                raise serializers.ValidationError(exc.message_dict)
+        return attrs
+
+    def save(self, **kwargs):
+        """Save, reporting a parent that a concurrent move made invalid
+        since validate(); see Label.save
+        """
+        try:
+            return super().save(**kwargs)
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(exc.message_dict)
 
 
-class PatientInfoSerializer(serializers.ModelSerializer):
+class PatientInfoSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
     """Serializer for patient info objects"""
 
     class Meta:
         model = PatientInfo
-        fields = ('id', 'name')
+        fields = ('id', 'name', 'patient_id')
         read_only_fields = ('id',)
 
 
-class ImageSerializer(serializers.ModelSerializer):
+class ImageSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
     """Serializer for image objects"""
-    patient_info = serializers.PrimaryKeyRelatedField(
+    patient_info = UserPrimaryKeyRelatedField(
         many=True,
         queryset=PatientInfo.objects.all()
     )
-    labels = serializers.PrimaryKeyRelatedField(
+    labels = UserPrimaryKeyRelatedField(
         many=True,
         queryset=Label.objects.all()
     )
+    status = ImageStatusField(required=False)
 
     class Meta:
         model = Image
         fields = (
-            'id', 'title', 'status', 'date', 'labels', 'patient_info'
-            )
-        read_only_fields = ('id',)
+            'id', 'title', 'status', 'version', 'date', 'labels',
+            'patient_info'
+            ) + IMAGE_METADATA_FIELDS + IMAGE_STATS_FIELDS
+        read_only_fields = (
+            ('id', 'version') + IMAGE_METADATA_FIELDS + IMAGE_STATS_FIELDS
+        )
 
 
 class ImageDetailSerializer(ImageSerializer):
     """Serialize an image detail"""
     patient_info = PatientInfoSerializer(many=True, read_only=True)
     labels = LabelSerializer(many=True, read_only=True)
+    histogram = HistogramField(read_only=True)
+
+    class Meta(ImageSerializer.Meta):
+        fields = ImageSerializer.Meta.fields + ('histogram',)
+
+
+DIRECT_UPLOAD_SALT = 'image.direct-upload'
+UPLOAD_COMPLETED = 'This upload is already complete.'
 
 
-class ImageUploadSerializer(serializers.ModelSerializer):
+def upload_token(image, name):
+    """Return the token that completes a presigned upload to name"""
+    return signing.dumps(
+        {'image': image.id, 'name': name}, salt=DIRECT_UPLOAD_SALT
+    )
+
+
+def replaced_file(image):
+    """Return the file names and tiles version a new upload replaces"""
+    return (
+        [field.name for field in (image.image_file, image.preview_file)
+         if field],
+        image.tiles_status and tiles_version(image.checksum),
+    )
+
+
+class ImageUploadSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
     """Serializer for uploading images """
+    image_file = ImageUploadField()
+    generate_tiles = serializers.BooleanField(
+        write_only=True, required=False, default=False
+    )
 
     class Meta:
         model = Image
-        fields = ('id', 'image_file')
-        read_only_fields = ('id',)
+        fields = (
+            'id', 'image_file', 'generate_tiles'
+            ) + IMAGE_METADATA_FIELDS
+        read_only_fields = ('id',) + IMAGE_METADATA_FIELDS
+
+    def validate(self, attrs):
+        """Hold images that get no tiles to the plain pixel limit"""
+        image_file = attrs.get('image_file')
+        if image_file and not attrs.get('generate_tiles'):
+            try:
+                uploads.inspect_file(image_file)
+            except uploads.UploadRejected as exc:
+                raise serializers.ValidationError({'image_file': [str(exc)]})
+        return attrs
+
+    def update(self, instance, validated_data):
+        """Store the file along with the metadata read from its header"""
+        generate_tiles = validated_data.pop('generate_tiles', False)
+        validated_data['tiles_status'] = (
+            Image.TILES_PENDING if generate_tiles else ''
+        )
+        image_file = validated_data.get('image_file')
+        if image_file:
+            metadata, patient = extract_metadata(image_file)
+            validated_data.update(metadata, preview_file=None)
+        replaced = replaced_file(instance)
+        instance = super().update(instance, validated_data)
+        if image_file:
+            dicom.link_patient(instance, patient)
+            cleanup.delete_replaced_later(instance, *replaced)
+        return instance
+
+
+class DirectUploadSerializer(serializers.Serializer):
+    """Request of a presigned upload; the name gives the extension"""
+    filename = serializers.CharField(max_length=255)
+
+
+class CompleteUploadSerializer(serializers.Serializer):
+    """Token of a finished presigned upload, naming the uploaded file"""
+    token = serializers.CharField()
+    generate_tiles = serializers.BooleanField(required=False, default=False)
+
+    def validate_token(self, value):
+        image = self.context['image']
+        try:
+            claim = signing.loads(
+                value,
+                salt=DIRECT_UPLOAD_SALT,
+                # An upload started just before its URL expired may take
+                # about as long again to finish
+                max_age=2 * settings.S3_UPLOAD_EXPIRES_SECONDS,
+            )
+        except signing.BadSignature:
+            raise serializers.ValidationError('Invalid or expired token.')
+        if claim['image'] != image.id:
+            raise serializers.ValidationError('Token of another image.')
+        if claim['name'] == image.image_file.name:
+            # A retry; the file must not count as replaced by itself
+            raise serializers.ValidationError(UPLOAD_COMPLETED)
+        return claim['name']
+
+
+class AnnotationSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
+    """Serializer for region annotations.
+
+    The label is a plain id so that bulk writes can check every label of
+    a request with one query, in the view.
+    """
+    label = serializers.IntegerField(source='label_id')
+    kind = NamedChoiceField(Annotation.KIND_NAMES)
+    points = PointsField()
+
+    class Meta:
+        model = Annotation
+        fields = (
+            'id', 'label', 'kind', 'points', 'x_min', 'y_min', 'x_max',
+            'y_max', 'area'
+        )
+        read_only_fields = (
+            'id', 'x_min', 'y_min', 'x_max', 'y_max', 'area'
+        )
+
+    def validate(self, attrs):
+        count = len(attrs['points'])
+        if attrs['kind'] == Annotation.BOX and count != 2:
+            raise serializers.ValidationError(
+                {'points': 'A box takes two opposite corners.'}
+            )
+        if attrs['kind'] == Annotation.POLYGON and count < 3:
+            raise serializers.ValidationError(
+                {'points': 'A polygon takes at least three points.'}
+            )
+        return attrs
+
+
+class StatusTransitionSerializer(serializers.Serializer):
+    """Move one image to a status, if it is still at the given version"""
+    id = serializers.IntegerField()
+    version = serializers.IntegerField(min_value=1)
+    status = ImageStatusField()
+
+
+class LeaseRequestSerializer(serializers.Serializer):
+    """How many images to lease from the work queue, and for how long"""
+    size = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.IMAGE_LEASE_BATCH_MAX,
+        default=settings.IMAGE_LEASE_BATCH_SIZE,
+    )
+    lease_seconds = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.IMAGE_LEASE_MAX_SECONDS,
+        default=settings.IMAGE_LEASE_SECONDS,
+    )
+
+
+class DerivativeParamsSerializer(serializers.Serializer):
+    """Validate derivative parameters against the configured allow-lists"""
+    width = serializers.ChoiceField(
+        choices=settings.IMAGE_DERIVATIVE_SIZES, required=False
+    )
+    height = serializers.ChoiceField(
+        choices=settings.IMAGE_DERIVATIVE_SIZES, required=False
+    )
+    # ?format= is taken by DRF's renderer override
+    file_format = serializers.ChoiceField(
+        choices=settings.IMAGE_DERIVATIVE_FORMATS, default='jpeg'
+    )
+    quality = serializers.ChoiceField(
+        choices=settings.IMAGE_DERIVATIVE_QUALITIES, default=85
+    )
+
+    def validate(self, attrs):
+        if not attrs.get('width') and not attrs.get('height'):
+            raise serializers.ValidationError(
+                'A width or a height is required.'
+            )
+        return attrs
+
+
+class JobSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
+    """Serializer for the status of background jobs"""
+    result = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = (
+            'id', 'kind', 'status', 'progress', 'attempts', 'max_attempts',
+            'result', 'error', 'created', 'updated'
+        )
+        read_only_fields = fields
+
+    def get_result(self, obj):
+        return json.loads(obj.result) if obj.result else None
@@ -0,0 +1,75 @@
+import numpy as np
+
+from PIL import Image as PILImage
+
+
+# Longest side the statistics are computed at
+STATS_SIZE = 256
+HISTOGRAM_BINS = 32
+# Levels counted as over-exposed, out of 0-255
+OVEREXPOSED_LEVEL = 250
+# Width in levels of the band whose share of the pixels is the blankness
+BLANK_BAND = 8
+# 16 bit modes are scaled down by their full range, not their content
+WIDE_MODES = {'I;16': 65535, 'I;16B': 65535, 'I;16L': 65535}
+
+
+def grayscale(fp):
+    """Return a downsampled grayscale uint8 array of an image file.
+
+    draft() lets the JPEG decoder scale down while decoding; what is left
+    is subsampled with a strided view, which costs nothing. 16 bit and
+    float scans keep their dynamic range instead of being clipped to 255.
+    """
+    with PILImage.open(fp) as img:
+        img.draft('L', (STATS_SIZE, STATS_SIZE))
+        if img.mode in WIDE_MODES or img.mode in ('I', 'F'):
+            values = np.asarray(img, dtype=np.float32)
+            full = WIDE_MODES.get(img.mode) or max(float(values.max()), 1.0)
+            pixels = (np.clip(values, 0, full) * (255 / full)).astype(
+                np.uint8
+            )
+        else:
+            pixels = np.asarray(img.convert('L'), dtype=np.uint8)
+    step = max(1, -(-max(pixels.shape) // STATS_SIZE))
+    return pixels[::step, ::step]
+
+
+def pixel_stats(fp):
+    """Return the Image column values describing an image's exposure.
+
+    Everything is derived from one 256 level histogram of the downsampled
+    pixels, with intensities scaled to 0-1:
+
+    - intensity_mean, intensity_std
+    - contrast: spread between the 1st and 99th percentile
+    - overexposed: share of the pixels at OVEREXPOSED_LEVEL or above
+    - blankness: largest share of the pixels within BLANK_BAND levels,
+      1 for a uniform image
+    - histogram: HISTOGRAM_BINS shares as little-endian float32
+    """
+    counts = np.bincount(grayscale(fp).ravel(), minlength=256).astype(
+        np.float64
+    )
+    total = counts.sum()
+    shares = counts / total
+    levels = np.arange(256) / 255
+    mean = shares @ levels
+    std = np.sqrt(shares @ (levels - mean) ** 2)
+    low, high = np.searchsorted(np.cumsum(shares), [0.01, 0.99])
+    blankness = np.convolve(shares, np.ones(BLANK_BAND), 'valid').max()
+    histogram = shares.reshape(HISTOGRAM_BINS, -1).sum(axis=1)
+
+    return {
+        'intensity_mean': float(mean),
+        'intensity_std': float(std),
+        'contrast': float(min(high, 255) - low) / 255,
+        'overexposed': float(shares[OVEREXPOSED_LEVEL:].sum()),
+        'blankness': float(min(blankness, 1.0)),
+        'histogram': histogram.astype('<f4').tobytes(),
+    }
+
+
+def unpack_histogram(data):
+    """Return the shares packed by pixel_stats()"""
+    return np.frombuffer(bytes(data), dtype='<f4').tolist()
@@ -0,0 +1,162 @@
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import BigIntegerField
+from django.db.models.functions import Cast, Coalesce
+
+from core import cleanup, jobs
+from core.models import (
+    DICOM_FORMAT,
+    ChangeLog,
+    Image,
+    record_changes,
+    update_image,
+)
+
+from image import dicom, embeddings, metadata, phash, stats, tiles
+
+
+# The columns a job needs to find the file to decode, see pixel_file,
+# and to log the change of the image
+PIXEL_FILE_FIELDS = ('user_id', 'image_file', 'preview_file', 'format')
+
+
+@jobs.register('image.compute_phash')
+def compute_phash(image_id):
+    """Store the perceptual hash of an image's file"""
+    image = Image.objects.filter(id=image_id).only(*PIXEL_FILE_FIELDS).first()
+    if image is None or not image.pixel_file:
+        return
+    with image.pixel_file.open('rb') as image_file:
+        value = phash.dhash(image_file)
+    update_image(image, **phash.hash_fields(value))
+
+
+@jobs.register('image.compute_stats')
+def compute_stats(image_id):
+    """Store the exposure statistics of an image's file"""
+    image = Image.objects.filter(id=image_id).only(*PIXEL_FILE_FIELDS).first()
+    if image is None or not image.pixel_file:
+        return
+    with image.pixel_file.open('rb') as image_file:
+        values = stats.pixel_stats(image_file)
+    update_image(image, **values)
+
+
+@jobs.register('image.compute_embedding')
+def compute_embedding(image_id):
+    """Store the embedding of an image's file.
+
+    The update is logged as a change of the image, which is also how the
+    in-memory embedding indexes learn about it.
+    """
+    image = Image.objects.filter(id=image_id).only(*PIXEL_FILE_FIELDS).first()
+    if image is None or not image.pixel_file:
+        return
+    with image.pixel_file.open('rb') as image_file:
+        vector = embeddings.embed(image_file)
+    update_image(image, embedding=embeddings.pack(vector))
+
+
+@jobs.register('image.extract_metadata')
+def extract_metadata(image_id, name, replaced=(), replaced_tiles=''):
+    """Store the metadata of a file uploaded straight to storage.
+
+    Reading the whole file for its checksum is left to this job so that
+    completing a direct upload stays quick; the jobs of process_upload and
+    the deletion of the replaced files follow once it is done.
+    """
+    image = Image.objects.filter(id=image_id, image_file=name).first()
+    if image is None:
+        # Deleted, or given another file since
+        return
+    with image.image_file.open('rb') as image_file:
+        values, patient = metadata.extract_metadata(image_file)
+    with transaction.atomic():
+        update_image(image, **values)
+        for field, value in values.items():
+            setattr(image, field, value)
+        dicom.link_patient(image, patient)
+        cleanup.delete_replaced_later(
+            image, [old for old in replaced if old != name], replaced_tiles
+        )
+        process_upload(image)
+
+
+@jobs.register('image.render_preview')
+def render_preview(image_id):
+    """Store the 8 bit preview that the pixels of a DICOM file are read
+    from, then queue the rest of the work on the upload
+    """
+    image = Image.objects.filter(id=image_id).first()
+    if image is None or image.format != DICOM_FORMAT:
+        return
+    name = image.image_file.name
+    with image.image_file.open('rb') as image_file:
+        preview = dicom.render_preview(image_file)
+    buffer = BytesIO()
+    preview.save(buffer, 'PNG')
+    preview_name = default_storage.save(
+        dicom.preview_name(name), ContentFile(buffer.getvalue())
+    )
+    with transaction.atomic():
+        if not Image.objects.filter(id=image_id, image_file=name).update(
+            preview_file=preview_name
+        ):
+            # Given another file meanwhile
+            default_storage.delete(preview_name)
+            return
+        record_changes(image.user_id, 'image', [image_id], ChangeLog.UPDATE)
+        image.preview_file.name = preview_name
+        process_upload(image)
+
+
+@jobs.register('image.generate_tiles')
+def generate_tiles(image_id):
+    """Build the deep zoom tile pyramid of an image"""
+    tiles.generate_tiles(image_id, progress=jobs.report_progress)
+
+
+def decodable(queryset):
+    """Return the images of queryset with a file the jobs of
+    process_upload may decode whole, those within IMAGE_UPLOAD_MAX_PIXELS
+    """
+    return queryset.exclude(image_file='').exclude(
+        image_file__isnull=True
+    ).annotate(pixels=(
+        Cast(Coalesce('width', 0), BigIntegerField())
+        * Cast(Coalesce('height', 0), BigIntegerField())
+    )).filter(pixels__lte=settings.IMAGE_UPLOAD_MAX_PIXELS)
+
+
+def process_upload(image):
+    """Queue the background jobs that follow a file upload.
+
+    DICOM files first get a preview; its job calls this again to queue
+    the rest. Images over IMAGE_UPLOAD_MAX_PIXELS, only accepted with
+    tiles, get nothing but their tiles: the other jobs decode the whole
+    image.
+    """
+    if image.format == DICOM_FORMAT and not image.preview_file:
+        jobs.enqueue(
+            'image.render_preview', user=image.user, image_id=image.id
+        )
+        return
+    pixels = (image.width or 0) * (image.height or 0)
+    if pixels <= settings.IMAGE_UPLOAD_MAX_PIXELS:
+        jobs.enqueue(
+            'image.compute_phash', user=image.user, image_id=image.id
+        )
+        jobs.enqueue(
+            'image.compute_stats', user=image.user, image_id=image.id
+        )
+        jobs.enqueue(
+            'image.compute_embedding', user=image.user, image_id=image.id
+        )
+    if image.tiles_status == Image.TILES_PENDING:
+        jobs.enqueue(
+            'image.generate_tiles', user=image.user, image_id=image.id
+        )
@@ -0,0 +1,45 @@
+from django.test import SimpleTestCase
+
+from core.models import Annotation
+
+from image import annotations
+
+
+class AnnotationGeometryTests(SimpleTestCase):
+
+    def test_pack_round_trip(self):
+        """Test points survive packing as float32 pairs"""
+        points = [[0.5, 1.25], [10.0, -3.0], [7.75, 2.5]]
+        packed = annotations.pack(points)
+
+        self.assertEqual(len(packed), 6 * 4)
+        self.assertEqual(annotations.unpack(packed), points)
+
+    def test_polygon_area(self):
+        """Test the shoelace area ignores the winding direction"""
+        square = [[0, 0], [4, 0], [4, 4], [0, 4]]
+
+        self.assertEqual(annotations.polygon_area(square), 16)
+        self.assertEqual(annotations.polygon_area(square[::-1]), 16)
+
+    def test_build_box(self):
+        """Test a box is normalized to its min and max corners"""
+        region = annotations.build(
+            None, None, 1, Annotation.BOX, [[10, 2], [4, 8]]
+        )
+
+        self.assertEqual(
+            (region.x_min, region.y_min, region.x_max, region.y_max),
+            (4, 2, 10, 8)
+        )
+        self.assertEqual(region.area, 36)
+        self.assertEqual(annotations.unpack(region.points), [[4, 2], [10, 8]])
+
+    def test_build_polygon(self):
+        """Test a polygon keeps its points and gets its bounding box"""
+        points = [[0, 0], [6, 0], [0, 3]]
+        region = annotations.build(None, None, 1, Annotation.POLYGON, points)
+
+        self.assertEqual((region.x_max, region.y_max), (6, 3))
+        self.assertEqual(region.area, 9)
+        self.assertEqual(annotations.unpack(region.points), points)
@@ -0,0 +1,179 @@
+import math
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.urls import reverse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Annotation, Image, Label
+
+from image.serializers import AnnotationSerializer
+
+IMAGES_URL = reverse('image:image-list')
+
+
+def annotations_url(image_id):
+    """Return the annotations URL of an image"""
+    return reverse('image:image-annotations', args=[image_id])
+
+
+def box(label, x, y, size):
+    return {
+        'label': label.id,
+        'kind': 'box',
+        'points': [[x, y], [x + size, y + size]],
+    }
+
+
+class AnnotationApiTests(TestCase):
+    """Test the region annotation API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.image = Image.objects.create(user=self.user, title='Scan')
+        self.tumor = Label.objects.create(user=self.user, name='Tumor')
+        self.cyst = Label.objects.create(user=self.user, name='Cyst')
+
+    def test_bulk_create_in_constant_queries(self):
+        """Test thousands of shapes are written with a few queries"""
+        payload = [box(self.tumor, i, i, 10) for i in range(2000)]
+        fields = [f for f in Annotation._meta.concrete_fields
+                  if not f.primary_key]
+        inserts = math.ceil(len(payload) / max(
+            connection.ops.bulk_batch_size(fields, payload), 1
+        ))
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.post(
+                annotations_url(self.image.id), payload, format='json'
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        # Only the backend's own bulk_create batching adds queries
+        self.assertEqual(
+            sum('INSERT' in q['sql'] for q in queries.captured_queries),
+            inserts
+        )
+        self.assertLessEqual(len(queries) - inserts, 6)
+        self.assertEqual(res.data, {'created': 2000})
+        self.assertEqual(Annotation.objects.count(), 2000)
+
+    def test_list_annotations(self):
+        """Test shapes come back with their points, bounding box and area"""
+        polygon = {
+            'label': self.cyst.id,
+            'kind': 'polygon',
+            'points': [[0, 0], [6, 0], [0, 3]],
+        }
+        self.client.post(
+            annotations_url(self.image.id),
+            [box(self.tumor, 5, 5, 2), polygon],
+            format='json'
+        )
+
+        res = self.client.get(annotations_url(self.image.id))
+
+        self.assertEqual(len(res.data), 2)
+        self.assertEqual(res.data[0]['points'], [[5, 5], [7, 7]])
+        self.assertEqual(res.data[0]['area'], 4)
+        self.assertEqual(res.data[1]['kind'], 'polygon')
+        self.assertEqual(res.data[1]['area'], 9)
+        res = self.client.get(
+            annotations_url(self.image.id), {'label': self.cyst.id}
+        )
+        self.assertEqual([item['kind'] for item in res.data], ['polygon'])
+
+    def test_replace_and_delete(self):
+        """Test PUT replaces the shapes and DELETE removes them by label"""
+        url = annotations_url(self.image.id)
+        self.client.post(url, [box(self.tumor, 0, 0, 1)], format='json')
+        self.client.put(
+            url, [box(self.cyst, 0, 0, 1), box(self.tumor, 1, 1, 1)],
+            format='json'
+        )
+        self.assertEqual(Annotation.objects.count(), 2)
+
+        res = self.client.delete(f'{url}?label={self.cyst.id}')
+
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(
+            list(Annotation.objects.values_list('label', flat=True)),
+            [self.tumor.id]
+        )
+
+    def test_invalid_shapes(self):
+        """Test malformed shapes and other users' labels are rejected"""
+        other = Label.objects.create(
+            user=get_user_model().objects.create_user(
+                'other@testdomain.com', 'password123'
+            ),
+            name='Tumor'
+        )
+        url = annotations_url(self.image.id)
+        invalid = [
+            [box(other, 0, 0, 1)],
+            [{'label': self.tumor.id, 'kind': 'box', 'points': [[0, 0]]}],
+            [{'label': self.tumor.id, 'kind': 'polygon',
+              'points': [[0, 0], [1, 'x'], [2, 2]]}],
+            [{'label': self.tumor.id, 'kind': 'circle',
+              'points': [[0, 0], [1, 1]]}],
+            [{'label': self.tumor.id, 'kind': 'box',
+              'points': [[0, 0], [1e39, 1]]}],
+        ]
+        for payload in invalid:
+            res = self.client.post(url, payload, format='json')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Annotation.objects.exists())
+
+    @override_settings(ANNOTATIONS_BATCH_MAX=2)
+    def test_batch_limit_checked_first(self):
+        """Test oversized batches are refused before any shape is read"""
+        payload = [box(self.tumor, i, i, 1) for i in range(3)]
+
+        with mock.patch.object(
+            AnnotationSerializer, 'to_internal_value'
+        ) as validate:
+            res = self.client.post(
+                annotations_url(self.image.id), payload, format='json'
+            )
+
+        validate.assert_not_called()
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('At most 2', res.data[0])
+        self.assertFalse(Annotation.objects.exists())
+
+    def test_filter_images_by_region_size(self):
+        """Test listing images with a large enough box of a label"""
+        small = Image.objects.create(user=self.user, title='Small')
+        other_label = Image.objects.create(user=self.user, title='Cyst')
+        self.client.post(
+            annotations_url(self.image.id),
+            [box(self.tumor, 0, 0, 50), box(self.tumor, 0, 0, 60)],
+            format='json'
+        )
+        self.client.post(
+            annotations_url(small.id), [box(self.tumor, 0, 0, 5)],
+            format='json'
+        )
+        self.client.post(
+            annotations_url(other_label.id), [box(self.cyst, 0, 0, 50)],
+            format='json'
+        )
+
+        res = self.client.get(IMAGES_URL, {
+            'annotation_label': self.tumor.id,
+            'annotation_kind': 'box',
+            'min_annotation_area': 1000,
+        })
+
+        self.assertEqual([image['id'] for image in res.data], [self.image.id])
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image as PILImage
+
+from django.test import TestCase
+
+from image.derivatives import DerivativeCache, render
+
+
+class RenderTests(TestCase):
+
+    def test_render_fits_and_transcodes(self):
+        """Test derivatives keep the aspect ratio in the new format"""
+        source = BytesIO()
+        PILImage.new('RGB', (2000, 1000), (10, 20, 30)).save(source, 'JPEG')
+        source.seek(0)
+
+        content = render(source, width=256, format='webp', quality=70)
+
+        img = PILImage.open(BytesIO(content))
+        self.assertEqual(img.format, 'WEBP')
+        self.assertEqual(img.size, (256, 128))
+
+    def test_render_never_upscales(self):
+        """Test small originals keep their size"""
+        source = BytesIO()
+        PILImage.new('RGBA', (40, 30)).save(source, 'PNG')
+        source.seek(0)
+
+        img = PILImage.open(BytesIO(render(source, width=512)))
+        self.assertEqual(img.size, (40, 30))
+        self.assertEqual(img.mode, 'RGB')
+
+    def test_render_palette(self):
+        """Test palette images are reduced and re-encoded"""
+        for format in ('jpeg', 'png'):
+            with self.subTest(format=format):
+                source = BytesIO()
+                PILImage.new('P', (1024, 512), 3).save(source, 'PNG')
+                source.seek(0)
+
+                content = render(source, width=128, format=format)
+
+                self.assertEqual(
+                    PILImage.open(BytesIO(content)).size, (128, 64)
+                )
+
+
+class DerivativeCacheTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_concurrent_misses_coalesce(self):
+        """Test identical concurrent requests produce the entry once"""
+        cache = DerivativeCache(self.tmp.name, 10 ** 6)
+        calls = []
+
+        def produce():
+            calls.append(1)
+            time.sleep(0.05)
+            return b'derivative'
+
+        results = []
+
+        def request():
+            with cache.open('abcdef', 'jpeg', produce) as entry:
+                results.append(entry.read())
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b'derivative'] * 8)
+
+    def test_least_recently_used_evicted(self):
+        """Test the cache stays within its budget, dropping cold entries"""
+        cache = DerivativeCache(self.tmp.name, 250)
+        for key in ('aa01', 'bb02'):
+            cache.open(key, 'png', lambda: b'x' * 100).close()
+        old = time.time() - 60
+        os.utime(cache.path('aa01', 'png'), (old, old))
+        os.utime(cache.path('bb02', 'png'), (old - 60, old - 60))
+        # A hit makes aa01 the most recently used entry
+        cache.open('aa01', 'png', lambda: b'').close()
+
+        cache.open('cc03', 'png', lambda: b'x' * 100).close()
+
+        self.assertTrue(os.path.exists(cache.path('aa01', 'png')))
+        self.assertFalse(os.path.exists(cache.path('bb02', 'png')))
+        self.assertTrue(os.path.exists(cache.path('cc03', 'png')))
@@ -0,0 +1,304 @@
+import os
+import shutil
+import tempfile
+import warnings
+from datetime import date
+from io import BytesIO, StringIO
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Image, Job, PatientInfo
+
+from image import dicom, uploads
+
+
+def dicom_bytes(rows=30, columns=40, patient_id='P-1', name='Doe^Jane',
+                uid=None, photometric='MONOCHROME2', window=None,
+                modality='CT'):
+    """Return a CT image encoded as a DICOM file"""
+    uid = uid or generate_uid()
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.preamble = bytes(dicom.PREAMBLE)
+    dataset.SOPClassUID = CTImageStorage
+    dataset.SOPInstanceUID = uid
+    dataset.PatientID = patient_id
+    dataset.PatientName = name
+    dataset.StudyDate = '20200614'
+    dataset.Modality = modality
+    dataset.Rows, dataset.Columns = rows, columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = photometric
+    dataset.BitsAllocated = dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 0
+    if window:
+        dataset.WindowCenter, dataset.WindowWidth = window
+    dataset.PixelData = np.arange(
+        rows * columns, dtype=np.uint16
+    ).reshape(rows, columns).tobytes()
+    buffer = BytesIO()
+    try:
+        pydicom.dcmwrite(buffer, dataset, enforce_file_format=True)
+    except TypeError:
+        # pydicom < 3
+        dataset.is_little_endian, dataset.is_implicit_VR = True, False
+        pydicom.dcmwrite(buffer, dataset, write_like_original=False)
+    return buffer.getvalue()
+
+
+class HeaderTests(SimpleTestCase):
+    """Test reading DICOM headers without the pixel data"""
+
+    def test_fields(self):
+        """Test image columns and the patient are read from the header"""
+        content = dicom_bytes(uid='1.2.3.4')
+        header = dicom.read_header(BytesIO(content))
+
+        self.assertNotIn('PixelData', header)
+        self.assertEqual(dicom.image_fields(header), {
+            'width': 40, 'height': 30, 'mode': 'I;16', 'format': 'DICOM',
+            'modality': 'CT', 'sop_instance_uid': '1.2.3.4',
+            'date': date(2020, 6, 14),
+        })
+        self.assertEqual(
+            dicom.patient_fields(header),
+            {'patient_id': 'P-1', 'name': 'Jane Doe'}
+        )
+
+    def test_not_dicom(self):
+        """Test files pydicom cannot read raise ValueError"""
+        content = bytes(dicom.PREAMBLE) + dicom.MAGIC + b'\xff' * 20
+        with self.assertRaises(ValueError), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            dicom.read_header(BytesIO(content))
+
+    def test_inspect(self):
+        """Test DICOM files pass the upload checks with their dimensions"""
+        upload = SimpleUploadedFile('scan.dcm', dicom_bytes())
+
+        self.assertEqual(uploads.inspect_file(upload), ('dicom', 40, 30))
+
+    @override_settings(IMAGE_UPLOAD_MAX_PIXELS=1000)
+    def test_inspect_pixel_limit(self):
+        """Test the pixel limit applies to DICOM files"""
+        upload = SimpleUploadedFile('scan.dcm', dicom_bytes())
+
+        with self.assertRaisesMessage(uploads.UploadRejected, '40x30'):
+            uploads.inspect_file(upload)
+
+    def test_stream(self):
+        """Test DICOM files are recognized while they stream in"""
+        content = dicom_bytes()
+        inspector = uploads.StreamInspector()
+        for start in range(0, len(content), 50):
+            inspector.feed(content[start:start + 50])
+
+        self.assertEqual(inspector.result, ('dicom', None, None))
+
+
+class PreviewTests(SimpleTestCase):
+    """Test rendering DICOM pixels to 8 bits"""
+
+    def test_stretched(self):
+        """Test frames without a window span the full range"""
+        preview = dicom.render_preview(BytesIO(dicom_bytes()))
+        pixels = np.asarray(preview)
+
+        self.assertEqual(preview.mode, 'L')
+        self.assertEqual(pixels.shape, (30, 40))
+        self.assertEqual((pixels.min(), pixels.max()), (0, 255))
+
+    def test_window(self):
+        """Test the default window clips values around its center"""
+        content = dicom_bytes(window=(600, 400))
+        pixels = np.asarray(dicom.render_preview(BytesIO(content)))
+
+        self.assertEqual(pixels[0, 0], 0)
+        self.assertEqual(pixels[-1, -1], 255)
+        self.assertEqual(pixels[15, 0], 128)
+
+    def test_monochrome1_inverted(self):
+        """Test low values are rendered bright in MONOCHROME1"""
+        content = dicom_bytes(photometric='MONOCHROME1')
+        pixels = np.asarray(dicom.render_preview(BytesIO(content)))
+
+        self.assertEqual((pixels[0, 0], pixels[-1, -1]), (255, 0))
+
+
+class DicomTestCase(TestCase):
+    """Run against an empty media directory of its own"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = get_user_model().objects.create_user(
+            'test@test.com', 'testpass'
+        )
+
+
+class DicomUploadApiTests(DicomTestCase):
+    """Test uploading DICOM files"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, content, **params):
+        image = Image.objects.create(user=self.user, title='Scan')
+        upload = BytesIO(content)
+        upload.name = 'scan.dcm'
+        res = self.client.post(
+            reverse('image:image-upload-file', args=[image.id]),
+            {'image_file': upload, **params}, format='multipart'
+        )
+        image.refresh_from_db()
+        return res, image
+
+    def test_upload(self):
+        """Test the header fills in the image and links the patient"""
+        res, image = self.upload(dicom_bytes())
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['modality'], 'CT')
+        self.assertEqual((image.format, image.width), ('DICOM', 40))
+        self.assertEqual(image.date, date(2020, 6, 14))
+        patient = image.patient_info.get()
+        self.assertEqual(
+            (patient.name, patient.patient_id), ('Jane Doe', 'P-1')
+        )
+        self.assertIsNone(image.pixel_file)
+        self.assertEqual(
+            list(Job.objects.values_list('kind', flat=True)),
+            ['image.render_preview']
+        )
+
+    def test_modality_filter(self):
+        """Test modalities are stored upper case and matched in any case"""
+        with warnings.catch_warnings():
+            # pydicom warns of the lower case value, which the standard forbids
+            warnings.simplefilter('ignore')
+            content = dicom_bytes(modality='mr')
+        _, image = self.upload(content)
+        self.upload(dicom_bytes())
+
+        res = self.client.get(
+            reverse('image:image-list'), {'modality': 'Mr'}
+        )
+
+        self.assertEqual(image.modality, 'MR')
+        self.assertEqual([item['id'] for item in res.data], [image.id])
+
+    def test_patient_linked_by_id(self):
+        """Test uploads of a known patient ID link the existing patient"""
+        known = PatientInfo.objects.create(
+            user=self.user, name='J. Doe', patient_id='P-1'
+        )
+
+        _, image = self.upload(dicom_bytes(name='Doe^Jane'))
+
+        self.assertEqual(list(image.patient_info.all()), [known])
+        self.assertEqual(PatientInfo.objects.count(), 1)
+
+    @override_settings(JOBS_EAGER=True)
+    def test_preview(self):
+        """Test the preview is rendered and the usual jobs run on it"""
+        _, image = self.upload(dicom_bytes(), generate_tiles=True)
+
+        self.assertTrue(image.preview_file.name.endswith('.preview.png'))
+        self.assertEqual(image.pixel_file, image.preview_file)
+        self.assertIsNotNone(image.phash)
+        self.assertIsNotNone(image.blankness)
+        self.assertEqual(image.tiles_status, Image.TILES_READY)
+        res = self.client.get(
+            reverse('image:image-render', args=[image.id]),
+            {'width': settings.IMAGE_DERIVATIVE_SIZES[0]}
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    @override_settings(JOBS_EAGER=True)
+    def test_replaced_preview_deleted(self):
+        """Test uploading over a DICOM file removes its preview too"""
+        _, image = self.upload(dicom_bytes())
+        preview = image.preview_file.path
+        upload = BytesIO(dicom_bytes())
+        upload.name = 'scan.dcm'
+
+        self.client.post(
+            reverse('image:image-upload-file', args=[image.id]),
+            {'image_file': upload}, format='multipart'
+        )
+
+        self.assertFalse(os.path.exists(preview))
+
+
+class IngestDicomTests(DicomTestCase):
+    """Test importing a study directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.study = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.study)
+        os.makedirs(os.path.join(self.study, 'series'))
+        self.write('series/1', dicom_bytes(uid='1.1'))
+        self.write('series/2', dicom_bytes(uid='1.2', patient_id='P-2'))
+        self.write('notes.txt', b'not an image')
+
+    def write(self, name, content):
+        with open(os.path.join(self.study, name), 'wb') as fp:
+            fp.write(content)
+
+    def ingest(self):
+        out = StringIO()
+        call_command('ingest_dicom', self.study, user='test@test.com',
+                     processes=0, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_ingest(self):
+        """Test DICOM files become images and other files are skipped"""
+        out = self.ingest()
+
+        self.assertIn('Imported 2 DICOM files', out)
+        self.assertIn('1 other files', out)
+        image = Image.objects.get(sop_instance_uid='1.1')
+        self.assertEqual(image.title, os.path.join('series', '1'))
+        self.assertEqual(image.modality, 'CT')
+        self.assertEqual(
+            sorted(PatientInfo.objects.values_list('patient_id', flat=True)),
+            ['P-1', 'P-2']
+        )
+        self.assertEqual(
+            Job.objects.filter(kind='image.render_preview').count(), 2
+        )
+
+    def test_ingest_again(self):
+        """Test files imported before are skipped"""
+        self.ingest()
+        self.write('series/3', dicom_bytes(uid='1.3'))
+
+        out = self.ingest()
+
+        self.assertIn('Imported 1 DICOM files, skipped 2', out)
+        self.assertEqual(Image.objects.count(), 3)
+        self.assertEqual(PatientInfo.objects.count(), 2)
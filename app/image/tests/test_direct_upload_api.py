@@ -0,0 +1,160 @@
+import json
+
+import requests
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Image, Job
+from core.tests.test_storage import S3TestMixin
+
+from image.tests.test_uploads import bomb_png, encode
+
+
+class DirectUploadApiTests(S3TestMixin, TestCase):
+    """Test uploading files straight to the bucket"""
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'test@test.com', 'testpass'
+        )
+        self.client.force_authenticate(self.user)
+        self.image = Image.objects.create(user=self.user, title='Scan')
+
+    def url(self, name):
+        return reverse(f'image:image-{name}', args=[self.image.id])
+
+    def upload(self, content, filename='scan.jpg'):
+        """Upload through a presigned form; return the token"""
+        res = self.client.post(
+            self.url('upload-url'), {'filename': filename}
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        posted = requests.post(
+            res.data['url'], data=res.data['fields'],
+            files={'file': (filename, content)},
+        )
+        self.assertLess(posted.status_code, 300)
+        return res.data['token']
+
+    def complete(self, token, **params):
+        return self.client.post(
+            self.url('complete-upload'), {'token': token, **params}
+        )
+
+    @override_settings(JOBS_EAGER=True)
+    def test_upload(self):
+        """Test the file is attached and its metadata read by a job"""
+        content = encode('JPEG', size=(64, 48))
+        token = self.upload(content)
+
+        res = self.complete(token)
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual((self.image.width, self.image.height), (64, 48))
+        self.assertEqual(self.image.byte_size, len(content))
+        self.assertEqual(len(self.image.checksum), 64)
+        self.assertEqual(self.image.mode, 'RGB')
+        self.assertIsNotNone(self.image.phash)
+        with self.image.image_file.open() as stored:
+            self.assertEqual(stored.read(), content)
+
+    def test_replaced_file_deleted_after_metadata(self):
+        """Test the old file is queued for deletion by the metadata job"""
+        self.image.image_file.save('old.png', ContentFile(encode('PNG')))
+        old_name = self.image.image_file.name
+
+        res = self.complete(self.upload(encode('PNG'), 'new.png'))
+
+        job = Job.objects.get(kind='image.extract_metadata')
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(json.loads(job.payload)['replaced'], [old_name])
+        self.assertFalse(Job.objects.filter(kind='core.delete_files'))
+
+    @override_settings(JOBS_EAGER=True)
+    def test_retry_keeps_file(self):
+        """Test completing the same upload twice leaves the file in place"""
+        token = self.upload(encode('PNG'), 'scan.png')
+        self.assertEqual(
+            self.complete(token).status_code, status.HTTP_202_ACCEPTED
+        )
+
+        res = self.complete(token)
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('already complete', res.data['token'][0])
+        self.assertTrue(self.storage.exists(self.image.image_file.name))
+        self.assertEqual(len(self.image.checksum), 64)
+
+    def test_bomb_rejected_and_deleted(self):
+        """Test a decompression bomb is refused and removed from storage"""
+        token = self.upload(bomb_png(100000, 100000), 'bomb.png')
+        name, _ = next(self.storage.scan('uploads/image/'))
+
+        res = self.complete(token)
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('100000x100000', res.data['image_file'][0])
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(self.image.image_file)
+
+    def test_nothing_uploaded(self):
+        """Test completing an upload that never happened is refused"""
+        res = self.client.post(
+            self.url('upload-url'), {'filename': 'scan.png'}
+        )
+
+        res = self.complete(res.data['token'])
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('token', res.data)
+
+    def test_token_of_another_image(self):
+        """Test a token only completes the upload of its own image"""
+        token = self.upload(encode('PNG'), 'scan.png')
+        self.image = Image.objects.create(user=self.user, title='Other')
+
+        res = self.complete(token)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('token', res.data)
+
+    def test_download_url(self):
+        """Test the download URL is presigned"""
+        self.image.image_file.save('scan.png', ContentFile(b'png'))
+
+        res = self.client.get(self.url('download-url'))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(self.image.image_file.name, res.data['url'])
+        self.assertIn('Signature', res.data['url'])
+
+
+class LocalStorageTests(TestCase):
+    """Test direct uploads need object storage"""
+
+    def test_not_implemented(self):
+        """Test upload URLs are refused without a bucket"""
+        client = APIClient()
+        user = get_user_model().objects.create_user(
+            'test@test.com', 'testpass'
+        )
+        client.force_authenticate(user)
+        image = Image.objects.create(user=user, title='Scan')
+
+        res = client.post(
+            reverse('image:image-upload-url', args=[image.id]),
+            {'filename': 'scan.png'}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_501_NOT_IMPLEMENTED)
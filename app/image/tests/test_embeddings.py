@@ -0,0 +1,173 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image as PILImage
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Image, Label
+
+from image import embeddings
+
+
+def png(color, size=(64, 48)):
+    buffer = BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+def unit(*values):
+    """Return a unit embedding pointing along the given leading values"""
+    vector = np.zeros(embeddings.DIMENSIONS, dtype=np.float32)
+    vector[:len(values)] = values
+    return embeddings.pack(vector / np.linalg.norm(vector))
+
+
+def suggest_url(image_id):
+    return reverse('image:image-suggest-labels', args=[image_id])
+
+
+class EmbedTests(SimpleTestCase):
+
+    def test_unit_vector(self):
+        """Test embeddings are unit float32 vectors"""
+        vector = embeddings.embed(png((200, 30, 30)))
+
+        self.assertEqual(vector.shape, (embeddings.DIMENSIONS,))
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertAlmostEqual(float(np.linalg.norm(vector)), 1.0, places=5)
+        self.assertTrue(np.array_equal(
+            embeddings.unpack(embeddings.pack(vector)), vector
+        ))
+
+    def test_similar_images_are_closer(self):
+        """Test similar colors score higher than different ones"""
+        red = embeddings.embed(png((200, 30, 30)))
+        darker_red = embeddings.embed(png((190, 20, 25), size=(40, 40)))
+        blue = embeddings.embed(png((20, 40, 210)))
+
+        self.assertGreater(red @ darker_red, red @ blue)
+
+
+class EmbeddingIndexTests(TestCase):
+
+    def setUp(self):
+        embeddings._indexes.clear()
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        self.label = Label.objects.create(user=self.user, name='Chest')
+
+    def image(self, embedding, labelled=True):
+        image = Image.objects.create(
+            user=self.user, title='Scan', embedding=embedding
+        )
+        if labelled:
+            image.labels.add(self.label)
+        return image
+
+    def nearest(self, query, k=3, exclude=()):
+        index = embeddings.get_index(self.user.id)
+        return [image_id for image_id, _ in index.nearest(
+            embeddings.unpack(query), k, exclude
+        )[0]]
+
+    def test_nearest_labelled_images(self):
+        """Test only labelled images are returned, most similar first"""
+        far = self.image(unit(0, 1))
+        near = self.image(unit(1, 0.1))
+        self.image(unit(1, 0), labelled=False)
+        query = self.image(unit(1, 0))
+
+        self.assertEqual(
+            self.nearest(unit(1, 0), exclude=[query.id]), [near.id, far.id]
+        )
+
+    def test_incremental_refresh(self):
+        """Test later changes reach the index without reloading it"""
+        first = self.image(unit(1, 0))
+        self.assertEqual(self.nearest(unit(1, 0)), [first.id])
+        index = embeddings.get_index(self.user.id)
+
+        second = self.image(unit(0, 1))
+        unlabelled = self.image(unit(1, 1), labelled=False)
+        unlabelled.labels.add(self.label)
+        first.delete()
+        with self.assertNumQueries(2):
+            result = self.nearest(unit(1, 0))
+
+        self.assertIs(embeddings.get_index(self.user.id), index)
+        self.assertEqual(result, [unlabelled.id, second.id])
+        with self.assertNumQueries(1):
+            self.nearest(unit(1, 0))
+
+    def test_batched_queries(self):
+        """Test several queries are answered with one matrix product"""
+        a = self.image(unit(1, 0))
+        b = self.image(unit(0, 1))
+        index = embeddings.get_index(self.user.id)
+
+        results = index.nearest(
+            np.stack([embeddings.unpack(unit(1, 0)),
+                      embeddings.unpack(unit(0, 1))]), 1
+        )
+
+        self.assertEqual([r[0][0] for r in results], [a.id, b.id])
+
+
+class SuggestLabelsApiTests(TestCase):
+
+    def setUp(self):
+        embeddings._indexes.clear()
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_suggest_most_common_labels(self):
+        """Test labels are ranked by how many neighbours carry them"""
+        chest = Label.objects.create(user=self.user, name='Chest')
+        nodule = Label.objects.create(user=self.user, name='Nodule')
+        knee = Label.objects.create(user=self.user, name='Knee')
+        for i, labels in enumerate([[chest, nodule], [chest], [knee]]):
+            image = Image.objects.create(
+                user=self.user, title=str(i), embedding=unit(1, i * 0.1)
+            )
+            image.labels.add(*labels)
+        Image.objects.create(user=self.user, title='Far', embedding=unit(0, 1))
+        query = Image.objects.create(user=self.user, title='Query',
+                                     embedding=unit(1, 0))
+
+        res = self.client.get(suggest_url(query.id), {'k': 3})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(label['name'], label['count']) for label in res.data['labels']],
+            [('Chest', 2), ('Nodule', 1), ('Knee', 1)]
+        )
+        self.assertEqual(len(res.data['neighbours']), 3)
+        self.assertEqual(res.data['labels'][0]['score'], round(2 / 3, 4))
+
+    def test_embedding_not_computed(self):
+        """Test suggestions wait for the embedding"""
+        image = Image.objects.create(user=self.user, title='Scan')
+
+        res = self.client.get(suggest_url(image.id))
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+    def test_invalid_k(self):
+        """Test the number of neighbours is bounded"""
+        image = Image.objects.create(user=self.user, title='Scan',
+                                     embedding=unit(1))
+
+        res = self.client.get(suggest_url(image.id), {'k': 0})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,105 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from core import pubsub
+from core.models import Image, Label
+
+EVENTS_URL = reverse('image:events')
+
+
+def read_events(response):
+    """Return the events and comments of a finished stream"""
+    body = b''.join(response.streaming_content).decode()
+    return [chunk for chunk in body.split('\n\n') if chunk]
+
+
+class PublicEventsApiTests(TestCase):
+    """Test the publicly available events API"""
+
+    def test_login_required(self):
+        """Test that login is required to stream events"""
+        res = APIClient().get(EVENTS_URL, HTTP_ACCEPT='text/event-stream')
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertTrue(res.content.startswith(b'event: error\n'))
+
+
+@override_settings(EVENTS_HEARTBEAT_SECONDS=0.05, EVENTS_MAX_SECONDS=0.2)
+class PrivateEventsApiTests(TestCase):
+    """Test the authorized user events API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'password123'
+        )
+        self.client = APIClient()
+
+    def test_stream_user_events(self):
+        """Test events published for the user are streamed"""
+        token = Token.objects.create(user=self.user)
+        res = self.client.get(EVENTS_URL, {'token': token.key})
+        broker = pubsub.get_broker()
+        broker.publish(pubsub.user_channel(self.user.id + 1), {'x': 1})
+        event = {'seq': 7, 'model': 'image', 'id': 3, 'changed': ['labels']}
+        broker.publish(pubsub.user_channel(self.user.id), event)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'text/event-stream')
+        chunks = read_events(res)
+        self.assertEqual(chunks[0], ': connected')
+        self.assertEqual(
+            chunks[1], f'id: 7\nevent: image\ndata: {json.dumps(event)}'
+        )
+        self.assertIn(': keep-alive', chunks[2:])
+
+    def test_invalid_token(self):
+        """Test a wrong query token is rejected"""
+        res = self.client.get(EVENTS_URL, {'token': 'wrong'})
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ImageChangeEventTests(TransactionTestCase):
+    """Test image changes are published once committed"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'password123'
+        )
+        self.image = Image.objects.create(
+            user=self.user, title='Scan', status=Image.NEW
+        )
+        self.subscription = pubsub.get_broker().subscribe(
+            pubsub.user_channel(self.user.id)
+        )
+        self.addCleanup(self.subscription.close)
+
+    def test_label_changes_published(self):
+        """Test adding a label publishes an image event"""
+        label = Label.objects.create(user=self.user, name='Chest')
+        self.image.labels.add(label)
+
+        event = self.subscription.get(timeout=0)
+        self.assertEqual(event['id'], self.image.id)
+        self.assertEqual(event['changed'], ['labels'])
+
+    def test_status_changes_published(self):
+        """Test only saves that change the status publish an event"""
+        self.image.title = 'Renamed'
+        self.image.save()
+        self.assertIsNone(self.subscription.get(timeout=0))
+
+        self.image.status = Image.REVIEWED
+        self.image.save()
+
+        event = self.subscription.get(timeout=0)
+        self.assertEqual(event['changed'], ['status'])
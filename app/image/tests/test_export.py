@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+import numpy as np
+from PIL import Image as PILImage
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+
+from core.models import Image, Label
+
+from image import export
+
+
+def png(size, color):
+    buffer = BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, format='PNG')
+    return ContentFile(buffer.getvalue())
+
+
+class ExportTrainingSetTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.out = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings.enable()
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        self.lung = Label.objects.create(user=self.user, name='Lung')
+        self.heart = Label.objects.create(user=self.user, name='Heart')
+        self.images = []
+        for i in range(5):
+            image = Image.objects.create(
+                user=self.user, title=f'Scan {i}', status=Image.LABELLED
+            )
+            image.image_file.save('scan.png', png((32, 16), (i * 50, 0, 0)))
+            self.images.append(image)
+        self.images[0].labels.add(self.lung)
+        self.images[3].labels.add(self.lung, self.heart)
+        # Neither labelled nor reviewed
+        Image.objects.create(user=self.user, title='New', status=Image.NEW)
+
+    def tearDown(self):
+        self.settings.disable()
+        self.media.cleanup()
+        self.out.cleanup()
+
+    def export(self, **options):
+        options = {'size': '8x16', 'shard_size': 2, 'processes': 0,
+                   **options}
+        call_command('export_training_set', self.out.name,
+                     stdout=StringIO(), **options)
+        with open(os.path.join(self.out.name, export.MANIFEST)) as fp:
+            return json.load(fp)
+
+    def test_export_shards(self):
+        """Test images are written as fixed shape shards with labels"""
+        manifest = self.export()
+
+        self.assertEqual(manifest['count'], 5)
+        self.assertEqual(
+            [shard['count'] for shard in manifest['shards']], [2, 2, 1]
+        )
+        self.assertEqual(
+            [label['id'] for label in manifest['labels']],
+            [self.lung.id, self.heart.id]
+        )
+        images, labels, ids = export.load_shard(self.out.name, 1)
+        self.assertIsInstance(images, np.memmap)
+        self.assertEqual(images.shape, (2, 8, 16, 3))
+        self.assertEqual(
+            ids.tolist(), [self.images[2].id, self.images[3].id]
+        )
+        self.assertEqual(labels.tolist(), [[0, 0], [1, 1]])
+        self.assertEqual(images[1, 4, 8].tolist(), [150, 0, 0])
+
+    def test_iter_batches(self):
+        """Test batches cover every image in export order"""
+        self.export(mode='L', size='4')
+
+        batches = list(export.iter_batches(self.out.name, 3))
+
+        self.assertEqual(
+            [image_id for _, _, ids in batches for image_id in ids],
+            [image.id for image in self.images]
+        )
+        self.assertEqual(batches[0][0].shape, (2, 4, 4, 1))
+        # Padded above and below the 2:1 image
+        self.assertEqual(batches[0][0][1, 0, 0, 0], 0)
+
+    def test_filter_by_label_subtree(self):
+        """Test --labels exports the images of the labels' subtrees"""
+        nodule = Label.objects.create(user=self.user, name='Nodule',
+                                      parent=self.lung)
+        self.images[4].labels.add(nodule)
+
+        manifest = self.export(labels=str(self.lung.id))
+
+        self.assertEqual(manifest['count'], 3)
+
+    def test_resume(self):
+        """Test a rerun only writes the shards that are not complete"""
+        manifest = self.export()
+        manifest['shards'][1]['complete'] = False
+        with open(os.path.join(self.out.name, export.MANIFEST), 'w') as fp:
+            json.dump(manifest, fp)
+        Image.objects.create(user=self.user, title='Late',
+                             status=Image.LABELLED,
+                             image_file=self.images[0].image_file.name)
+
+        with mock.patch('image.export.write_shard',
+                        wraps=export.write_shard) as write_shard:
+            manifest = self.export()
+
+        self.assertEqual(write_shard.call_count, 1)
+        self.assertEqual(write_shard.call_args[0][1], 1)
+        self.assertEqual(manifest['count'], 5)
+        self.assertTrue(all(s['complete'] for s in manifest['shards']))
+
+    def test_other_parameters_rejected(self):
+        """Test a directory cannot be resumed with another shape"""
+        self.export()
+
+        with self.assertRaises(CommandError):
+            self.export(size='32')
+
+    def test_other_filters_rejected(self):
+        """Test a directory cannot be resumed with other images selected"""
+        self.export(labels=str(self.lung.id))
+
+        with self.assertRaisesMessage(CommandError, 'other parameters'):
+            self.export(labels=str(self.heart.id))
+        with self.assertRaisesMessage(CommandError, 'other parameters'):
+            self.export(labels=str(self.lung.id), status='reviewed')
+
+        self.assertEqual(
+            self.export(labels=str(self.lung.id))['filters'],
+            {'user': None, 'status': ['labelled', 'reviewed'],
+             'labels': [self.lung.id]}
+        )
+
+    @override_settings(IMAGE_UPLOAD_MAX_PIXELS=32 * 16)
+    def test_oversized_and_bombs_skipped(self):
+        """Test images over the pixel limit are left out of the plan and
+        a decompression bomb only fails its own row
+        """
+        Image.objects.filter(id=self.images[1].id).update(
+            width=20000, height=20000
+        )
+        Image.objects.filter(id__in=[i.id for i in self.images]).exclude(
+            id=self.images[1].id
+        ).update(width=32, height=16)
+        decode = export.decode
+
+        def bomb(image_file, size, mode):
+            if image_file.name.endswith(self.images[2].image_file.name):
+                raise PILImage.DecompressionBombError('Too many pixels')
+            return decode(image_file, size, mode)
+
+        with mock.patch('image.export.decode', bomb):
+            manifest = self.export()
+
+        self.assertEqual(manifest['count'], 4)
+        self.assertEqual(
+            [shard['failed'] for shard in manifest['shards']],
+            [[self.images[2].id], []]
+        )
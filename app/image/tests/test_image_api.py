@@ -1,13 +1,28 @@
+import hashlib
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image as PILImage
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from rest_framework import status
-from rest_framework.test import APIClient
-
-from core.models import Image, Label, PatientInfo
-
+from rest_framework.test import APIClient, APIRequestFactory
+
+from core.models import (
+    ChangeLog,
+    Image,
+    Job,
+    Label,
+    PatientInfo,
+    VersionConflict,
+)
+from core.testing import QueryBudgetMixin
+
+from image import derivatives, phash
 from image.serializers import ImageSerializer, ImageDetailSerializer
 
 
@@ -29,6 +44,29 @@ def sample_patient_info(user, name='Patient1'):
     return PatientInfo.objects.create(user=user, name=name)
 
 
+def similar_url(image_id):
+    """Return the near-duplicate search URL of an image"""
+    return reverse('image:image-similar', args=[image_id])
+
+
+def tiles_url(image_id):
+    """Return the tile descriptor URL of an image"""
+    return reverse('image:image-tiles', args=[image_id])
+
+
+def tile_url(image_id, level, col, row):
+    """Return the URL of one tile of an image"""
+    return reverse('image:image-tile', args=[image_id, level, col, row])
+
+
+def render_url(image_id):
+    """Return the derivative URL of an image"""
+    return reverse('image:image-render', args=[image_id])
+
+
+STATUS_URL = reverse('image:image-status')
+
+
 def detail_url(image_id):
     """Return image detail URL"""
     return reverse('image:image-detail', args=[image_id])
@@ -38,7 +76,7 @@ def sample_image(user, **params):
     """Create and return a sample image"""
     defaults = {
         'title': 'Sample image',
-        'status': 'Sample status',
+        'status': Image.NEW,
         'date': '2020-06-14',
     }
     defaults.update(params)
@@ -59,7 +97,7 @@ class PublicImageApiTests(TestCase):
         self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
 
 
-class PrivateImageApiTests(TestCase):
+class PrivateImageApiTests(QueryBudgetMixin, TestCase):
     """Test authenticated image API access"""
 
     def setUp(self):
@@ -111,18 +149,42 @@ class PrivateImageApiTests(TestCase):
         serializer = ImageDetailSerializer(image)
         self.assertEqual(res.data, serializer.data)
 
+    def test_list_images_query_budget(self):
+        """Test listing images costs the same queries for any size"""
+        for i in range(10):
+            image = sample_image(user=self.user, title=f'Image {i}')
+            image.labels.add(sample_label(user=self.user, name=f'L{i}'))
+            image.patient_info.add(
+                sample_patient_info(user=self.user, name=f'P{i}')
+            )
+
+        with self.assertQueryBudget(3, max_repeats=1):
+            res = self.client.get(IMAGES_URL)
+
+        self.assertEqual(len(res.data), 10)
+
+    def test_image_detail_query_budget(self):
+        """Test retrieving an image detail stays within its budget"""
+        image = sample_image(user=self.user)
+        image.labels.add(sample_label(user=self.user))
+        image.patient_info.add(sample_patient_info(user=self.user))
+
+        with self.assertQueryBudget(3, max_repeats=1):
+            self.client.get(detail_url(image.id))
+
     def test_create_basic_image(self):
         """ Test creating an image"""
         payload = {
             'title': 'Test image title',
-            'status': 'Test status',
+            'status': 'in_progress',
         }
         res = self.client.post(IMAGES_URL, payload)
 
         self.assertEqual(res.status_code, status.HTTP_201_CREATED)
         image = Image.objects.get(id=res.data['id'])
-        for key in payload.keys():
-            self.assertEqual(payload[key], getattr(image, key))
+        self.assertEqual(image.title, payload['title'])
+        self.assertEqual(image.status, Image.IN_PROGRESS)
+        self.assertEqual(res.data['status'], 'in_progress')
 
     def test_create_image_with_label(self):
         """ Test creating an image with labels"""
@@ -131,7 +193,7 @@ class PrivateImageApiTests(TestCase):
         payload = {
             'title': 'Title for test image',
             'labels': [label1.id, label2.id],
-            'status': 'Test status',
+            'status': 'new',
             'date': '2020-05-14'
         }
         res = self.client.post(IMAGES_URL, payload)
@@ -143,6 +205,54 @@ class PrivateImageApiTests(TestCase):
         self.assertIn(label1, labels)
         self.assertIn(label2, labels)
 
+    def test_create_image_with_other_users_label(self):
+        """Test labels of another user cannot be attached"""
+        other = get_user_model().objects.create_user(
+            'other@testdomain.com', 'testpass'
+        )
+        label = sample_label(user=other)
+        payload = {'title': 'Scan', 'labels': [label.id]}
+
+        res = self.client.post(IMAGES_URL, payload)
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('labels', res.data)
+        self.assertFalse(Image.objects.exists())
+
+    def test_related_pks_validated_in_batches(self):
+        """Test validation costs one query per relation, not per pk"""
+        Label.objects.bulk_create(
+            Label(user=self.user, name=f'Label {i}') for i in range(200)
+        )
+        labels = Label.objects.filter(user=self.user)
+        patient = sample_patient_info(user=self.user)
+        request = APIRequestFactory().post(IMAGES_URL)
+        request.user = self.user
+        serializer = ImageSerializer(
+            data={
+                'title': 'Scan',
+                'labels': [label.id for label in labels],
+                'patient_info': [patient.id],
+            },
+            context={'request': request},
+        )
+
+        with self.assertNumQueries(2):
+            self.assertTrue(serializer.is_valid())
+        self.assertEqual(len(serializer.validated_data['labels']), 200)
+
+    def test_unknown_related_pk(self):
+        """Test a missing pk is reported like DRF does"""
+        res = self.client.post(
+            IMAGES_URL, {'title': 'Scan', 'labels': [999]}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            res.data['labels'],
+            ['Invalid pk "999" - object does not exist.']
+        )
+
     def test_create_image_with_patient_info(self):
         """ Test creating an image with patient info"""
         patient_info1 = sample_patient_info(user=self.user, name='Peter Jones')
@@ -150,7 +260,7 @@ class PrivateImageApiTests(TestCase):
         payload = {
             'title': 'Title for test image',
             'patient_info': [patient_info1.id, patient_info2.id],
-            'status': 'Test status',
+            'status': 'new',
             'date': '2020-05-14'
         }
         res = self.client.post(IMAGES_URL, payload)
@@ -185,18 +295,153 @@ class PrivateImageApiTests(TestCase):
 
         payload = {
                 'title': 'Image test title',
-                'status': 'Image status',
+                'status': 'labelled',
             }
         url = detail_url(image.id)
         self.client.put(url, payload)
 
         image.refresh_from_db()
         self.assertEqual(image.title, payload['title'])
-        self.assertEqual(image.status, payload['status'])
+        self.assertEqual(image.status, Image.LABELLED)
+        self.assertEqual(image.version, 2)
         labels = image.labels.all()
         self.assertEqual(len(labels), 0)
 
+    def test_update_with_stale_version(self):
+        """Test an update over a version changed since is refused"""
+        image = sample_image(user=self.user)
+        url = detail_url(image.id)
+        self.client.patch(url, {'title': 'First', 'version': 1})
+
+        res = self.client.patch(url, {'title': 'Second', 'version': 1})
+
+        image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res.data['detail'].code, 'version_conflict')
+        self.assertEqual((image.title, image.version), ('First', 2))
+
+    def test_concurrent_saves_conflict(self):
+        """Test a save over a row changed since it was read fails"""
+        image = sample_image(user=self.user)
+        stale = Image.objects.get(id=image.id)
+        image.title = 'First'
+        image.save()
+
+        stale.title = 'Second'
+        with self.assertRaises(VersionConflict):
+            stale.save()
 
+        image.refresh_from_db()
+        self.assertEqual((image.title, image.version), ('First', 2))
+        self.assertEqual(stale.version, 1)
+
+
+class ImageStatusTransitionTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'user@testdomain.com',
+            'testpass'
+        )
+        self.client.force_authenticate(self.user)
+
+    def test_filter_images_by_status(self):
+        """Test filtering images by status names"""
+        sample_image(user=self.user, status=Image.NEW)
+        labelled = sample_image(user=self.user, status=Image.LABELLED)
+        reviewed = sample_image(user=self.user, status=Image.REVIEWED)
+
+        res = self.client.get(IMAGES_URL, {'status': 'labelled,reviewed'})
+
+        self.assertEqual(
+            [image['id'] for image in res.data], [reviewed.id, labelled.id]
+        )
+        res = self.client.get(IMAGES_URL, {'status': 'unknown'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_transition_many_images(self):
+        """Test images at the expected version move in constant queries"""
+        images = [sample_image(user=self.user) for _ in range(10)]
+        payload = [
+            {'id': image.id, 'version': 1, 'status': 'labelled'}
+            for image in images
+        ]
+
+        # Lock, update and change log, plus savepoints
+        with self.assertNumQueries(9):
+            res = self.client.post(STATUS_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['conflicts'], [])
+        self.assertEqual(len(res.data['updated']), 10)
+        self.assertEqual(
+            set(Image.objects.values_list('status', 'version')),
+            {(Image.LABELLED, 2)}
+        )
+
+    def test_transition_conflicts(self):
+        """Test stale versions and unknown images are reported per item"""
+        fresh = sample_image(user=self.user)
+        stale = sample_image(user=self.user)
+        stale.status = Image.IN_PROGRESS
+        stale.save()
+        other = sample_image(
+            user=get_user_model().objects.create_user(
+                'other@testdomain.com', 'testpass'
+            )
+        )
+        payload = [
+            {'id': fresh.id, 'version': 1, 'status': 'reviewed'},
+            {'id': stale.id, 'version': 1, 'status': 'reviewed'},
+            {'id': other.id, 'version': 1, 'status': 'reviewed'},
+        ]
+
+        res = self.client.post(STATUS_URL, payload, format='json')
+
+        self.assertEqual(res.data['updated'], [
+            {'id': fresh.id, 'version': 2, 'status': 'reviewed'}
+        ])
+        self.assertEqual(res.data['conflicts'], [
+            {'id': stale.id, 'reason': 'version_conflict', 'version': 2,
+             'status': 'in_progress'},
+            {'id': other.id, 'reason': 'not_found'},
+        ])
+        stale.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(stale.status, Image.IN_PROGRESS)
+        self.assertEqual(other.status, Image.NEW)
+
+    def test_transition_logged_for_sync(self):
+        """Test moved images show up in the change log"""
+        image = sample_image(user=self.user)
+        payload = [{'id': image.id, 'version': 1, 'status': 'labelled'}]
+
+        self.client.post(STATUS_URL, payload, format='json')
+
+        change = ChangeLog.objects.filter(user=self.user).latest('seq')
+        self.assertEqual(
+            (change.model, change.object_id, change.action),
+            ('image', image.id, ChangeLog.UPDATE)
+        )
+
+    def test_transition_invalid_payload(self):
+        """Test invalid statuses and repeated images are rejected"""
+        image = sample_image(user=self.user)
+
+        res = self.client.post(STATUS_URL, [
+            {'id': image.id, 'version': 1, 'status': 'done'}
+        ], format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.post(STATUS_URL, [
+            {'id': image.id, 'version': 1, 'status': 'new'},
+            {'id': image.id, 'version': 1, 'status': 'labelled'},
+        ], format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'))
 class ImageUploadTests(TestCase):
 
     def setUp(self):
@@ -209,8 +454,83 @@ class ImageUploadTests(TestCase):
         self.image = sample_image(user=self.user)
 
     def tearDown(self):
+        self.image.refresh_from_db()
         self.image.image_file.delete()
 
+    @override_settings(JOBS_EAGER=True)
+    def test_upload_image_computes_phash(self):
+        """Test the perceptual hash is computed after an upload"""
+        url = image_upload_url(self.image.id)
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            PILImage.new('RGB', (32, 32), (200, 10, 10)).save(ntf, 'PNG')
+            ntf.seek(0)
+            self.client.post(url, {'image_file': ntf}, format='multipart')
+
+        self.image.refresh_from_db()
+        self.assertIsNotNone(self.image.phash)
+        self.assertEqual(
+            [self.image.phash_0, self.image.phash_1,
+             self.image.phash_2, self.image.phash_3],
+            phash.split(phash.to_unsigned(self.image.phash))
+        )
+
+    @override_settings(JOBS_EAGER=True)
+    def test_upload_image_computes_stats(self):
+        """Test the exposure statistics are computed after an upload"""
+        url = image_upload_url(self.image.id)
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            PILImage.new('L', (32, 32), 255).save(ntf, 'PNG')
+            ntf.seek(0)
+            self.client.post(url, {'image_file': ntf}, format='multipart')
+
+        res = self.client.get(detail_url(self.image.id))
+
+        self.assertEqual(res.data['blankness'], 1.0)
+        self.assertEqual(res.data['overexposed'], 1.0)
+        self.assertEqual(res.data['histogram'][-1], 1.0)
+
+    def test_upload_image_queues_jobs(self):
+        """Test an upload queues its background work for the workers"""
+        url = image_upload_url(self.image.id)
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            PILImage.new('RGB', (32, 32)).save(ntf, 'PNG')
+            ntf.seek(0)
+            self.client.post(url, {'image_file': ntf}, format='multipart')
+
+        jobs = Job.objects.order_by('id')
+        self.assertEqual(
+            [job.kind for job in jobs],
+            ['image.compute_phash', 'image.compute_stats',
+             'image.compute_embedding']
+        )
+        self.assertEqual(jobs[0].user, self.user)
+        self.assertEqual(jobs[0].status, Job.QUEUED)
+
+    def test_upload_image_to_image(self):
+        """Test uploading an image stores the file and its metadata"""
+        url = image_upload_url(self.image.id)
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            img = PILImage.new('RGB', (20, 10))
+            img.save(ntf, format='PNG')
+            ntf.seek(0)
+            content = ntf.read()
+            ntf.seek(0)
+            res = self.client.post(
+                url, {'image_file': ntf}, format='multipart'
+            )
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn('image_file', res.data)
+        self.assertEqual(self.image.width, 20)
+        self.assertEqual(self.image.height, 10)
+        self.assertEqual(self.image.mode, 'RGB')
+        self.assertEqual(self.image.format, 'PNG')
+        self.assertEqual(self.image.byte_size, len(content))
+        self.assertEqual(
+            self.image.checksum, hashlib.sha256(content).hexdigest()
+        )
+
     def test_upload_image_bad_request(self):
         """Test uploading an invalid image"""
         url = image_upload_url(self.image.id)
@@ -244,6 +564,34 @@ class ImageUploadTests(TestCase):
         self.assertIn(serializer2.data, res.data)
         self.assertNotIn(serializer3.data, res.data)
 
+    def test_filter_images_by_label_subtree(self):
+        """Test a label filter also matches the labels below it"""
+        lung = sample_label(user=self.user, name='Lung')
+        nodule = Label.objects.create(user=self.user, name='Nodule',
+                                      parent=lung)
+        small = Label.objects.create(user=self.user, name='Small',
+                                     parent=nodule)
+        heart = sample_label(user=self.user, name='Heart')
+        image1 = sample_image(user=self.user, title='Lung')
+        image1.labels.add(lung, small)
+        image2 = sample_image(user=self.user, title='Nodule')
+        image2.labels.add(small)
+        image3 = sample_image(user=self.user, title='Heart')
+        image3.labels.add(heart)
+
+        res = self.client.get(IMAGES_URL, {'labels': lung.id})
+        self.assertEqual(
+            [image['id'] for image in res.data], [image2.id, image1.id]
+        )
+
+        res = self.client.get(
+            IMAGES_URL, {'labels': f'{nodule.id},{heart.id}'}
+        )
+        self.assertEqual(
+            [image['id'] for image in res.data],
+            [image3.id, image2.id, image1.id]
+        )
+
     def test_filter_images_by_patient_info(self):
         """Test returning images with specific patient info"""
         image1 = sample_image(user=self.user, title='Title 1')
@@ -265,3 +613,242 @@ class ImageUploadTests(TestCase):
         self.assertIn(serializer1.data, res.data)
         self.assertIn(serializer2.data, res.data)
         self.assertNotIn(serializer3.data, res.data)
+
+    def test_filter_images_by_metadata(self):
+        """Test filtering images on their indexed metadata"""
+        small = sample_image(user=self.user, width=100, height=100,
+                             format='PNG')
+        large = sample_image(user=self.user, width=4000, height=3000,
+                             format='JPEG')
+
+        res = self.client.get(IMAGES_URL, {'min_width': 1000})
+        self.assertEqual([image['id'] for image in res.data], [large.id])
+
+        res = self.client.get(IMAGES_URL, {'file_format': 'png'})
+        self.assertEqual([image['id'] for image in res.data], [small.id])
+
+    def test_order_images_by_metadata(self):
+        """Test ordering images by an allowed metadata column"""
+        large = sample_image(user=self.user, width=4000)
+        small = sample_image(user=self.user, width=100)
+
+        res = self.client.get(IMAGES_URL, {'ordering': 'width'})
+        ids = [image['id'] for image in res.data]
+        self.assertLess(ids.index(small.id), ids.index(large.id))
+
+        res = self.client.get(IMAGES_URL, {'ordering': 'user'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_metadata_filter(self):
+        """Test a malformed numeric filter is rejected"""
+        res = self.client.get(IMAGES_URL, {'min_width': 'wide'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_similar_images(self):
+        """Test near-duplicates are returned nearest first"""
+        base = 0xF0F0F0F0F0F0F0F0
+        query = sample_image(user=self.user, **phash.hash_fields(base))
+        near = sample_image(user=self.user, **phash.hash_fields(base ^ 0b1))
+        nearer = sample_image(user=self.user, **phash.hash_fields(base))
+        far = sample_image(
+            user=self.user, **phash.hash_fields(base ^ (1 << 64) - 1)
+        )
+        other_user = get_user_model().objects.create_user(
+            'other@testdomain.com', 'testpass'
+        )
+        sample_image(user=other_user, **phash.hash_fields(base))
+
+        res = self.client.get(similar_url(query.id), {'distance': 4})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(item['id'], item['distance']) for item in res.data],
+            [(nearer.id, 0), (near.id, 1)]
+        )
+        self.assertNotIn(far.id, [item['id'] for item in res.data])
+
+    def test_similar_images_requires_hash(self):
+        """Test searching from an unhashed image is a conflict"""
+        res = self.client.get(similar_url(self.image.id))
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+    def test_search_images(self):
+        """Test searching by partial title, label or patient name"""
+        chest = sample_image(user=self.user, title='Chest X-Ray')
+        knee = sample_image(user=self.user, title='Knee MRI')
+        knee.labels.add(sample_label(user=self.user, name='Fracture'))
+        knee.patient_info.add(
+            sample_patient_info(user=self.user, name='Albert Jones')
+        )
+
+        def search(term):
+            res = self.client.get(IMAGES_URL, {'search': term})
+            return [image['id'] for image in res.data]
+
+        self.assertEqual(search('x-ra'), [chest.id])
+        self.assertEqual(search('fract'), [knee.id])
+        self.assertEqual(search('JONES mri'), [knee.id])
+        self.assertEqual(search('jones chest'), [])
+
+    def test_search_follows_renamed_label(self):
+        """Test the search text is refreshed when a label changes"""
+        image = sample_image(user=self.user, title='Scan')
+        label = sample_label(user=self.user, name='Benign')
+        image.labels.add(label)
+
+        label.name = 'Malignant'
+        label.save()
+
+        res = self.client.get(IMAGES_URL, {'search': 'malig'})
+        self.assertEqual([item['id'] for item in res.data], [image.id])
+
+        label.delete()
+        res = self.client.get(IMAGES_URL, {'search': 'malig'})
+        self.assertEqual(res.data, [])
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'),
+    JOBS_EAGER=True,
+    IMAGE_TILE_SIZE=16,
+)
+class ImageTileTests(TestCase):
+    """Test deep zoom tile generation and serving"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'user@testdomain.com',
+            'testpass'
+        )
+        self.client.force_authenticate(self.user)
+        self.image = sample_image(user=self.user)
+
+    def _upload(self, color=(0, 90, 200), **data):
+        url = image_upload_url(self.image.id)
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            PILImage.new('RGB', (40, 20), color).save(ntf, 'PNG')
+            ntf.seek(0)
+            data['image_file'] = ntf
+            return self.client.post(url, data, format='multipart')
+
+    def test_upload_without_tiles(self):
+        """Test tiles are only generated on request"""
+        self._upload()
+
+        res = self.client.get(tiles_url(self.image.id))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_generate_and_serve_tiles(self):
+        """Test the whole pyramid is generated and tiles are cacheable"""
+        res = self._upload(generate_tiles=True)
+        self.assertEqual(res.data['tiles_status'], 'pending')
+
+        res = self.client.get(tiles_url(self.image.id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['Image']['TileSize'], 16)
+        self.assertEqual(
+            res.data['Image']['Size'], {'Width': 40, 'Height': 20}
+        )
+
+        # Level 6 is full resolution: 3 x 2 tiles of 16px with overlap
+        res = self.client.get(tile_url(self.image.id, 6, 2, 1))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        tile = PILImage.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(tile.size, (9, 5))
+
+        res = self.client.get(tile_url(self.image.id, 0, 0, 0))
+        tile = PILImage.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(tile.size, (1, 1))
+
+        res = self.client.get(tile_url(self.image.id, 6, 3, 0))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_tile_cache_headers(self):
+        """Test tiles are immutable only under their current version"""
+        self._upload(generate_tiles=True)
+        version = self.client.get(tiles_url(self.image.id)).data['version']
+        url = tile_url(self.image.id, 6, 0, 0)
+
+        res = self.client.get(url, {'v': version})
+        self.assertIn('immutable', res['Cache-Control'])
+
+        for params in ({}, {'v': 'old'}):
+            res = self.client.get(url, params)
+            self.assertEqual(res['Cache-Control'], 'private, max-age=60')
+
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self._upload(generate_tiles=True, color=(255, 0, 0))
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=f'"{version}"')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'),
+    IMAGE_DERIVATIVE_CACHE_DIR=tempfile.mkdtemp(prefix='test-cache-'),
+)
+class ImageRenderTests(TestCase):
+    """Test serving resized and transcoded derivatives"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'user@testdomain.com',
+            'testpass'
+        )
+        self.client.force_authenticate(self.user)
+        self.image = sample_image(user=self.user)
+        with tempfile.NamedTemporaryFile(suffix='.png') as ntf:
+            PILImage.new('RGB', (800, 400), (0, 90, 200)).save(ntf, 'PNG')
+            ntf.seek(0)
+            self.client.post(
+                image_upload_url(self.image.id),
+                {'image_file': ntf},
+                format='multipart'
+            )
+
+    def test_render_derivative(self):
+        """Test a derivative is rendered with the requested parameters"""
+        res = self.client.get(
+            render_url(self.image.id), {'width': 256, 'file_format': 'webp'}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'image/webp')
+        img = PILImage.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(img.size, (256, 128))
+
+    def test_render_cache_headers(self):
+        """Test copies are immutable only under the image's current
+        version, and revalidated with their ETag otherwise
+        """
+        self.image.refresh_from_db()
+        url = render_url(self.image.id)
+
+        res = self.client.get(
+            url, {'width': 256, 'v': self.image.checksum[:16]}
+        )
+        self.assertIn('immutable', res['Cache-Control'])
+
+        res = self.client.get(url, {'width': 256})
+        self.assertEqual(res['Cache-Control'], 'private, max-age=60')
+
+        with mock.patch.object(derivatives, 'render') as render:
+            res = self.client.get(
+                url, {'width': 256}, HTTP_IF_NONE_MATCH=res['ETag']
+            )
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        render.assert_not_called()
+
+    def test_render_rejects_unlisted_parameters(self):
+        """Test only allow-listed sizes, formats and qualities are served"""
+        url = render_url(self.image.id)
+
+        for params in ({'width': 300}, {'width': 256, 'file_format': 'tiff'},
+                       {'width': 256, 'quality': 99}, {}):
+            res = self.client.get(url, params)
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,88 @@
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.test import TestCase
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Job
+
+JOBS_URL = reverse('image:job-list')
+
+
+def detail_url(job_id):
+    """Return the job detail URL"""
+    return reverse('image:job-detail', args=[job_id])
+
+
+class PublicJobsApiTests(TestCase):
+    """Test the publicly available jobs API"""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_login_required(self):
+        """Test that login is required for retrieving jobs"""
+        res = self.client.get(JOBS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PrivateJobsApiTests(TestCase):
+    """Test the authorized user jobs API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_jobs_limited_to_user(self):
+        """Test that only the authenticated user's jobs are listed"""
+        user2 = get_user_model().objects.create_user(
+            'user2@testdomain.com',
+            'password123'
+        )
+        Job.objects.create(user=user2, kind='image.compute_phash')
+        job = Job.objects.create(user=self.user, kind='image.compute_phash')
+
+        res = self.client.get(JOBS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([item['id'] for item in res.data], [job.id])
+
+    def test_filter_jobs_by_status(self):
+        """Test filtering jobs by their status"""
+        Job.objects.create(user=self.user, kind='a', status=Job.FAILED)
+        running = Job.objects.create(
+            user=self.user, kind='a', status=Job.RUNNING
+        )
+
+        res = self.client.get(JOBS_URL, {'status': Job.RUNNING})
+
+        self.assertEqual([item['id'] for item in res.data], [running.id])
+
+    def test_retrieve_job_status(self):
+        """Test a job reports its progress and decoded result"""
+        job = Job.objects.create(
+            user=self.user,
+            kind='image.generate_tiles',
+            status=Job.SUCCEEDED,
+            progress=1,
+            result='{"tiles": 21}',
+        )
+
+        res = self.client.get(detail_url(job.id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], Job.SUCCEEDED)
+        self.assertEqual(res.data['progress'], 1)
+        self.assertEqual(res.data['result'], {'tiles': 21})
+
+    def test_jobs_are_read_only(self):
+        """Test jobs cannot be created through the API"""
+        res = self.client.post(JOBS_URL, {'kind': 'image.compute_phash'})
+
+        self.assertEqual(res.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -1,11 +1,11 @@
 from django.contrib.auth import get_user_model
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from core.models import Label
+from core.models import Image, Label
 
 from image.serializers import LabelSerializer
 
@@ -64,6 +64,17 @@ class PrivateLabelsApiTests(TestCase):
         self.assertEqual(len(res.data), 1)
         self.assertEqual(res.data[0]['name'], label.name)
 
+    def test_labels_include_image_count(self):
+        """Test labels report how many images carry them"""
+        label = Label.objects.create(user=self.user, name='Heart Disease')
+        image = Image.objects.create(user=self.user, title='Scan')
+        image.labels.add(label)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(LABELS_URL)
+
+        self.assertEqual(res.data[0]['image_count'], 1)
+
     def test_create_label_successful(self):
         """ Test creating a new label is successful"""
         payload = {'name': 'New label'}
@@ -81,3 +92,91 @@ class PrivateLabelsApiTests(TestCase):
         res = self.client.post(LABELS_URL, payload)
 
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def label_url(self, label):
+        return reverse('image:label-detail', args=[label.id])
+
+    def test_create_child_label(self):
+        """Test a label created under a parent gets the parent's path"""
+        lung = Label.objects.create(user=self.user, name='Lung')
+
+        res = self.client.post(
+            LABELS_URL, {'name': 'Nodule', 'parent': lung.id}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        nodule = Label.objects.get(id=res.data['id'])
+        self.assertEqual(nodule.parent, lung)
+        self.assertEqual(nodule.path, f'/{lung.id}/{nodule.id}/')
+
+    def test_move_subtree(self):
+        """Test changing a parent rewrites the whole subtree at once"""
+        chest = Label.objects.create(user=self.user, name='Chest')
+        lung = Label.objects.create(user=self.user, name='Lung')
+        nodule = Label.objects.create(user=self.user, name='Nodule',
+                                      parent=lung)
+        for i in range(20):
+            Label.objects.create(user=self.user, name=f'Nodule {i}',
+                                 parent=nodule)
+
+        # The same for any subtree size: the paths move in one UPDATE,
+        # after the label and its parent are locked and checked again
+        with self.assertNumQueries(15):
+            res = self.client.patch(self.label_url(lung),
+                                    {'parent': chest.id})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        prefix = f'/{chest.id}/{lung.id}/{nodule.id}/'
+        self.assertEqual(
+            Label.objects.filter(path__startswith=prefix).count(), 21
+        )
+        res = self.client.patch(self.label_url(lung), {'parent': ''})
+        lung.refresh_from_db()
+        self.assertEqual(lung.path, f'/{lung.id}/')
+        self.assertEqual(
+            Label.objects.filter(path__startswith=lung.path).count(), 22
+        )
+
+    def test_move_under_own_subtree_rejected(self):
+        """Test a label cannot become its own descendant"""
+        lung = Label.objects.create(user=self.user, name='Lung')
+        nodule = Label.objects.create(user=self.user, name='Nodule',
+                                      parent=lung)
+
+        res = self.client.patch(self.label_url(lung), {'parent': nodule.id})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('parent', res.data)
+
+    def test_parent_of_other_user_rejected(self):
+        """Test labels cannot be nested under another user's label"""
+        user2 = get_user_model().objects.create_user(
+            'other@testdomain.com',
+            'testpass'
+        )
+        other = Label.objects.create(user=user2, name='Lung')
+
+        res = self.client.post(
+            LABELS_URL, {'name': 'Nodule', 'parent': other.id}
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(LABEL_MAX_DEPTH=3)
+    def test_depth_limited(self):
+        """Test moves and creates cannot nest labels too deeply"""
+        root = Label.objects.create(user=self.user, name='Root')
+        child = Label.objects.create(user=self.user, name='Child',
+                                     parent=root)
+        leaf = Label.objects.create(user=self.user, name='Leaf',
+                                    parent=child)
+        other = Label.objects.create(user=self.user, name='Other')
+
+        res = self.client.post(LABELS_URL, {'name': 'Deep', 'parent': leaf.id})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.patch(self.label_url(root), {'parent': other.id})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.patch(self.label_url(child), {'parent': other.id})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
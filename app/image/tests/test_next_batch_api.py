@@ -0,0 +1,131 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.test import TestCase
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Image, Label
+
+NEXT_BATCH_URL = reverse('image:image-next-batch')
+STATUS_URL = reverse('image:image-status')
+
+
+class NextBatchApiTests(TestCase):
+    """Test leasing images from the work queue"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.images = [
+            Image.objects.create(user=self.user, title=f'Scan {i}')
+            for i in range(5)
+        ]
+
+    def lease(self, size, url=NEXT_BATCH_URL):
+        res = self.client.post(url, {'size': size}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data
+
+    def test_batches_do_not_overlap(self):
+        """Test each batch gets the oldest images nobody holds"""
+        first = self.lease(2)
+        second = self.lease(2)
+
+        ids = [image.id for image in self.images]
+        self.assertEqual([i['id'] for i in first['images']], ids[:2])
+        self.assertEqual([i['id'] for i in second['images']], ids[2:4])
+        self.assertNotEqual(first['lease'], second['lease'])
+        self.assertEqual(
+            Image.objects.filter(lease_token=first['lease']).count(), 2
+        )
+
+    def test_only_new_images_by_default(self):
+        """Test images past new are not leased unless asked for"""
+        Image.objects.exclude(id=self.images[4].id).update(
+            status=Image.LABELLED
+        )
+
+        data = self.lease(10)
+        self.assertEqual(
+            [i['id'] for i in data['images']], [self.images[4].id]
+        )
+
+        data = self.lease(10, f'{NEXT_BATCH_URL}?status=labelled')
+        self.assertEqual(len(data['images']), 4)
+
+    def test_filter_by_label(self):
+        """Test the list filters narrow down the queue"""
+        label = Label.objects.create(user=self.user, name='Chest')
+        self.images[3].labels.add(label)
+
+        data = self.lease(10, f'{NEXT_BATCH_URL}?labels={label.id}')
+
+        self.assertEqual(
+            [i['id'] for i in data['images']], [self.images[3].id]
+        )
+
+    def test_expired_leases_are_reclaimed(self):
+        """Test images whose lease ran out go back to the queue"""
+        first = self.lease(5)
+        self.assertEqual(self.lease(5)['images'], [])
+
+        Image.objects.filter(id=self.images[1].id).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+
+        data = self.lease(5)
+        self.assertEqual(
+            [i['id'] for i in data['images']], [self.images[1].id]
+        )
+        self.assertEqual(
+            Image.objects.filter(lease_token=first['lease']).count(), 4
+        )
+
+    def test_release_lease(self):
+        """Test a batch can be handed back before it expires"""
+        data = self.lease(3)
+
+        res = self.client.delete(f'{NEXT_BATCH_URL}?lease={data["lease"]}')
+
+        self.assertEqual(res.data, {'released': 3})
+        self.assertEqual(len(self.lease(5)['images']), 5)
+
+    def test_status_transition_ends_lease(self):
+        """Test moving an image on releases it from its batch"""
+        data = self.lease(1)
+        image = data['images'][0]
+
+        self.client.post(STATUS_URL, [{
+            'id': image['id'], 'version': image['version'],
+            'status': 'in_progress',
+        }], format='json')
+
+        self.assertIsNone(Image.objects.get(id=image['id']).lease_token)
+
+    def test_leases_limited_to_user(self):
+        """Test another user's images are never leased"""
+        user2 = get_user_model().objects.create_user(
+            'other@testdomain.com',
+            'password123'
+        )
+        Image.objects.create(user=user2, title='Other')
+
+        data = self.lease(10)
+
+        self.assertEqual(len(data['images']), 5)
+
+    def test_invalid_requests(self):
+        """Test the batch size and lease token are validated"""
+        res = self.client.post(NEXT_BATCH_URL, {'size': 0}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.delete(f'{NEXT_BATCH_URL}?lease=nope')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,112 @@
+import random
+import tempfile
+from io import BytesIO, StringIO
+
+from PIL import Image as PILImage, ImageDraw
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from core.models import Image
+
+from image import phash
+
+
+def sample_png(offset=0):
+    """Return PNG bytes of a simple gradient scene"""
+    img = PILImage.new('L', (128, 128))
+    draw = ImageDraw.Draw(img)
+    for x in range(128):
+        draw.line([(x, 0), (x, 127)], fill=(x * 2 + offset) % 256)
+    draw.rectangle([30, 30, 70, 90], fill=255)
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+class PerceptualHashTests(TestCase):
+
+    def test_dhash_stable_under_small_changes(self):
+        """Test near identical images hash close together"""
+        original = phash.dhash(sample_png())
+        brighter = phash.dhash(sample_png(offset=3))
+
+        self.assertEqual(original, phash.dhash(sample_png()))
+        self.assertLessEqual(phash.distance(original, brighter), 4)
+
+    def test_signed_round_trip(self):
+        """Test hashes survive storage in a signed 64 bit column"""
+        value = (1 << 64) - 5
+        signed = phash.to_signed(value)
+
+        self.assertLess(signed, 0)
+        self.assertEqual(phash.to_unsigned(signed), value)
+        self.assertEqual(phash.distance(signed, value), 0)
+
+    def test_candidates_filter_has_full_recall(self):
+        """Test the chunk index finds every hash within the distance"""
+        user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'testpass'
+        )
+        rng = random.Random(1)
+        query = rng.getrandbits(64)
+        hashes = [rng.getrandbits(64) for _ in range(200)]
+        for flips in range(phash.MAX_DISTANCE + 1):
+            mask = 0
+            for bit in rng.sample(range(64), flips):
+                mask |= 1 << bit
+            hashes.append(query ^ mask)
+        Image.objects.bulk_create([
+            Image(user=user, title=str(i), status=Image.NEW,
+                  **phash.hash_fields(value))
+            for i, value in enumerate(hashes)
+        ])
+
+        for max_distance in (0, 3, 8, phash.MAX_DISTANCE):
+            expected = sorted(
+                value for value in hashes
+                if phash.distance(query, value) <= max_distance
+            )
+            found = sorted(
+                phash.to_unsigned(value) for value in
+                Image.objects.filter(
+                    phash.candidates_filter(query, max_distance)
+                ).values_list('phash', flat=True)
+                if phash.distance(query, value) <= max_distance
+            )
+            self.assertEqual(found, expected)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'),
+                   IMAGE_UPLOAD_MAX_PIXELS=128 * 128)
+class ComputePhashesCommandTests(TestCase):
+
+    def test_backfill_skips_and_survives(self):
+        """Test images over the pixel limit are skipped and an unreadable
+        file does not stop the backfill
+        """
+        user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        for title, content, width in (
+            ('Broken', ContentFile(b'not an image'), 128),
+            ('Scan', ContentFile(sample_png().getvalue()), 128),
+            ('Slide', ContentFile(sample_png().getvalue()), 20000),
+        ):
+            image = Image.objects.create(
+                user=user, title=title, width=width, height=128
+            )
+            image.image_file.save('scan.png', content)
+
+        out = StringIO()
+        with self.assertLogs('image', 'ERROR'):
+            call_command('compute_phashes', stdout=out)
+
+        self.assertEqual(
+            [image.phash is None for image in Image.objects.order_by('id')],
+            [True, False, True]
+        )
+        self.assertIn('Hashed 1 images, 1 failed', out.getvalue())
@@ -0,0 +1,166 @@
+import tempfile
+from io import BytesIO, StringIO
+
+import numpy as np
+from PIL import Image as PILImage
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from core.models import Image
+
+from image import stats
+
+IMAGES_URL = reverse('image:image-list')
+
+
+def encode(img, format='PNG'):
+    buffer = BytesIO()
+    img.save(buffer, format=format)
+    buffer.seek(0)
+    return buffer
+
+
+def gradient(width=512, height=64):
+    """Return an image with every gray level in equal shares"""
+    row = np.repeat(np.arange(256, dtype=np.uint8), width // 256)
+    return PILImage.fromarray(np.tile(row, (height, 1)), 'L')
+
+
+class PixelStatsTests(SimpleTestCase):
+
+    def test_blank_image(self):
+        """Test a uniform image is fully blank and has no contrast"""
+        values = stats.pixel_stats(encode(PILImage.new('L', (300, 200), 40)))
+
+        self.assertEqual(values['blankness'], 1.0)
+        self.assertEqual(values['contrast'], 0.0)
+        self.assertEqual(values['intensity_std'], 0.0)
+        self.assertAlmostEqual(values['intensity_mean'], 40 / 255)
+        self.assertEqual(values['overexposed'], 0.0)
+
+    def test_gradient_image(self):
+        """Test an even spread of levels has full contrast"""
+        values = stats.pixel_stats(encode(gradient(), 'JPEG'))
+
+        self.assertAlmostEqual(values['intensity_mean'], 0.5, places=2)
+        self.assertGreater(values['contrast'], 0.95)
+        self.assertLess(values['blankness'], 0.05)
+        self.assertAlmostEqual(values['overexposed'], 6 / 256, places=2)
+
+    def test_histogram(self):
+        """Test the packed histogram holds the shares of its bins"""
+        values = stats.pixel_stats(encode(gradient()))
+        histogram = stats.unpack_histogram(values['histogram'])
+
+        self.assertEqual(len(histogram), stats.HISTOGRAM_BINS)
+        self.assertAlmostEqual(sum(histogram), 1.0, places=5)
+        self.assertAlmostEqual(histogram[0], 1 / stats.HISTOGRAM_BINS)
+
+    def test_sixteen_bit_scan(self):
+        """Test 16 bit images keep their range instead of clipping"""
+        pixels = np.full((64, 64), 32768, dtype=np.uint16)
+        img = PILImage.fromarray(pixels, 'I;16')
+
+        values = stats.pixel_stats(encode(img))
+
+        self.assertAlmostEqual(values['intensity_mean'], 0.5, places=2)
+
+    def test_large_image_is_downsampled(self):
+        """Test statistics are computed on at most STATS_SIZE pixels a side"""
+        pixels = stats.grayscale(encode(PILImage.new('L', (2000, 1000))))
+
+        self.assertLessEqual(max(pixels.shape), stats.STATS_SIZE)
+
+
+class PixelStatsApiTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_filter_and_order_by_stats(self):
+        """Test images can be filtered and sorted by their statistics"""
+        blank = Image.objects.create(user=self.user, title='Blank',
+                                     blankness=0.98, contrast=0.01)
+        dim = Image.objects.create(user=self.user, title='Dim',
+                                   blankness=0.4, contrast=0.2)
+        good = Image.objects.create(user=self.user, title='Good',
+                                    blankness=0.1, contrast=0.9)
+        Image.objects.create(user=self.user, title='Not computed')
+
+        res = self.client.get(IMAGES_URL, {'max_blankness': '0.5',
+                                           'ordering': 'contrast'})
+
+        self.assertEqual([i['id'] for i in res.data], [dim.id, good.id])
+        res = self.client.get(IMAGES_URL, {'min_blankness': '0.9'})
+        self.assertEqual([i['id'] for i in res.data], [blank.id])
+        self.assertEqual(res.data[0]['contrast'], 0.01)
+
+    def test_invalid_bound(self):
+        """Test the statistic bounds must be numbers"""
+        res = self.client.get(IMAGES_URL, {'min_contrast': 'high'})
+
+        self.assertEqual(res.status_code, 400)
+
+
+class ComputeImageStatsCommandTests(TestCase):
+
+    def test_backfill(self):
+        """Test images without statistics get them"""
+        user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        image = Image.objects.create(user=user, title='Scan')
+        image.image_file.save('scan.png', encode(PILImage.new('L', (8, 8))))
+        self.addCleanup(image.image_file.delete)
+        Image.objects.create(user=user, title='No file')
+
+        out = StringIO()
+        call_command('compute_image_stats', processes=0, stdout=out)
+
+        image.refresh_from_db()
+        self.assertEqual(image.blankness, 1.0)
+        self.assertIn('Computed statistics of 1 images', out.getvalue())
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'),
+                       IMAGE_UPLOAD_MAX_PIXELS=100)
+    def test_backfill_skips_and_survives(self):
+        """Test images over the pixel limit are skipped and an unreadable
+        file does not stop the backfill
+        """
+        user = get_user_model().objects.create_user(
+            'test@testdomain.com', 'password123'
+        )
+        images = []
+        for title, content, size in (
+            ('Broken', ContentFile(b'not an image'), (8, 8)),
+            ('Scan', encode(PILImage.new('L', (8, 8))), (8, 8)),
+            ('Slide', encode(PILImage.new('L', (8, 8))), (20000, 20000)),
+        ):
+            image = Image.objects.create(
+                user=user, title=title, width=size[0], height=size[1]
+            )
+            image.image_file.save('scan.png', content)
+            images.append(image)
+
+        out = StringIO()
+        with self.assertLogs('image', 'ERROR') as logs:
+            call_command('compute_image_stats', processes=0, stdout=out)
+
+        self.assertEqual(
+            [image.blankness for image in Image.objects.order_by('id')],
+            [None, 1.0, None]
+        )
+        self.assertIn(f'image {images[0].id}', logs.output[0])
+        self.assertIn(
+            'Computed statistics of 1 images, 1 failed', out.getvalue()
+        )
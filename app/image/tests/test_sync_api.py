@@ -0,0 +1,179 @@
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image as PILImage
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.urls import reverse
+from django.test import TestCase, override_settings
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import ChangeLog, Image, Label
+
+from image import tasks
+
+SYNC_URL = reverse('image:sync')
+
+
+class PublicSyncApiTests(TestCase):
+    """Test the publicly available sync API"""
+
+    def test_login_required(self):
+        """Test that login is required to sync"""
+        res = APIClient().get(SYNC_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class PrivateSyncApiTests(TestCase):
+    """Test the authorized user sync API"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'test@testdomain.com',
+            'password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, since=0, **params):
+        res = self.client.get(SYNC_URL, {'since': since, **params})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data
+
+    def test_changes_are_logged_per_user(self):
+        """Test every change gets the next seq of its owner"""
+        user2 = get_user_model().objects.create_user(
+            'user2@testdomain.com',
+            'password123'
+        )
+        Label.objects.create(user=user2, name='Other')
+        label = Label.objects.create(user=self.user, name='Chest')
+        image = Image.objects.create(user=self.user, title='Scan')
+        image.labels.add(label)
+
+        self.assertEqual(
+            list(ChangeLog.objects.filter(user=self.user)
+                 .order_by('seq').values_list('seq', 'model', 'action')),
+            [(1, 'label', 'insert'), (2, 'image', 'insert'),
+             (3, 'image', 'update')]
+        )
+        self.assertEqual(
+            ChangeLog.objects.filter(user=user2).get().seq, 1
+        )
+
+    def test_sync_returns_current_state_once(self):
+        """Test repeated changes of an object collapse into one entry"""
+        label = Label.objects.create(user=self.user, name='Chest')
+        image = Image.objects.create(user=self.user, title='Scan')
+        image.labels.add(label)
+        image.title = 'Renamed'
+        image.save()
+
+        data = self.sync()
+
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['next'], 4)
+        self.assertEqual(
+            [(c['model'], c['id'], c['action']) for c in data['changes']],
+            [('label', label.id, 'insert'), ('image', image.id, 'insert')]
+        )
+        self.assertEqual(data['changes'][1]['data']['title'], 'Renamed')
+        self.assertEqual(data['changes'][1]['data']['labels'], [label.id])
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'))
+    def test_job_results_are_synced(self):
+        """Test values computed by background jobs are logged as changes"""
+        image = Image.objects.create(user=self.user, title='Scan')
+        buffer = BytesIO()
+        PILImage.new('RGB', (32, 32), (200, 10, 10)).save(buffer, 'PNG')
+        image.image_file.save('scan.png', ContentFile(buffer.getvalue()))
+        since = self.sync()['next']
+
+        tasks.compute_stats(image.id)
+        tasks.compute_phash(image.id)
+
+        changes = self.sync(since)['changes']
+        self.assertEqual(
+            [(c['model'], c['id'], c['action']) for c in changes],
+            [('image', image.id, 'update')]
+        )
+        image.refresh_from_db()
+        self.assertEqual(changes[0]['seq'], since + 2)
+        self.assertIsNotNone(image.phash)
+
+    def test_sync_since(self):
+        """Test only the changes after since are returned"""
+        image = Image.objects.create(user=self.user, title='Scan')
+        since = self.sync()['next']
+        image_id = image.id
+        image.delete()
+
+        data = self.sync(since)
+
+        self.assertEqual(data['changes'], [
+            {'seq': since + 1, 'model': 'image', 'id': image_id,
+             'action': 'delete'}
+        ])
+        self.assertEqual(self.sync(data['next'])['changes'], [])
+
+    @override_settings(SYNC_BATCH_SIZE=2)
+    def test_sync_in_batches(self):
+        """Test large change sets are returned in bounded batches"""
+        for i in range(5):
+            Label.objects.create(user=self.user, name=f'Label {i}')
+
+        seen, since = [], 0
+        while True:
+            with self.assertNumQueries(2):
+                data = self.sync(since)
+            self.assertLessEqual(len(data['changes']), 2)
+            seen.extend(change['data']['name'] for change in data['changes'])
+            since = data['next']
+            if not data['has_more']:
+                break
+
+        self.assertEqual(seen, [f'Label {i}' for i in range(5)])
+
+    def test_sync_skips_objects_deleted_later(self):
+        """Test an object deleted after the batch is not sent as live"""
+        Label.objects.create(user=self.user, name='Chest').delete()
+
+        data = self.sync(limit=1)
+
+        self.assertEqual(data['changes'], [])
+        self.assertTrue(data['has_more'])
+
+    def test_invalid_since(self):
+        """Test since must be a non-negative integer"""
+        res = self.client.get(SYNC_URL, {'since': 'x'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_deleting_user_logs_nothing(self):
+        """Test a user's data cascades away without logging changes"""
+        label = Label.objects.create(user=self.user, name='Chest')
+        image = Image.objects.create(user=self.user, title='Scan')
+        image.labels.add(label)
+
+        self.user.delete()
+
+        self.assertFalse(ChangeLog.objects.exists())
+
+    def test_failed_user_delete_logs_again(self):
+        """Test changes are logged again after a user delete fails"""
+        Image.objects.create(user=self.user, title='Scan')
+        users = get_user_model().objects.filter(id=self.user.id)
+
+        with mock.patch('core.cleanup.delete_files_later',
+                        side_effect=OSError):
+            with self.assertRaises(OSError), transaction.atomic():
+                users.delete()
+
+        Label.objects.create(user=self.user, name='Chest')
+        self.assertTrue(ChangeLog.objects.filter(model='label').exists())
@@ -0,0 +1,140 @@
+import math
+import zlib
+from io import BytesIO
+from unittest import mock
+
+import numpy as np
+from PIL import Image as PILImage
+from PIL.TiffImagePlugin import ImageFileDirectory_v2
+
+from django.test import SimpleTestCase, override_settings
+
+from image import tiles
+
+
+def tiled_tiff(pixels, tile_size):
+    """Return an RGB array encoded as a deflate compressed tiled TIFF"""
+    height, width, _ = pixels.shape
+    chunks = []
+    for row in range(math.ceil(height / tile_size)):
+        for col in range(math.ceil(width / tile_size)):
+            tile = np.zeros((tile_size, tile_size, 3), np.uint8)
+            part = pixels[row * tile_size:(row + 1) * tile_size,
+                          col * tile_size:(col + 1) * tile_size]
+            tile[:part.shape[0], :part.shape[1]] = part
+            chunks.append(zlib.compress(tile.tobytes()))
+    ifd = ImageFileDirectory_v2()
+    for tag, value in {256: width, 257: height, 258: (8, 8, 8), 259: 8,
+                       262: 2, 277: 3, 284: 1, 322: tile_size,
+                       323: tile_size}.items():
+        ifd[tag] = value
+    ifd[325] = tuple(len(chunk) for chunk in chunks)
+    ifd[324] = (0,) * len(chunks)
+    ifd.tagtype[324] = ifd.tagtype[325] = 4
+    offset = 8 + len(ifd.tobytes(8))
+    offsets = []
+    for chunk in chunks:
+        offsets.append(offset)
+        offset += len(chunk)
+    ifd[324] = tuple(offsets)
+    return (b'II*\x00' + (8).to_bytes(4, 'little') + ifd.tobytes(8)
+            + b''.join(chunks))
+
+
+class PyramidTests(SimpleTestCase):
+    """Test pyramids built band by band"""
+
+    def pyramid(self, content):
+        """Return the tiles generated from a file by (level, col, row)"""
+        image = mock.Mock(id=1, checksum='0' * 64)
+        image.pixel_file.open.side_effect = lambda mode: BytesIO(content)
+        saved = {}
+
+        def save(name, tile):
+            level, name = name.split('/')[-2:]
+            col, row = name.split('.')[0].split('_')
+            saved[int(level), int(col), int(row)] = np.asarray(tile)
+
+        with mock.patch.object(tiles, '_save_tile', save):
+            tiles.generate_pyramid(image)
+        return saved
+
+    def whole(self, img):
+        """Return the tiles of an image decoded whole and reduced level
+        by level
+        """
+        saved = {}
+        for level in range(tiles.max_level(*img.size), -1, -1):
+            for col in range(math.ceil(img.width / 16)):
+                for row in range(math.ceil(img.height / 16)):
+                    saved[level, col, row] = np.asarray(img.crop((
+                        max(col * 16 - 1, 0), max(row * 16 - 1, 0),
+                        min(col * 16 + 17, img.width),
+                        min(row * 16 + 17, img.height),
+                    )))
+            img = img.reduce(2)
+        return saved
+
+    def assertSameTiles(self, first, second):
+        self.assertEqual(first.keys(), second.keys())
+        for key in first:
+            np.testing.assert_array_equal(first[key], second[key])
+
+    @override_settings(IMAGE_TILE_SIZE=16, IMAGE_TILE_OVERLAP=1)
+    def test_tiled_tiff_read_by_tile(self):
+        """Test tiled TIFFs are decoded one tile at a time"""
+        pixels = np.random.default_rng(0).integers(
+            0, 255, (45, 70, 3), np.uint8
+        )
+        decode = mock.Mock(wraps=tiles._tiff_piece)
+
+        with mock.patch.object(tiles, '_tiff_piece', decode):
+            saved = self.pyramid(tiled_tiff(pixels, 32))
+
+        self.assertEqual(decode.call_count, 6)
+        self.assertSameTiles(saved, self.whole(PILImage.fromarray(pixels)))
+
+    @override_settings(IMAGE_TILE_SIZE=16, IMAGE_TILE_OVERLAP=1)
+    def test_formats_match_whole_image(self):
+        """Test striped TIFFs and other formats give the same pyramid as
+        the image reduced whole
+        """
+        img = PILImage.fromarray(np.random.default_rng(1).integers(
+            0, 255, (37, 50, 3), np.uint8
+        ))
+        for format, params in (
+            ('TIFF', {'compression': 'tiff_lzw', 'strip_size': 50 * 3 * 5}),
+            ('TIFF', {'compression': 'raw', 'strip_size': 50 * 3 * 3}),
+            ('PNG', {}),
+        ):
+            with self.subTest(format=format, **params):
+                buffer = BytesIO()
+                img.save(buffer, format, **params)
+
+                saved = self.pyramid(buffer.getvalue())
+
+                self.assertSameTiles(saved, self.whole(img))
+
+    @override_settings(IMAGE_TILES_MAX_PIXELS=1000)
+    def test_pixel_limit(self):
+        """Test images over the tiling limit are refused from their
+        dimensions, without touching Pillow's own limit
+        """
+        buffer = BytesIO()
+        PILImage.new('RGB', (50, 30)).save(buffer, 'PNG')
+        limit = PILImage.MAX_IMAGE_PIXELS
+
+        with self.assertRaisesMessage(ValueError, '50x30'):
+            self.pyramid(buffer.getvalue())
+        self.assertEqual(PILImage.MAX_IMAGE_PIXELS, limit)
+
+    @override_settings(IMAGE_UPLOAD_MAX_PIXELS=1000)
+    def test_whole_image_limit(self):
+        """Test images that can only be decoded whole are held to the
+        plain upload limit
+        """
+        buffer = BytesIO()
+        PILImage.new('RGB', (50, 30)).save(buffer, 'PNG')
+
+        with self.assertRaisesMessage(ValueError, 'read in pieces'):
+            self.pyramid(buffer.getvalue())
@@ -0,0 +1,284 @@
+import struct
+import tempfile
+import zlib
+from io import BytesIO
+
+from PIL import Image as PILImage
+from PIL.TiffImagePlugin import ImageFileDirectory_v2
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from core.models import Image, Job
+
+from image import metadata, uploads
+
+
+def encode(fmt, size=(40, 30), mode='RGB', **params):
+    """Return an image encoded in memory"""
+    buffer = BytesIO()
+    PILImage.new(mode, size, (10, 200, 30)).save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data)))
+
+
+def bomb_png(width, height):
+    """Return a small PNG declaring width x height gray pixels"""
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header)
+            + png_chunk(b'IDAT', zlib.compress(bytes(width + 1) * 64))
+            + png_chunk(b'IEND', b''))
+
+
+def blank_tiff(width, height, tile_size=512):
+    """Return a small deflated RGB TIFF of width x height black pixels.
+
+    Its tiles all share one tile's bytes; without tile_size it is a
+    single strip, which can only be decoded whole.
+    """
+    if tile_size:
+        layout = {322: tile_size, 323: tile_size}
+        offsets, counts = 324, 325
+        pieces = -(-width // tile_size) * -(-height // tile_size)
+        data = zlib.compress(bytes(tile_size * tile_size * 3))
+    else:
+        layout = {278: height}
+        offsets, counts = 273, 279
+        pieces = 1
+        data = zlib.compress(bytes(width * 3)[:1])
+    ifd = ImageFileDirectory_v2()
+    for tag, value in {256: width, 257: height, 258: (8, 8, 8), 259: 8,
+                       262: 2, 277: 3, 284: 1, **layout}.items():
+        ifd[tag] = value
+    ifd[offsets] = ifd[counts] = (len(data),) * pieces
+    ifd.tagtype[offsets] = ifd.tagtype[counts] = 4
+    ifd[offsets] = (8 + len(ifd.tobytes(8)),) * pieces
+    return b'II*\x00' + (8).to_bytes(4, 'little') + ifd.tobytes(8) + data
+
+
+def uploaded(content, name='upload.png'):
+    return SimpleUploadedFile(name, content)
+
+
+class InspectFileTests(SimpleTestCase):
+    """Test reading formats and dimensions from headers"""
+
+    def test_formats(self):
+        """Test the dimensions of every accepted format are read"""
+        for fmt, params in (
+            ('PNG', {}), ('JPEG', {}), ('GIF', {}), ('BMP', {}),
+            ('TIFF', {}), ('TIFF', {'compression': 'tiff_lzw'}),
+            ('WEBP', {}), ('WEBP', {'lossless': True}),
+        ):
+            with self.subTest(fmt=fmt, **params):
+                content = encode(fmt, **params)
+                self.assertEqual(
+                    uploads.inspect_file(uploaded(content)),
+                    (fmt.lower(), 40, 30)
+                )
+
+    def test_jpeg_skips_large_segments(self):
+        """Test the JPEG frame header is found past an ICC profile"""
+        content = encode('JPEG', size=(640, 480),
+                         icc_profile=bytes(200 * 1024))
+
+        self.assertEqual(
+            uploads.inspect_file(uploaded(content)), ('jpeg', 640, 480)
+        )
+
+    def test_not_an_image(self):
+        """Test files without a known signature are rejected"""
+        for content in (b'', b'notimage', b'%PDF-1.4' + bytes(64)):
+            with self.subTest(content=content):
+                with self.assertRaises(uploads.UploadRejected):
+                    uploads.inspect_file(uploaded(content))
+
+    def test_truncated_header(self):
+        """Test a signature without a full header is rejected"""
+        with self.assertRaisesMessage(
+            uploads.UploadRejected, uploads.MALFORMED
+        ):
+            uploads.inspect_file(uploaded(encode('PNG')[:20]))
+
+    @override_settings(IMAGE_UPLOAD_FORMATS=('png',))
+    def test_format_not_accepted(self):
+        """Test formats left out of IMAGE_UPLOAD_FORMATS are rejected"""
+        with self.assertRaisesMessage(uploads.UploadRejected, 'gif'):
+            uploads.inspect_file(uploaded(encode('GIF')))
+
+    @override_settings(IMAGE_UPLOAD_MAX_PIXELS=10000)
+    def test_pixel_limit(self):
+        """Test images with more pixels than the limit are rejected"""
+        with self.assertRaisesMessage(uploads.UploadRejected, '200x100'):
+            uploads.inspect_file(uploaded(bomb_png(200, 100)))
+
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=100)
+    def test_byte_limit(self):
+        """Test files larger than the limit are rejected"""
+        with self.assertRaisesMessage(uploads.UploadRejected, '100 bytes'):
+            uploads.inspect_file(uploaded(encode('BMP')))
+
+
+class StreamInspectorTests(SimpleTestCase):
+    """Test checking images while they arrive"""
+
+    def feed(self, content, chunk_size):
+        inspector = uploads.StreamInspector()
+        for start in range(0, len(content), chunk_size):
+            inspector.feed(content[start:start + chunk_size])
+        return inspector
+
+    def test_any_chunking(self):
+        """Test the header is read whatever the chunk boundaries"""
+        content = encode('JPEG', icc_profile=bytes(5000))
+        for chunk_size in (1, 7, 64, 4096, len(content)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(
+                    self.feed(content, chunk_size).result,
+                    ('jpeg', 40, 30)
+                )
+
+    def test_rejects_bomb_from_first_chunk(self):
+        """Test a bomb is refused with the rest of it still to come"""
+        inspector = uploads.StreamInspector()
+        with self.assertRaisesMessage(
+            uploads.UploadRejected, '100000x100000'
+        ):
+            inspector.feed(bomb_png(100000, 100000)[:64])
+
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=1000)
+    def test_rejects_past_byte_limit(self):
+        """Test the stream is refused once it passes the byte limit"""
+        inspector = uploads.StreamInspector()
+        inspector.feed(encode('PNG'))
+        with self.assertRaises(uploads.UploadRejected):
+            inspector.feed(bytes(1000))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='test-media-'))
+class UploadApiTests(TestCase):
+    """Test the upload endpoint refuses bad images early"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            'test@test.com', 'testpass'
+        )
+        self.client.force_authenticate(self.user)
+        self.image = Image.objects.create(
+            user=self.user, title='Sample', status=Image.NEW,
+            date='2020-06-14'
+        )
+        self.url = reverse('image:image-upload-file', args=[self.image.id])
+
+    def upload(self, content, name='upload.png', **params):
+        upload = BytesIO(content)
+        upload.name = name
+        return self.client.post(
+            self.url, {'image_file': upload, **params}, format='multipart'
+        )
+
+    def test_bomb_rejected(self):
+        """Test a decompression bomb is refused and not stored"""
+        res = self.upload(bomb_png(100000, 100000))
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('100000x100000', res.data['image_file'][0])
+        self.assertFalse(self.image.image_file)
+
+    def test_not_an_image_rejected(self):
+        """Test a file that is not an image is refused"""
+        res = self.upload(b'#!/bin/sh\n' + bytes(100), name='image.png')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('not an image', res.data['image_file'][0])
+
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=2000,
+                       DATA_UPLOAD_MAX_MEMORY_SIZE=1000)
+    def test_large_body_rejected(self):
+        """Test a body over the limit is refused from its length alone"""
+        res = self.upload(encode('PNG') + bytes(5000))
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('2000 bytes', res.data['image_file'][0])
+
+    def test_valid_image_accepted(self):
+        """Test a valid image is still stored with its metadata"""
+        res = self.upload(encode('JPEG', size=(64, 48)), name='image.jpg')
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual((self.image.width, self.image.height), (64, 48))
+        self.assertEqual(self.image.format, 'JPEG')
+
+    @override_settings(IMAGE_UPLOAD_MAX_PIXELS=1000,
+                       IMAGE_TILES_MAX_PIXELS=10000)
+    def test_large_image_accepted_with_tiles(self):
+        """Test images over the limit are accepted when they get tiles"""
+        content = blank_tiff(64, 48, tile_size=16)
+
+        res = self.upload(content, name='slide.tif')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('64x48', res.data['image_file'][0])
+
+        res = self.upload(content, name='slide.tif', generate_tiles=True)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['width'], 64)
+        self.assertEqual(
+            list(Job.objects.values_list('kind', flat=True)),
+            ['image.generate_tiles']
+        )
+
+    def test_gigapixel_tiff_accepted_with_tiles(self):
+        """Test a TIFF past Pillow's own pixel limit is stored with its
+        metadata when it gets tiles
+        """
+        res = self.upload(blank_tiff(20000, 20000), name='slide.tif',
+                          generate_tiles=True)
+
+        self.image.refresh_from_db()
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual((self.image.width, self.image.height),
+                         (20000, 20000))
+        self.assertEqual(self.image.format, 'TIFF')
+        self.assertEqual(len(self.image.checksum), 64)
+        self.assertEqual(
+            list(Job.objects.values_list('kind', flat=True)),
+            ['image.generate_tiles']
+        )
+
+    def test_whole_image_formats_held_to_limit_with_tiles(self):
+        """Test images decoded whole get no tiled allowance"""
+        for content, name in (
+            (bomb_png(20000, 20000), 'slide.png'),
+            (blank_tiff(20000, 20000, tile_size=None), 'slide.tif'),
+        ):
+            with self.subTest(name=name):
+                res = self.upload(content, name=name, generate_tiles=True)
+
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('20000x20000', res.data['image_file'][0])
+
+
+class ExtractMetadataTests(SimpleTestCase):
+    """Test reading the indexed metadata of stored files"""
+
+    def test_past_pillow_limit(self):
+        """Test images past Pillow's pixel limit are read from the header"""
+        values, patient = metadata.extract_metadata(
+            BytesIO(blank_tiff(20000, 20000))
+        )
+
+        self.assertEqual((values['width'], values['height']), (20000, 20000))
+        self.assertEqual((values['mode'], values['format']), ('RGB', 'TIFF'))
+        self.assertIsNone(patient)
@@ -0,0 +1,330 @@
+import math
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from PIL import Image as PILImage
+from PIL import TiffTags
+from PIL.TiffImagePlugin import (
+    IMAGELENGTH,
+    IMAGEWIDTH,
+    ROWSPERSTRIP,
+    STRIPBYTECOUNTS,
+    STRIPOFFSETS,
+    ImageFileDirectory_v2,
+)
+
+from core.models import Image, tiles_prefix, tiles_version, update_image
+
+from image import uploads
+
+
+TILE_FORMAT = 'jpeg'
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+
+# Tags of the TIFF layout, and those copied to decode a piece on its own:
+# sample layout and compression, colormap, predictor, extra samples,
+# sample format, JPEG tables, YCbCr subsampling and reference levels
+PLANAR_CONFIGURATION = 284
+TILEWIDTH, TILELENGTH, TILEOFFSETS, TILEBYTECOUNTS = 322, 323, 324, 325
+TIFF_PIECE_TAGS = (
+    258, 259, 262, 266, 277, 284, 317, 320, 338, 339, 347, 530, 532,
+)
+
+
+def max_level(width, height):
+    """Return the index of the full resolution level of a DZI pyramid"""
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def level_size(width, height, level):
+    """Return the dimensions of a pyramid level"""
+    scale = 2 ** (max_level(width, height) - level)
+    return math.ceil(width / scale), math.ceil(height / scale)
+
+
+def tile_version(image):
+    """Return the part of the tile paths that changes on re-upload"""
+    return tiles_version(image.checksum)
+
+
+def tile_path(image, level, col, row):
+    """Return the storage name of a tile"""
+    return (
+        f'{tiles_prefix(image.id, tile_version(image))}{level}/'
+        f'{col}_{row}.{TILE_FORMAT}'
+    )
+
+
+def descriptor(image):
+    """Return the DZI descriptor of an image in its JSON form"""
+    return {
+        'Image': {
+            'xmlns': DZI_NAMESPACE,
+            'Format': TILE_FORMAT,
+            'Overlap': settings.IMAGE_TILE_OVERLAP,
+            'TileSize': settings.IMAGE_TILE_SIZE,
+            'Size': {'Width': image.width, 'Height': image.height},
+        },
+        'version': tile_version(image),
+    }
+
+
+def _open(image_file):
+    """Open an image, refusing those over IMAGE_TILES_MAX_PIXELS"""
+    source = uploads.open_image(image_file)
+    width, height = source.size
+    if width * height > settings.IMAGE_TILES_MAX_PIXELS:
+        raise ValueError(
+            f'The image has {width}x{height} pixels, more than the limit '
+            f'of {settings.IMAGE_TILES_MAX_PIXELS} for tiles.'
+        )
+    return source
+
+
+def _values(value):
+    return value if isinstance(value, tuple) else (value,)
+
+
+def _tiff_piece(image_file, tags, offset, byte_count, width, height):
+    """Decode one tile or strip of a TIFF on its own.
+
+    The compressed bytes are wrapped in a TIFF of a single strip that
+    carries the source's tags, which is what Pillow can read.
+    """
+    image_file.seek(offset)
+    data = image_file.read(byte_count)
+    ifd = ImageFileDirectory_v2()
+    for tag in TIFF_PIECE_TAGS:
+        if tag in tags:
+            ifd[tag] = tags[tag]
+            ifd.tagtype[tag] = tags.tagtype[tag]
+    ifd[IMAGEWIDTH], ifd[IMAGELENGTH] = width, height
+    ifd[ROWSPERSTRIP] = height
+    ifd[STRIPBYTECOUNTS] = len(data)
+    ifd.tagtype[STRIPBYTECOUNTS] = TiffTags.LONG
+    # Pillow writes the strip offset relative to the end of the directory,
+    # which is where the data goes
+    ifd[STRIPOFFSETS] = 0
+    ifd.tagtype[STRIPOFFSETS] = TiffTags.LONG
+    piece = PILImage.open(BytesIO(
+        b'II*\x00' + (8).to_bytes(4, 'little') + ifd.tobytes(8) + data
+    ))
+    piece.load()
+    return piece
+
+
+def _tiff_bands(image_file, source, mode):
+    """Yield the rows of a TIFF by tile or strip row, decoding each piece
+    on its own; None if the file is laid out in another way
+    """
+    tags = source.tag_v2
+    if tags.get(PLANAR_CONFIGURATION, 1) != 1:
+        return None
+    width, height = source.size
+    if TILEOFFSETS in tags:
+        piece_width, piece_height = tags[TILEWIDTH], tags[TILELENGTH]
+        offsets, counts = tags[TILEOFFSETS], tags[TILEBYTECOUNTS]
+    elif STRIPOFFSETS in tags:
+        piece_width = width
+        piece_height = min(tags.get(ROWSPERSTRIP, height), height)
+        offsets, counts = tags[STRIPOFFSETS], tags[STRIPBYTECOUNTS]
+    else:
+        return None
+    offsets, counts = _values(offsets), _values(counts)
+    across = math.ceil(width / piece_width)
+    down = math.ceil(height / piece_height)
+    if len(offsets) != across * down or len(counts) != len(offsets):
+        return None
+
+    def bands():
+        # Strips may be a single row each; they are gathered into bands of
+        # a tile row at least, each stacked with one copy
+        gathered = []
+        for row in range(down):
+            band_height = min(piece_height, height - row * piece_height)
+            band = PILImage.new(mode, (width, band_height))
+            for col in range(across):
+                index = row * across + col
+                # Tiles are padded to full size at the edges, strips are not
+                piece = _tiff_piece(
+                    image_file, tags, offsets[index], counts[index],
+                    piece_width, piece_height if TILEOFFSETS in tags
+                    else band_height,
+                )
+                if piece.mode != mode:
+                    piece = piece.convert(mode)
+                band.paste(piece.crop(
+                    (0, 0, min(piece_width, width - col * piece_width),
+                     band_height)
+                ), (col * piece_width, 0))
+            gathered.append(band)
+            if sum(band.height for band in gathered) >= (
+                settings.IMAGE_TILE_SIZE
+            ):
+                yield _stack(*gathered)
+                gathered = []
+        if gathered:
+            yield _stack(*gathered)
+    return bands()
+
+
+def _bands(image_file, source, mode):
+    """Yield the full resolution image as bands of rows, top to bottom.
+
+    TIFFs, the usual container of very large images, are read one tile
+    or strip row at a time. Other formats can only be decoded whole.
+    """
+    bands = None
+    if source.format == 'TIFF':
+        bands = _tiff_bands(image_file, source, mode)
+    if bands is None:
+        width, height = source.size
+        if width * height > settings.IMAGE_UPLOAD_MAX_PIXELS:
+            raise ValueError(
+                f'The image has {width}x{height} pixels and cannot be '
+                f'read in pieces, more than the limit of '
+                f'{settings.IMAGE_UPLOAD_MAX_PIXELS}.'
+            )
+        source.load()
+        bands = iter([source if source.mode == mode else source.convert(mode)])
+    return bands
+
+
+def _stack(*bands):
+    """Return bands of rows as one"""
+    if len(bands) == 1:
+        return bands[0]
+    stacked = PILImage.new(
+        bands[0].mode, (bands[0].width, sum(band.height for band in bands))
+    )
+    top = 0
+    for band in bands:
+        stacked.paste(band, (0, top))
+        top += band.height
+    return stacked
+
+
+class _Level:
+    """One level of a pyramid built from bands of rows.
+
+    Rows are held only until the tile rows that need them are written,
+    and passed on, halved, to the level below. Bands are halved at even
+    row offsets, so the levels come out as if the level above was reduced
+    whole.
+    """
+
+    def __init__(self, image, level, size):
+        self.image = image
+        self.level = level
+        self.width, self.height = level_size(*size, level)
+        # Rows held for the tiles, from row self.top on
+        self.rows = None
+        self.top = 0
+        # Rows not halved yet
+        self.pending = None
+        self.tile_row = 0
+        self.below = None
+        if level:
+            self.below = _Level(image, level - 1, size)
+
+    def add(self, band):
+        self.rows = band if self.rows is None else _stack(self.rows, band)
+        self._write_tiles()
+        if self.below:
+            self.pending = (
+                band if self.pending is None else _stack(self.pending, band)
+            )
+            even = self.pending.height // 2 * 2
+            if even:
+                self.below.add(
+                    self.pending.crop((0, 0, self.width, even)).reduce(2)
+                )
+                self.pending = (
+                    self.pending.crop(
+                        (0, even, self.width, self.pending.height)
+                    ) if even < self.pending.height else None
+                )
+
+    def finish(self):
+        if self.below:
+            if self.pending is not None:
+                self.below.add(self.pending.reduce(2))
+                self.pending = None
+            self.below.finish()
+
+    def _write_tiles(self):
+        tile_size = settings.IMAGE_TILE_SIZE
+        overlap = settings.IMAGE_TILE_OVERLAP
+        received = self.top + self.rows.height
+        while self.tile_row * tile_size < self.height:
+            top = max(self.tile_row * tile_size - overlap, 0)
+            bottom = min(
+                (self.tile_row + 1) * tile_size + overlap, self.height
+            )
+            if received < bottom:
+                break
+            for col in range(math.ceil(self.width / tile_size)):
+                box = (
+                    max(col * tile_size - overlap, 0),
+                    top - self.top,
+                    min((col + 1) * tile_size + overlap, self.width),
+                    bottom - self.top,
+                )
+                _save_tile(
+                    tile_path(self.image, self.level, col, self.tile_row),
+                    self.rows.crop(box),
+                )
+            self.tile_row += 1
+        # The next tile row starts overlap rows above its own first row
+        keep = min(max(self.tile_row * tile_size - overlap, 0), received)
+        if keep > self.top:
+            self.rows = self.rows.crop(
+                (0, keep - self.top, self.width, self.rows.height)
+            )
+            self.top = keep
+
+
+def _save_tile(name, tile):
+    buffer = BytesIO()
+    tile.save(buffer, format=TILE_FORMAT, quality=settings.IMAGE_TILE_QUALITY)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def generate_pyramid(image, progress=None):
+    """Write every tile of the image's pyramid to storage.
+
+    The full resolution image is read in bands of rows, tile or strip
+    rows of a TIFF, and every level is built as the bands come down the
+    pyramid, each from the one above with reduce(2). Only the rows of the
+    tile rows being written are held, rather than the whole image.
+    """
+    with image.pixel_file.open('rb') as image_file:
+        source = _open(image_file)
+        mode = source.mode if source.mode in ('RGB', 'L') else 'RGB'
+        width, height = source.size
+        top = _Level(image, max_level(width, height), source.size)
+        done = 0
+        for band in _bands(image_file, source, mode):
+            top.add(band)
+            done += band.height
+            if progress:
+                progress(done / height)
+        top.finish()
+
+
+def generate_tiles(image_id, progress=None):
+    """Build the tile pyramid of an uploaded image and record the outcome"""
+    image = Image.objects.filter(id=image_id).first()
+    if image is None or not image.pixel_file:
+        return
+    try:
+        generate_pyramid(image, progress=progress)
+    except Exception:
+        update_image(image, tiles_status=Image.TILES_FAILED)
+        raise
+    update_image(image, tiles_status=Image.TILES_READY)
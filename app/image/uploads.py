@@ -0,0 +1,399 @@
+import struct
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from PIL import Image as PILImage
+
+from image import dicom
+
+
+class UploadRejected(Exception):
+    """An upload that is not an acceptable image, with the reason why"""
+
+
+# Bytes needed to tell every supported format apart
+MAGIC_BYTES = 12
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'BM', 'bmp'),
+)
+# JPEG markers carrying no length, and the start of frame markers holding
+# the dimensions (DHT, JPG and DAC share the SOF range)
+JPEG_STANDALONE = {0x01} | set(range(0xd0, 0xd9))
+JPEG_FRAMES = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+TIFF_WIDTH, TIFF_HEIGHT = 256, 257
+TIFF_ROWS_PER_STRIP, TIFF_STRIP_OFFSETS = 278, 273
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_TILE_WIDTH, TIFF_TILE_LENGTH, TIFF_TILE_OFFSETS = 322, 323, 324
+TIFF_TYPES = {3: 'H', 4: 'I'}
+
+MALFORMED = 'The image header is malformed.'
+NOT_AN_IMAGE = 'Upload a valid image. The file is not an image.'
+
+
+def sniff(head):
+    """Return the format of a file from its first MAGIC_BYTES bytes, or
+    None if it has no known signature there
+    """
+    for magic, image_format in SIGNATURES:
+        if head.startswith(magic):
+            return image_format
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+# Header parsers. Each is a generator yielding the (offset, length) of the
+# bytes it needs next, always at or past the previous request, and
+# returning (width, height, block), block being the most pixels decoded at
+# once to read the image: all of them, except for TIFFs stored in tiles or
+# strips. This lets the same parser read a file with seeks or follow an
+# upload as it streams in without buffering it.
+
+def _png():
+    chunk = yield 8, 16
+    if chunk[4:8] != b'IHDR':
+        raise UploadRejected(MALFORMED)
+    width, height = struct.unpack('>II', chunk[8:16])
+    return width, height, width * height
+
+
+def _gif():
+    screen = yield 6, 4
+    width, height = struct.unpack('<HH', screen)
+    return width, height, width * height
+
+
+def _bmp():
+    info = yield 14, 12
+    size, = struct.unpack('<I', info[:4])
+    if size == 12:
+        width, height = struct.unpack('<HH', info[4:8])
+    else:
+        width, height = struct.unpack('<ii', info[4:12])
+        # Negative heights are top-down bitmaps
+        width, height = abs(width), abs(height)
+    return width, height, width * height
+
+
+def _webp():
+    chunk = yield 12, 18
+    kind = chunk[:4]
+    if kind == b'VP8 ' and chunk[11:14] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', chunk[14:18])
+        width, height = width & 0x3fff, height & 0x3fff
+    elif kind == b'VP8L' and chunk[8] == 0x2f:
+        bits = int.from_bytes(chunk[9:13], 'little')
+        width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif kind == b'VP8X':
+        width = int.from_bytes(chunk[12:15], 'little') + 1
+        height = int.from_bytes(chunk[15:18], 'little') + 1
+    else:
+        raise UploadRejected(MALFORMED)
+    return width, height, width * height
+
+
+def _jpeg():
+    # Skip from marker to marker to the start of frame; large APP segments
+    # (EXIF, ICC profiles) are stepped over, never read
+    offset = 2
+    while True:
+        marker = yield offset, 4
+        if marker[0] != 0xff:
+            raise UploadRejected(MALFORMED)
+        code = marker[1]
+        if code == 0xff:
+            # Fill byte
+            offset += 1
+        elif code in JPEG_STANDALONE:
+            offset += 2
+        elif code in JPEG_FRAMES:
+            frame = yield offset + 5, 4
+            height, width = struct.unpack('>HH', frame)
+            return width, height, width * height
+        else:
+            # Scan data or end of image before any frame header
+            length, = struct.unpack('>H', marker[2:4])
+            if code in (0xd9, 0xda) or length < 2:
+                raise UploadRejected(MALFORMED)
+            offset += 2 + length
+
+
+def _tiff():
+    header = yield 0, 8
+    order = '<' if header[:2] == b'II' else '>'
+    offset, = struct.unpack(order + 'I', header[4:8])
+    if offset < 8:
+        raise UploadRejected(MALFORMED)
+    count, = struct.unpack(order + 'H', (yield offset, 2))
+    entries = yield offset + 2, count * 12
+    values, counts = {}, {}
+    for start in range(0, len(entries), 12):
+        tag, kind, counts[tag] = struct.unpack(
+            order + 'HHI', entries[start:start + 8]
+        )
+        if kind in TIFF_TYPES and counts[tag] == 1:
+            # Single values are stored inline, left aligned
+            value = entries[start + 8:start + 12]
+            values[tag], = struct.unpack(
+                order + TIFF_TYPES[kind], value[:struct.calcsize(
+                    TIFF_TYPES[kind]
+                )]
+            )
+    if TIFF_WIDTH not in values or TIFF_HEIGHT not in values:
+        raise UploadRejected(MALFORMED)
+    width, height = values[TIFF_WIDTH], values[TIFF_HEIGHT]
+    return width, height, _tiff_block(width, height, values, counts)
+
+
+def _tiff_block(width, height, values, counts):
+    """Return the most pixels image.tiles decodes at once from a TIFF:
+    a tile or strip when it can read the file piece by piece, otherwise
+    the whole image
+    """
+    if values.get(TIFF_PLANAR_CONFIGURATION, 1) != 1:
+        return width * height
+    if TIFF_TILE_OFFSETS in counts:
+        piece_width = values.get(TIFF_TILE_WIDTH)
+        piece_height = values.get(TIFF_TILE_LENGTH)
+        offsets = counts[TIFF_TILE_OFFSETS]
+    elif TIFF_STRIP_OFFSETS in counts:
+        piece_width = width
+        piece_height = min(values.get(TIFF_ROWS_PER_STRIP, height), height)
+        offsets = counts[TIFF_STRIP_OFFSETS]
+    else:
+        return width * height
+    if not piece_width or not piece_height or offsets != (
+        -(-width // piece_width) * -(-height // piece_height)
+    ):
+        return width * height
+    return piece_width * piece_height
+
+
+PARSERS = {
+    'png': _png,
+    'jpeg': _jpeg,
+    'gif': _gif,
+    'tiff': _tiff,
+    'bmp': _bmp,
+    'webp': _webp,
+}
+
+
+def _parse(tiled=False):
+    head = yield 0, MAGIC_BYTES
+    image_format = sniff(head)
+    if image_format is None:
+        # DICOM's marker comes after a preamble
+        try:
+            marker = yield dicom.PREAMBLE, len(dicom.MAGIC)
+        except UploadRejected:
+            # Too short to be DICOM either
+            marker = b''
+        if marker != dicom.MAGIC:
+            raise UploadRejected(NOT_AN_IMAGE)
+        image_format = 'dicom'
+    if image_format not in settings.IMAGE_UPLOAD_FORMATS:
+        raise UploadRejected(
+            f'Images in the {image_format} format are not accepted.'
+        )
+    if image_format == 'dicom':
+        # Too irregular to follow as it streams; inspect_file reads the
+        # dimensions of complete files with pydicom
+        return image_format, None, None
+    width, height, block = yield from PARSERS[image_format]()
+    # Tiles are built without decoding the whole image only when it can be
+    # read piece by piece; any other image is held to the plain limit
+    check_dimensions(width, height, max_pixels(
+        tiled and block <= settings.IMAGE_UPLOAD_MAX_PIXELS
+    ))
+    return image_format, width, height
+
+
+def open_image(fp):
+    """Open an image without Pillow's global pixel limit.
+
+    Pillow refuses images over twice MAX_IMAGE_PIXELS as it opens them,
+    which tiled uploads may well be; their dimensions are checked against
+    this module's limits instead, so the plugin of the file's format is
+    called directly. Only the header is read.
+    """
+    fp.seek(0)
+    image_format = sniff(fp.read(MAGIC_BYTES))
+    fp.seek(0)
+    PILImage.init()
+    if image_format is None or image_format.upper() not in PILImage.OPEN:
+        raise ValueError('Not an image Pillow can read.')
+    factory, _ = PILImage.OPEN[image_format.upper()]
+    return factory(fp)
+
+
+def check_size(byte_size):
+    if byte_size > settings.IMAGE_UPLOAD_MAX_BYTES:
+        raise UploadRejected(
+            f'The file is larger than the limit of '
+            f'{settings.IMAGE_UPLOAD_MAX_BYTES} bytes.'
+        )
+
+
+def max_pixels(tiled=False):
+    """Return the pixel limit of uploads.
+
+    Images that get a tile pyramid, from a TIFF that image.tiles reads
+    one tile or strip at a time, are viewed through their tiles and never
+    decoded whole, so they may be as large as IMAGE_TILES_MAX_PIXELS.
+    """
+    if tiled:
+        return max(
+            settings.IMAGE_UPLOAD_MAX_PIXELS, settings.IMAGE_TILES_MAX_PIXELS
+        )
+    return settings.IMAGE_UPLOAD_MAX_PIXELS
+
+
+def check_dimensions(width, height, limit=None):
+    if not width or not height:
+        raise UploadRejected(MALFORMED)
+    limit = limit or max_pixels()
+    if width * height > limit:
+        raise UploadRejected(
+            f'The image has {width}x{height} pixels, more than the limit '
+            f'of {limit}.'
+        )
+
+
+def inspect_file(fp, tiled=False):
+    """Return (format, width, height) of a complete image file.
+
+    Only the few header bytes the parser asks for are read, and nothing
+    is decoded. Raises UploadRejected for a file that is not an accepted
+    image or exceeds the IMAGE_UPLOAD_MAX_BYTES byte limit or the pixel
+    limit, that of tiled images if tiled and the file allows it.
+    """
+    check_size(fp.size)
+    parser = _parse(tiled)
+    request = next(parser)
+    try:
+        while True:
+            offset, length = request
+            fp.seek(offset)
+            data = fp.read(length)
+            if len(data) < length:
+                request = parser.throw(UploadRejected(MALFORMED))
+            else:
+                request = parser.send(data)
+    except StopIteration as stop:
+        image_format, width, height = stop.value
+    finally:
+        fp.seek(0)
+    if image_format == 'dicom':
+        try:
+            header = dicom.read_header(fp)
+        except ValueError:
+            raise UploadRejected(MALFORMED)
+        width, height = int(header.Columns), int(header.Rows)
+        # Rendering the preview decodes the whole frame, tiles or not
+        check_dimensions(width, height)
+    return image_format, width, height
+
+
+class StreamInspector:
+    """Check an image while its bytes arrive, chunk by chunk.
+
+    feed() raises UploadRejected as soon as the stream exceeds the byte
+    limit, or once the header is in if the format or pixel count is not
+    accepted, so an oversized body or a decompression bomb is refused
+    before the rest of it is even received. Bytes ahead of those the
+    parser asks for next are dropped, so at most about a chunk is held.
+    """
+
+    def __init__(self, tiled=False):
+        self.received = 0
+        self.result = None
+        self._parser = _parse(tiled)
+        self._request = next(self._parser)
+        self._buffer = bytearray()
+        # Stream offset of the first buffered byte
+        self._start = 0
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        check_size(self.received)
+        if self.result is not None:
+            return
+        self._buffer += chunk
+        while True:
+            offset, length = self._request
+            if offset < self._start:
+                raise UploadRejected(MALFORMED)
+            skip = min(offset - self._start, len(self._buffer))
+            del self._buffer[:skip]
+            self._start += skip
+            if self._start != offset or len(self._buffer) < length:
+                return
+            try:
+                self._request = self._parser.send(bytes(self._buffer[:length]))
+            except StopIteration as stop:
+                self.result = stop.value
+                self._buffer = bytearray()
+                return
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """Refuse image uploads while they stream, before they are stored.
+
+    Listed first in FILE_UPLOAD_HANDLERS, it sees every chunk before the
+    handlers that store it. A body declared larger than the byte limit is
+    refused before any of the file is read. The reason goes into the
+    request's upload_rejections by field name, then StopUpload makes the
+    parser drop the file and stop reading the body; the client may see the
+    connection closed rather than the 400 response. The form fields may
+    come after the file, so pixels are checked against the limit of tiled
+    uploads here and against the plain limit by the serializer.
+    """
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        # Room for the form fields sent along with the file
+        allowance = settings.DATA_UPLOAD_MAX_MEMORY_SIZE or 0
+        self.declared_too_large = (
+            content_length > settings.IMAGE_UPLOAD_MAX_BYTES + allowance
+        )
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.inspector = StreamInspector(tiled=True)
+        if getattr(self, 'declared_too_large', False):
+            self._reject(UploadRejected(
+                f'The request is larger than the limit of '
+                f'{settings.IMAGE_UPLOAD_MAX_BYTES} bytes.'
+            ))
+        if self.content_length:
+            self._check(check_size, self.content_length)
+
+    def receive_data_chunk(self, raw_data, start):
+        self._check(self.inspector.feed, raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        # The stored file is inspected again by the serializer, which also
+        # covers headers that end with the stream
+        return None
+
+    def _check(self, check, value):
+        try:
+            check(value)
+        except UploadRejected as exc:
+            self._reject(exc)
+
+    def _reject(self, exc):
+        if self.request is not None:
+            if not hasattr(self.request, 'upload_rejections'):
+                self.request.upload_rejections = {}
+            self.request.upload_rejections[self.field_name] = str(exc)
+        raise StopUpload(connection_reset=True)
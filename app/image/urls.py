@@ -8,9 +8,12 @@ router = DefaultRouter()
 router.register('labels', views.LabelViewSet)
 router.register('patientinfo', views.PatientInfoViewSet)
 router.register('images', views.ImageViewSet)
+router.register('jobs', views.JobViewSet)
 
 app_name = 'image'
 
 urlpatterns = [
+    path('sync/', views.SyncView.as_view(), name='sync'),
+    path('events/', views.EventsView.as_view(), name='events'),
     path('', include(router.urls))
 ]
@@ -1,12 +1,48 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils import timezone
+
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework import viewsets, mixins, status
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 
-from core.models import Label, PatientInfo, Image
+from core import jobs, pubsub
+from core.models import (
+    Annotation,
+    ChangeLog,
+    Image,
+    Job,
+    Label,
+    PatientInfo,
+    VersionConflict,
+    image_file_path,
+    record_changes,
+    subtree_images,
+)
+from core.signals import publish_image_changes
 
-from image import serializers
+from image import (
+    annotations,
+    derivatives,
+    embeddings,
+    events,
+    phash,
+    serializers,
+    tasks,
+    tiles,
+    uploads,
+)
 
 
 class BaseImageAttrViewSet(
@@ -26,8 +62,13 @@ class BaseImageAttrViewSet(
         serializer.save(user=self.request.user)
 
 
-class LabelViewSet(BaseImageAttrViewSet):
-    """Manage labels in the database"""
+class LabelViewSet(
+    BaseImageAttrViewSet, mixins.RetrieveModelMixin, mixins.UpdateModelMixin
+):
+    """Manage labels in the database.
+
+    Changing a label's parent moves its whole subtree.
+    """
 
     queryset = Label.objects.all()
     serializer_class = serializers.LabelSerializer
@@ -40,6 +81,12 @@ class PatientInfoViewSet(BaseImageAttrViewSet):
     serializer_class = serializers.PatientInfoSerializer
 
 
+class ImageChanged(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The image was changed since the version you read.'
+    default_code = 'version_conflict'
+
+
 class ImageViewSet(viewsets.ModelViewSet):
     """Manage images in the database"""
     serializer_class = serializers.ImageSerializer
@@ -47,23 +94,164 @@ class ImageViewSet(viewsets.ModelViewSet):
     authentication_classes = (TokenAuthentication,)
     permission_classes = (IsAuthenticated,)
 
+    # Query parameter -> lookup for the indexed metadata columns
+    int_filters = {
+        'min_width': 'width__gte',
+        'max_width': 'width__lte',
+        'min_height': 'height__gte',
+        'max_height': 'height__lte',
+        'min_byte_size': 'byte_size__gte',
+        'max_byte_size': 'byte_size__lte',
+    }
+    # Query parameter -> lookup for the exposure statistics, all 0-1
+    float_filters = {
+        f'{bound}_{field}': f'{field}__{lookup}'
+        for field in serializers.IMAGE_STATS_FIELDS
+        for bound, lookup in (('min', 'gte'), ('max', 'lte'))
+    }
+    # ?format= is taken by DRF's renderer override, hence file_format
+    str_filters = {
+        'file_format': 'format',
+        'mode': 'mode',
+        'checksum': 'checksum',
+        'modality': 'modality',
+    }
+    # Stored upper case, as Pillow names formats and DICOM modalities, and
+    # matched exactly so the (user, column) indexes serve the filters
+    upper_filters = ('file_format', 'modality')
+    ordering_fields = (
+        'id', 'date', 'title', 'status', 'width', 'height', 'byte_size',
+        'format'
+    ) + serializers.IMAGE_STATS_FIELDS
+
     def _params_to_ints(self, qs):
         """ Convert a list of  string IDs to a list of integers"""
         return [int(str_id) for str_id in qs.split(',')]
 
+    def _param_to_int(self, name, value):
+        """Convert a query parameter to an integer or reject the request"""
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValidationError({name: 'A valid integer is required.'})
+
+    def _param_to_float(self, name, value):
+        """Convert a query parameter to a float or reject the request"""
+        try:
+            return float(value)
+        except ValueError:
+            raise ValidationError({name: 'A valid number is required.'})
+
+    def _status_codes(self, value):
+        """Convert a list of status names to their stored codes"""
+        field = serializers.ImageStatusField()
+        try:
+            return [field.to_internal_value(name) for name in value.split(',')]
+        except ValidationError as exc:
+            raise ValidationError({'status': exc.detail})
+
+    def _ordering(self):
+        """Return the validated ordering requested by the client"""
+        ordering = self.request.query_params.get('ordering')
+        if not ordering:
+            return ['-id']
+        fields = ordering.split(',')
+        for field in fields:
+            if field.lstrip('-') not in self.ordering_fields:
+                raise ValidationError(
+                    {'ordering': f'Cannot order by "{field}".'}
+                )
+        return fields + ['-id']
+
     def get_queryset(self):
         """Retrieve the images for the authenticated user"""
-        labels = self.request.query_params.get('labels')
-        patient_information = self.request.query_params.get('patient_info')
-        queryset = self.queryset
+        queryset = self.queryset.filter(user=self.request.user)
+        if self.action == 'list':
+            queryset = self._filter_list(queryset).order_by(
+                *self._ordering()
+            )
+        return queryset.prefetch_related('labels', 'patient_info')
+
+    def _filter_list(self, queryset):
+        """Apply the list filters from the query parameters"""
+        params = self.request.query_params
+        labels = params.get('labels')
+        patient_information = params.get('patient_info')
         if labels:
-            label_ids = self._params_to_ints(labels)
-            queryset = queryset.filter(labels__id__in=label_ids)
+            queryset = queryset.filter(
+                id__in=self._labelled_images(self._params_to_ints(labels))
+            )
         if patient_information:
             pi_ids = self._params_to_ints(patient_information)
             queryset = queryset.filter(patient_info__id__in=pi_ids)
+        if params.get('status'):
+            queryset = queryset.filter(
+                status__in=self._status_codes(params['status'])
+            )
+        regions = self._filter_annotations(params)
+        if regions is not None:
+            # A subquery rather than a join: no duplicate images
+            queryset = queryset.filter(id__in=regions.values('image_id'))
+        for param, lookup in self.int_filters.items():
+            if params.get(param):
+                queryset = queryset.filter(
+                    **{lookup: self._param_to_int(param, params[param])}
+                )
+        for param, lookup in self.float_filters.items():
+            if params.get(param):
+                queryset = queryset.filter(
+                    **{lookup: self._param_to_float(param, params[param])}
+                )
+        for param, lookup in self.str_filters.items():
+            if params.get(param):
+                value = params[param]
+                if param in self.upper_filters:
+                    value = value.upper()
+                queryset = queryset.filter(**{lookup: value})
+        # Each term must appear somewhere in the title, label names or
+        # patient names; served by the trigram index on PostgreSQL
+        for term in params.get('search', '').lower().split():
+            queryset = queryset.filter(search_text__contains=term)
+
+        return queryset
+
+    def _labelled_images(self, label_ids):
+        """Return the ids of images carrying a label in the given subtrees.
+
+        The image ids come back as a subquery, so an image carrying
+        several matching labels is listed once.
+        """
+        return subtree_images(
+            Label.objects.filter(user=self.request.user, id__in=label_ids)
+        )
+
+    def _filter_annotations(self, params):
+        """Return the annotations the list must have one of, if asked.
 
-        return queryset.filter(user=self.request.user)
+        Served by the (label, kind, area) index, so "images with a tumor
+        box larger than X" never decodes a shape.
+        """
+        label = params.get('annotation_label')
+        kind = params.get('annotation_kind')
+        min_area = params.get('min_annotation_area')
+        if not (label or kind or min_area):
+            return None
+        regions = Annotation.objects.filter(user=self.request.user)
+        if label:
+            regions = regions.filter(
+                label_id=self._param_to_int('annotation_label', label)
+            )
+        if kind:
+            field = serializers.NamedChoiceField(Annotation.KIND_NAMES)
+            try:
+                regions = regions.filter(kind=field.to_internal_value(kind))
+            except ValidationError as exc:
+                raise ValidationError({'annotation_kind': exc.detail})
+        if min_area:
+            regions = regions.filter(area__gte=self._param_to_float(
+                'min_annotation_area', min_area
+            ))
+        return regions
 
     def get_serializer_class(self):
         """Return appropriate serializer class """
@@ -77,6 +265,22 @@ class ImageViewSet(viewsets.ModelViewSet):
         """Create a new image"""
         serializer.save(user=self.request.user)
 
+    def perform_update(self, serializer):
+        """Save the image over the version the client read, if it sends
+        one, rather than the one just loaded
+        """
+        version = self.request.data.get('version')
+        if version is not None:
+            serializer.instance.version = self._param_to_int(
+                'version', version
+            )
+        serializer.save()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, VersionConflict):
+            exc = ImageChanged()
+        return super().handle_exception(exc)
+
     @action(methods=['POST'], detail=True, url_path='upload-file')
     def upload_file(self, request, pk=None):
         """ Upload an image """
@@ -88,6 +292,7 @@ class ImageViewSet(viewsets.ModelViewSet):
 
         if serializer.is_valid():
             serializer.save()
+            tasks.process_upload(image)
             return Response(
                 serializer.data,
                 status=status.HTTP_200_OK
@@ -96,3 +301,645 @@ class ImageViewSet(viewsets.ModelViewSet):
             serializer.errors,
             status=status.HTTP_400_BAD_REQUEST
         )
+
+    @action(methods=['POST'], detail=True, url_path='upload-url',
+            url_name='upload-url')
+    def upload_url(self, request, pk=None):
+        """Issue a presigned POST uploading a file straight to storage.
+
+        The client posts the file to the returned URL with the returned
+        form fields, then hands the token to complete-upload. The bytes
+        never pass through the API. Needs object storage (S3_BUCKET).
+        """
+        image = self.get_object()
+        if not hasattr(default_storage, 'presigned_upload'):
+            return Response(
+                {'detail': 'Direct uploads need object storage.'},
+                status=status.HTTP_501_NOT_IMPLEMENTED
+            )
+        params = serializers.DirectUploadSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        name = image_file_path(image, params.validated_data['filename'])
+        expires = settings.S3_UPLOAD_EXPIRES_SECONDS
+        upload = default_storage.presigned_upload(
+            name, settings.IMAGE_UPLOAD_MAX_BYTES, expires
+        )
+        return Response({
+            'url': upload['url'],
+            'fields': upload['fields'],
+            'token': serializers.upload_token(image, name),
+            'expires': timezone.now() + timedelta(seconds=expires),
+        })
+
+    @action(methods=['POST'], detail=True, url_path='complete-upload',
+            url_name='complete-upload')
+    def complete_upload(self, request, pk=None):
+        """Attach a file uploaded with upload-url to the image.
+
+        Only the header of the stored object is read, to refuse files that
+        are not acceptable images, which are deleted. The checksum and the
+        rest of the metadata follow in the image.extract_metadata job.
+        """
+        image = self.get_object()
+        params = serializers.CompleteUploadSerializer(
+            data=request.data, context={'image': image}
+        )
+        params.is_valid(raise_exception=True)
+        name = params.validated_data['token']
+        try:
+            with default_storage.open(name) as image_file:
+                image_format, width, height = uploads.inspect_file(
+                    image_file, tiled=params.validated_data['generate_tiles']
+                )
+                byte_size = image_file.size
+        except FileNotFoundError:
+            raise ValidationError({'token': ['Nothing was uploaded.']})
+        except uploads.UploadRejected as exc:
+            default_storage.delete(name)
+            raise ValidationError({'image_file': [str(exc)]})
+        with transaction.atomic():
+            # Locked and read again, so that a retry racing the first call
+            # sees its file and is refused
+            image = Image.objects.select_for_update().get(id=image.id)
+            if image.image_file.name == name:
+                raise ValidationError(
+                    {'token': [serializers.UPLOAD_COMPLETED]}
+                )
+            replaced, replaced_tiles = serializers.replaced_file(image)
+            image.image_file.name = name
+            image.preview_file = None
+            image.width, image.height = width, height
+            image.format = image_format.upper()
+            image.byte_size = byte_size
+            image.mode = image.checksum = ''
+            image.tiles_status = (
+                Image.TILES_PENDING
+                if params.validated_data['generate_tiles'] else ''
+            )
+            image.save()
+            jobs.enqueue(
+                'image.extract_metadata', user=image.user,
+                image_id=image.id, name=name, replaced=replaced,
+                replaced_tiles=replaced_tiles,
+            )
+        return Response(
+            serializers.ImageUploadSerializer(
+                image, context=self.get_serializer_context()
+            ).data,
+            status=status.HTTP_202_ACCEPTED
+        )
+
+    @action(methods=['GET'], detail=True, url_path='download-url',
+            url_name='download-url')
+    def download_url(self, request, pk=None):
+        """Return a URL the image's file downloads from directly.
+
+        With object storage it is presigned for S3_URL_EXPIRES_SECONDS.
+        """
+        image = self.get_object()
+        if not image.image_file:
+            raise Http404
+        return Response(
+            {'url': request.build_absolute_uri(image.image_file.url)}
+        )
+
+    @action(methods=['POST'], detail=False, url_path='status',
+            url_name='status')
+    def transition_status(self, request):
+        """Move many images to new statuses with optimistic concurrency.
+
+        Takes a list of {id, version, status}. Each image moves only if it
+        is still at the version the client read; the others come back as
+        conflicts with their current version and status, so one labeller
+        can never silently overwrite another's work. The matching rows are
+        locked with one SELECT and moved with one UPDATE ... WHERE version,
+        whatever the number of images.
+        """
+        serializer = serializers.StatusTransitionSerializer(
+            data=request.data, many=True
+        )
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data
+        if len(items) > settings.IMAGE_STATUS_BATCH_MAX:
+            raise ValidationError(
+                f'At most {settings.IMAGE_STATUS_BATCH_MAX} images at once.'
+            )
+        if len({item['id'] for item in items}) != len(items):
+            raise ValidationError('Each image may appear only once.')
+
+        with transaction.atomic():
+            current = {
+                image_id: (version, image_status)
+                for image_id, version, image_status in (
+                    Image.objects.select_for_update()
+                    .filter(user=request.user, id__in=[i['id'] for i in items])
+                    .values_list('id', 'version', 'status')
+                )
+            }
+            moving = [
+                item for item in items
+                if current.get(item['id'], (None,))[0] == item['version']
+            ]
+            moved = self._apply_transitions(moving)
+            seqs = record_changes(
+                request.user.id, 'image', moved, ChangeLog.UPDATE
+            )
+            publish_image_changes(request.user.id, moved, seqs, ['status'])
+
+        updated, conflicts = [], []
+        moved = set(moved)
+        for item in items:
+            if item['id'] in moved:
+                updated.append({
+                    'id': item['id'],
+                    'version': item['version'] + 1,
+                    'status': Image.STATUS_NAMES[item['status']],
+                })
+            elif item['id'] not in current:
+                conflicts.append({'id': item['id'], 'reason': 'not_found'})
+            else:
+                version, image_status = current[item['id']]
+                conflicts.append({
+                    'id': item['id'],
+                    'reason': 'version_conflict',
+                    'version': version,
+                    'status': Image.STATUS_NAMES[image_status],
+                })
+
+        return Response({'updated': updated, 'conflicts': conflicts})
+
+    def _apply_transitions(self, items):
+        """Move the images locked at their expected version in one UPDATE.
+
+        The version condition is redundant while the rows stay locked, but
+        keeps the statement safe on its own.
+        """
+        if not items:
+            return []
+        by_version, by_status = {}, {}
+        for item in items:
+            by_version.setdefault(item['version'], []).append(item['id'])
+            by_status.setdefault(item['status'], []).append(item['id'])
+        expected = Q()
+        for version, ids in by_version.items():
+            expected |= Q(version=version, id__in=ids)
+
+        Image.objects.filter(expected).update(
+            status=Case(
+                *(When(id__in=ids, then=Value(code))
+                  for code, ids in by_status.items()),
+                output_field=Image._meta.get_field('status'),
+            ),
+            version=F('version') + 1,
+            # A status change ends the image's work queue lease
+            lease_token=None,
+            lease_expires=None,
+        )
+        return [item['id'] for item in items]
+
+    @action(methods=['POST', 'DELETE'], detail=False,
+            url_path='next-batch', url_name='next-batch')
+    def next_batch(self, request):
+        """Lease the next images to label, or release a lease early.
+
+        POST leases up to `size` images for `lease_seconds`, oldest first,
+        among those matching the list filters in the query string (status
+        defaults to new) that nobody else holds. SELECT ... FOR UPDATE
+        SKIP LOCKED makes concurrent labellers skip the rows others are
+        leasing instead of waiting for them or leasing them twice. Expired
+        leases simply stop counting, so their images return to the queue
+        without any cleanup. DELETE ?lease=<token> hands a batch back.
+        """
+        if request.method == 'DELETE':
+            try:
+                token = uuid.UUID(request.query_params.get('lease', ''))
+            except ValueError:
+                raise ValidationError({'lease': 'A valid UUID is required.'})
+            released = Image.objects.filter(
+                user=request.user, lease_token=token
+            ).update(lease_token=None, lease_expires=None)
+            return Response({'released': released})
+
+        serializer = serializers.LeaseRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        candidates = self._filter_list(
+            self.queryset.filter(user=request.user)
+        )
+        if not request.query_params.get('status'):
+            candidates = candidates.filter(status=Image.NEW)
+        now = timezone.now()
+        token = uuid.uuid4()
+        expires = now + timedelta(seconds=params['lease_seconds'])
+
+        with transaction.atomic():
+            ids = list(
+                Image.objects.select_for_update(skip_locked=True)
+                .filter(user=request.user, id__in=candidates.values('id'))
+                .filter(
+                    Q(lease_expires__isnull=True) | Q(lease_expires__lte=now)
+                )
+                .order_by('id')
+                .values_list('id', flat=True)[:params['size']]
+            )
+            Image.objects.filter(id__in=ids).update(
+                lease_token=token, lease_expires=expires
+            )
+
+        images = Image.objects.filter(id__in=ids).order_by('id')
+        return Response({
+            'lease': token,
+            'expires': expires,
+            'images': self.get_serializer(
+                images.prefetch_related('labels', 'patient_info'), many=True
+            ).data,
+        })
+
+    @action(methods=['GET', 'POST', 'PUT', 'DELETE'], detail=True,
+            url_path='annotations', url_name='annotations')
+    def image_annotations(self, request, pk=None):
+        """List, add, replace or delete the region annotations of an image.
+
+        POST appends and PUT replaces with a list of up to
+        ANNOTATIONS_BATCH_MAX shapes, inserted with bulk_create after one
+        query checks all their labels. GET and DELETE take an optional
+        ?label= id.
+        """
+        image = self.get_object()
+        regions = Annotation.objects.filter(image=image).order_by('id')
+        if request.method in ('GET', 'DELETE'):
+            label = request.query_params.get('label')
+            if label:
+                regions = regions.filter(
+                    label_id=self._param_to_int('label', label)
+                )
+        if request.method == 'GET':
+            return Response(
+                serializers.AnnotationSerializer(regions, many=True).data
+            )
+        if request.method == 'DELETE':
+            regions.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        # Checked before validating, which is the costly part
+        limit = settings.ANNOTATIONS_BATCH_MAX
+        if isinstance(request.data, list) and len(request.data) > limit:
+            raise ValidationError(f'At most {limit} annotations at once.')
+        serializer = serializers.AnnotationSerializer(
+            data=request.data, many=True
+        )
+        serializer.is_valid(raise_exception=True)
+        shapes = serializer.validated_data
+        label_ids = {shape['label_id'] for shape in shapes}
+        missing = label_ids - set(
+            Label.objects.filter(user=request.user, id__in=label_ids)
+            .values_list('id', flat=True)
+        )
+        if missing:
+            raise ValidationError({
+                'label': [f'Invalid pk "{pk}" - object does not exist.'
+                          for pk in sorted(missing)]
+            })
+
+        with transaction.atomic():
+            if request.method == 'PUT':
+                regions.delete()
+            Annotation.objects.bulk_create(
+                annotations.build(
+                    request.user, image, shape['label_id'], shape['kind'],
+                    shape['points']
+                )
+                for shape in shapes
+            )
+        return Response(
+            {'created': len(shapes)}, status=status.HTTP_201_CREATED
+        )
+
+    @action(methods=['GET'], detail=True, url_path='similar')
+    def similar(self, request, pk=None):
+        """Return near-duplicates of an image by perceptual hash distance"""
+        image = self.get_object()
+        if image.phash is None:
+            return Response(
+                {'detail': 'The image hash has not been computed yet.'},
+                status=status.HTTP_409_CONFLICT
+            )
+        max_distance = self._param_to_int(
+            'distance',
+            request.query_params.get(
+                'distance', settings.SIMILAR_IMAGES_DISTANCE
+            )
+        )
+        if not 0 <= max_distance <= phash.MAX_DISTANCE:
+            raise ValidationError({
+                'distance': f'Must be between 0 and {phash.MAX_DISTANCE}.'
+            })
+
+        candidates = Image.objects.filter(
+            phash.candidates_filter(image.phash, max_distance),
+            user=request.user,
+        ).exclude(id=image.id).values_list('id', 'phash')
+        distances = (
+            (phash.distance(image.phash, value), image_id)
+            for image_id, value in candidates
+        )
+        matches = sorted(
+            match for match in distances if match[0] <= max_distance
+        )[:settings.SIMILAR_IMAGES_LIMIT]
+
+        images = Image.objects.filter(
+            id__in=[image_id for _, image_id in matches]
+        ).prefetch_related('labels', 'patient_info').in_bulk()
+        data = []
+        for match_distance, image_id in matches:
+            item = serializers.ImageSerializer(images[image_id]).data
+            item['distance'] = match_distance
+            data.append(item)
+
+        return Response(data)
+
+    @action(methods=['GET'], detail=True, url_path='suggest-labels',
+            url_name='suggest-labels')
+    def suggest_labels(self, request, pk=None):
+        """Suggest labels from the k most similar labelled images.
+
+        Labels are ranked by how many of the neighbours carry them, then
+        by the neighbours' summed similarity. The search runs against the
+        user's in-memory embedding index, see image.embeddings.
+        """
+        image = self.get_object()
+        if image.embedding is None:
+            return Response(
+                {'detail': 'The image embedding has not been computed yet.'},
+                status=status.HTTP_409_CONFLICT
+            )
+        k = self._param_to_int(
+            'k', request.query_params.get('k', settings.EMBEDDING_NEIGHBOURS)
+        )
+        if not 1 <= k <= settings.EMBEDDING_MAX_NEIGHBOURS:
+            raise ValidationError({
+                'k': f'Must be between 1 and '
+                     f'{settings.EMBEDDING_MAX_NEIGHBOURS}.'
+            })
+
+        index = embeddings.get_index(request.user.id)
+        with index.lock:
+            neighbours = index.nearest(
+                embeddings.unpack(image.embedding), k, exclude=[image.id]
+            )[0]
+        similarity = dict(neighbours)
+        votes = {}
+        for image_id, label_id in Image.labels.through.objects.filter(
+            image_id__in=list(similarity)
+        ).values_list('image_id', 'label_id'):
+            count, total = votes.get(label_id, (0, 0.0))
+            votes[label_id] = (count + 1, total + similarity[image_id])
+        names = dict(
+            Label.objects.filter(id__in=list(votes)).values_list('id', 'name')
+        )
+        ranked = sorted(votes.items(), key=lambda item: item[1], reverse=True)
+
+        return Response({
+            'labels': [
+                {'id': label_id, 'name': names[label_id], 'count': count,
+                 'score': round(count / len(neighbours), 4)}
+                for label_id, (count, _) in ranked
+            ],
+            'neighbours': [
+                {'id': image_id, 'similarity': round(score, 4)}
+                for image_id, score in neighbours
+            ],
+        })
+
+    @action(methods=['GET'], detail=True, url_path='tiles', url_name='tiles')
+    def tiles_descriptor(self, request, pk=None):
+        """Return the deep zoom (DZI) descriptor of an image's tiles"""
+        image = self.get_object()
+        if image.tiles_status != Image.TILES_READY:
+            return Response(
+                {'tiles_status': image.tiles_status},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(tiles.descriptor(image))
+
+    @action(
+        methods=['GET'],
+        detail=True,
+        url_path=r'tiles/(?P<level>\d+)/(?P<col>\d+)_(?P<row>\d+)',
+    )
+    def tile(self, request, pk=None, level=None, col=None, row=None):
+        """Serve one precomputed tile of the image pyramid"""
+        image = self.get_object()
+        if image.tiles_status != Image.TILES_READY:
+            raise Http404
+        name = tiles.tile_path(image, int(level), int(col), int(row))
+        if not default_storage.exists(name):
+            raise Http404
+
+        version = tiles.tile_version(image)
+        etag = f'"{version}"'
+        response = get_conditional_response(request, etag=etag) or (
+            FileResponse(default_storage.open(name), content_type='image/jpeg')
+        )
+        response['ETag'] = etag
+        _cache_control(
+            request, response, version, settings.IMAGE_TILE_CACHE_SECONDS
+        )
+        return response
+
+    @action(
+        methods=['GET'], detail=True, url_path='render', url_name='render'
+    )
+    def render_derivative(self, request, pk=None):
+        """Serve a resized and/or transcoded copy of the image file"""
+        image = self.get_object()
+        pixels = (image.width or 0) * (image.height or 0)
+        if not image.pixel_file or pixels > settings.IMAGE_UPLOAD_MAX_PIXELS:
+            # Images over the limit are only viewed through their tiles
+            raise Http404
+        params = serializers.DerivativeParamsSerializer(
+            data=request.query_params
+        )
+        params.is_valid(raise_exception=True)
+        spec = params.validated_data
+        options = {
+            'width': spec.get('width'),
+            'height': spec.get('height'),
+            'format': spec['file_format'],
+            'quality': spec['quality'],
+        }
+
+        etag = f'"{derivatives.derivative_key(image, **options)}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = FileResponse(
+                derivatives.get_derivative(image, **options),
+                content_type=derivatives.CONTENT_TYPES[spec['file_format']]
+            )
+        response['ETag'] = etag
+        _cache_control(
+            request, response, tiles.tile_version(image),
+            settings.IMAGE_DERIVATIVE_CACHE_SECONDS,
+        )
+        return response
+
+
+def _cache_control(request, response, version, seconds):
+    """Let clients keep a file for seconds without asking again only when
+    the URL names its current version with ?v=.
+
+    Tile and render URLs otherwise serve whatever file the image has now,
+    so they are revalidated against the ETag after a short while.
+    """
+    if version and request.query_params.get('v') == version:
+        response['Cache-Control'] = f'private, max-age={seconds}, immutable'
+    else:
+        response['Cache-Control'] = (
+            f'private, max-age={settings.IMAGE_UNVERSIONED_CACHE_SECONDS}'
+        )
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    """Follow the status and progress of the user's background jobs"""
+    serializer_class = serializers.JobSerializer
+    queryset = Job.objects.all()
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        """Return the jobs of the current user, newest first"""
+        queryset = self.queryset.filter(user=self.request.user)
+        if self.action == 'list':
+            job_status = self.request.query_params.get('status')
+            if job_status:
+                queryset = queryset.filter(status=job_status)
+            kind = self.request.query_params.get('kind')
+            if kind:
+                queryset = queryset.filter(kind=kind)
+        return queryset.order_by('-created', '-id')
+
+
+class SyncView(APIView):
+    """Return the changes to the user's data since a change log seq.
+
+    Clients start from since=0 and pass back `next` until `has_more` is
+    false. Each batch reads at most `limit` change log rows through the
+    (user, seq) index and the changed objects by primary key, so a sync
+    costs in proportion to the changes, not to the size of the library.
+    Several changes of one object within a batch come back as one entry
+    with its current state.
+    """
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    sources = {
+        'image': (
+            Image.objects.prefetch_related('labels', 'patient_info'),
+            serializers.ImageSerializer,
+        ),
+        'label': (Label.objects.all(), serializers.LabelSerializer),
+        'patientinfo': (
+            PatientInfo.objects.all(), serializers.PatientInfoSerializer
+        ),
+    }
+
+    def _param_to_int(self, name, default, minimum, maximum):
+        try:
+            value = int(self.request.query_params.get(name, default))
+        except ValueError:
+            raise ValidationError({name: 'A valid integer is required.'})
+        if not minimum <= value <= maximum:
+            raise ValidationError(
+                {name: f'Must be between {minimum} and {maximum}.'}
+            )
+        return value
+
+    def get(self, request):
+        since = self._param_to_int('since', 0, 0, 2 ** 63 - 1)
+        limit = self._param_to_int(
+            'limit', settings.SYNC_BATCH_SIZE, 1, settings.SYNC_MAX_BATCH_SIZE
+        )
+        rows = list(
+            ChangeLog.objects.filter(user=request.user, seq__gt=since)
+            .order_by('seq')
+            .values_list('seq', 'model', 'object_id', 'action')[:limit + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Latest change per object, in the order of those latest changes
+        latest = {}
+        for seq, model, object_id, change_type in rows:
+            _, first = latest.pop((model, object_id), (None, None))
+            if first == ChangeLog.INSERT and change_type != ChangeLog.DELETE:
+                change_type = ChangeLog.INSERT
+            latest[(model, object_id)] = (seq, change_type)
+
+        current = self._current_objects(latest)
+        changes = []
+        for (model, object_id), (seq, change_type) in latest.items():
+            change = {
+                'seq': seq,
+                'model': model,
+                'id': object_id,
+                'action': change_type,
+            }
+            if change_type != ChangeLog.DELETE:
+                data = current.get((model, object_id))
+                if data is None:
+                    # Deleted since; a later batch carries the delete
+                    continue
+                change['data'] = data
+            changes.append(change)
+
+        return Response({
+            'changes': changes,
+            'next': rows[-1][0] if rows else since,
+            'has_more': has_more,
+        })
+
+    def _current_objects(self, latest):
+        """Serialize the changed objects that still exist, by model"""
+        ids = {}
+        for (model, object_id), (_, change_type) in latest.items():
+            if change_type != ChangeLog.DELETE:
+                ids.setdefault(model, []).append(object_id)
+
+        current = {}
+        for model, object_ids in ids.items():
+            queryset, serializer_class = self.sources[model]
+            objects = queryset.filter(
+                user=self.request.user, id__in=object_ids
+            )
+            for item in serializer_class(objects, many=True).data:
+                current[(model, item['id'])] = item
+        return current
+
+
+class EventsView(APIView):
+    """Server-sent events of the user's image label and status changes.
+
+    Each event carries the change log seq as its id. After a reconnect or
+    a resync event, clients catch up with the sync endpoint from the last
+    seq they saw.
+    """
+    authentication_classes = (events.QueryTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+    renderer_classes = (events.EventStreamRenderer,)
+
+    def get(self, request):
+        subscription = pubsub.get_broker().subscribe(
+            pubsub.user_channel(request.user.id)
+        )
+        response = StreamingHttpResponse(
+            events.event_stream(
+                subscription,
+                settings.EVENTS_HEARTBEAT_SECONDS,
+                settings.EVENTS_MAX_SECONDS,
+            ),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Stops nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
@@ -0,0 +1,16 @@
+from django.urls import reverse
+
+from core.benchmarks import expect_status, register
+
+
+TOKEN_URL = reverse('user:token')
+
+
+@register('token-login', iterations=20)
+def token_login(context):
+    payload = {'email': context.user.email, 'password': context.password}
+
+    def call():
+        res = context.client.post(TOKEN_URL, payload)
+        expect_status(res)
+    return call
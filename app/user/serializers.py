@@ -3,13 +3,18 @@ from django.utils.translation import ugettext_lazy as _
 
 from rest_framework import serializers
 
+from core.metrics import TimedSerializerMixin
 
-class UserSerializer(serializers.ModelSerializer):
+
+class UserSerializer(
+    TimedSerializerMixin, serializers.ModelSerializer
+):
     """Serializer for the users object"""
 
     class Meta:
         model = get_user_model()
-        fields = ('email', 'password', 'name')
+        fields = ('email', 'password', 'name', 'image_count')
+        read_only_fields = ('image_count',)
         extra_kwargs = {'password': {'write_only': True, 'min_length': 5}}
 
     def create(self, validated_data):
@@ -28,7 +33,9 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class AuthTokenSerializer(serializers.Serializer):
+class AuthTokenSerializer(
+    TimedSerializerMixin, serializers.Serializer
+):
     """Serializer for the user authentication object"""
     email = serializers.CharField()
     password = serializers.CharField(
@@ -122,6 +122,7 @@ class PrivateUserApiTests(TestCase):
         self.assertEqual(res.data, {
             'name': self.user.name,
             'email': self.user.email,
+            'image_count': 0,
         })
 
     def test_post_me_not_allowed(self):